@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+import threading
+from tempfile import TemporaryDirectory
+
+import numpy as np
+
+from temscript import ReferenceLibrary
+from temscript.flatfield import flat_field_correct
+
+
+def test_integer_clipping():
+    image = np.array([[0, 100], [65535, 5]], dtype=np.uint16)
+    dark = np.full((2, 2), 10, dtype=np.float32)
+    gain = np.array([[1.0, 2.0], [2.0, 1.0]], dtype=np.float32)
+
+    corrected = flat_field_correct(image, dark, gain)
+    assert corrected.dtype == np.uint16
+    assert corrected.tolist() == [[0, 180], [65535, 0]]
+
+    image = np.array([[0, 200], [-30000, 5]], dtype=np.int16)
+    gain = np.array([[1.0, 200.0], [2.0, 1.0]], dtype=np.float32)
+    signed = flat_field_correct(image, dark, gain)
+    assert signed.dtype == np.int16
+    assert signed.tolist() == [[-10, 32767], [-32768, -5]]
+
+
+def test_integer_chunks():
+    # Image larger than one chunk with a partial last chunk
+    rng = np.random.RandomState(0)
+    image = rng.randint(0, 4000, size=(1100, 700)).astype(np.uint16)
+    dark = rng.uniform(0, 100, size=image.shape).astype(np.float32)
+    gain = rng.uniform(0.5, 2.0, size=image.shape).astype(np.float32)
+    expected = np.clip(np.rint((image.astype(np.float32) - dark) * gain), 0, 65535).astype(np.uint16)
+
+    assert np.array_equal(flat_field_correct(image, dark, gain), expected)
+    result = flat_field_correct(image, dark, gain, out=image)
+    assert result is image
+    assert np.array_equal(image, expected)
+
+
+def test_float_in_place():
+    image = np.array([[0.0, 100.0], [200.0, 5.0]], dtype=np.float32)
+    dark = np.full((2, 2), 10, dtype=np.float32)
+    gain = np.full((2, 2), 0.5, dtype=np.float32)
+    result = flat_field_correct(image, dark, gain, out=image)
+    assert result is image
+    assert image.tolist() == [[-5.0, 45.0], [95.0, -2.5]]
+
+
+def test_library():
+    with TemporaryDirectory() as directory:
+        library = ReferenceLibrary(directory, max_entries=1)
+        key = library.make_key("CCD", 1, "FULL", 0.5)
+        dark = np.full((4, 4), 10.0)
+        gain = np.full((4, 4), 2.0)
+
+        # Concurrent puts of dark and gain references must keep both
+        barrier = threading.Barrier(2)
+
+        def put(**kw):
+            barrier.wait()
+            library.put(key, **kw)
+
+        threads = [threading.Thread(target=put, kwargs={"dark": dark}),
+                   threading.Thread(target=put, kwargs={"gain": gain})]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        library.put(library.make_key("CCD", 2, "FULL", 0.5), dark=dark[:2, :2])
+
+        # Reload from disk
+        library = ReferenceLibrary(directory)
+        assert len(library) == 2
+        loaded_dark, loaded_gain = library.get(key)
+        assert np.array_equal(loaded_dark, dark) and np.array_equal(loaded_gain, gain)
+        image = np.full((4, 4), 60, dtype=np.uint16)
+        assert np.array_equal(library.correct(key, image), np.full((4, 4), 100))
+
+
+if __name__ == '__main__':
+    for test in (test_integer_clipping, test_integer_chunks, test_float_in_place, test_library):
+        test()
+        print("%s: OK" % test.__name__)
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+import os
+from tempfile import TemporaryDirectory
+
+import numpy as np
+
+from temscript import MrcWriter, load_mrc
+
+
+def make_frames(count=5, shape=(64, 48), dtype=np.uint16):
+    rng = np.random.RandomState(0)
+    return [rng.randint(0, 4000, size=shape).astype(dtype) for n in range(count)]
+
+
+def test_mrc_writer():
+    with TemporaryDirectory() as directory:
+        frames = make_frames(dtype=np.int16)
+        path = os.path.join(directory, "stack.mrc")
+        with MrcWriter(path, pixel_size=1e-10, capacity=2) as writer:
+            for index, frame in enumerate(frames):
+                writer.append(frame, tilt_angle=index * 3.0 - 6.0)
+
+        data, header = load_mrc(path)
+        stack = np.array(frames, dtype=np.float64)
+        assert np.array_equal(data, np.array(frames))
+        assert header["min"] == stack.min() and header["max"] == stack.max()
+        assert np.isclose(header["mean"], stack.mean(), rtol=1e-6)
+        assert np.isclose(header["rms"], stack.std(), rtol=1e-5)
+        assert np.allclose(header["tilt_angles"][:len(frames)], [-6.0, -3.0, 0.0, 3.0, 6.0])
+        assert np.isclose(header["pixel_size"], 1e-10, rtol=1e-5)
+
+
+if __name__ == '__main__':
+    test_mrc_writer()
+    print("test_mrc_writer: OK")
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+import os
+from tempfile import TemporaryDirectory
+
+import numpy as np
+
+from temscript import NullMicroscope, RecordingMicroscope, ReplayMicroscope
+from temscript.recording_microscope import load_recording
+
+
+def record_session(filename):
+    results = {}
+    with RecordingMicroscope(NullMicroscope(wait_exposure=False), filename) as microscope:
+        results["family"] = microscope.get_family()
+        results["defocus"] = microscope.get_defocus()
+        microscope.set_defocus(1e-6)
+        results["defocus_after"] = microscope.get_defocus()
+        results["camera_param"] = microscope.get_camera_param("CCD")
+        results["image"] = microscope.acquire("CCD")["CCD"]
+        try:
+            microscope.get_camera_param("UNKNOWN")
+        except KeyError:
+            pass
+        else:
+            raise AssertionError("Unknown camera didn't raise KeyError")
+    return results
+
+
+def test_round_trip():
+    for name in ("session.rec", "session.rec.gz"):
+        with TemporaryDirectory() as directory:
+            filename = os.path.join(directory, name)
+            results = record_session(filename)
+
+            calls = list(load_recording(filename))
+            assert [call["method"] for call in calls] == ["get_family", "get_defocus", "set_defocus", "get_defocus",
+                                                         "get_camera_param", "acquire", "get_camera_param"]
+            assert calls[-1]["error"][0] == "KeyError"
+
+            replay = ReplayMicroscope(filename, latency_scale=0.0)
+            assert replay.get_family() == results["family"]
+            # Calls with the same arguments are served in recorded order
+            assert replay.get_defocus() == results["defocus"]
+            assert replay.get_defocus() == results["defocus_after"]
+            assert replay.get_camera_param("CCD") == results["camera_param"]
+            assert np.array_equal(replay.acquire("CCD")["CCD"], results["image"])
+            try:
+                replay.get_camera_param("UNKNOWN")
+            except KeyError:
+                pass
+            else:
+                raise AssertionError("Recorded KeyError wasn't replayed")
+            try:
+                replay.get_voltage()
+            except KeyError:
+                pass
+            else:
+                raise AssertionError("Call of method not recorded didn't raise KeyError")
+
+
+if __name__ == '__main__':
+    test_round_trip()
+    print("test_round_trip: OK")
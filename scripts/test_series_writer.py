@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+import os
+from tempfile import TemporaryDirectory
+
+import numpy as np
+
+from temscript import SeriesWriter, load_series
+
+
+def make_frames(count=5, shape=(64, 48), dtype=np.uint16):
+    rng = np.random.RandomState(0)
+    return [rng.randint(0, 4000, size=shape).astype(dtype) for n in range(count)]
+
+
+def test_series_writer():
+    with TemporaryDirectory() as directory:
+        frames = make_frames()
+        path = os.path.join(directory, "series")
+        with SeriesWriter(path, capacity=2) as writer:
+            for index, frame in enumerate(frames):
+                writer.append({"CCD": frame, "HAADF": frame[:8, :8]},
+                              state={"defocus": index * 1e-6, "stage_position": {"x": float(index), "y": 0.0}})
+            try:
+                writer.append({"CCD": frames[0]})
+            except ValueError:
+                pass
+            else:
+                raise AssertionError("Frame with missing detector was accepted")
+
+        series = load_series(path)
+        assert np.array_equal(series["CCD"], np.array(frames))
+        assert np.array_equal(series["HAADF"], np.array(frames)[:, :8, :8])
+        assert np.array_equal(np.load(os.path.join(path, "frames-CCD.npy")), np.array(frames))
+        metadata = series["metadata"]
+        assert list(metadata["index"]) == list(range(len(frames)))
+        assert np.allclose(metadata["defocus"], np.arange(len(frames)) * 1e-6)
+        assert np.allclose(metadata["stage_position"]["x"], np.arange(len(frames)))
+
+
+if __name__ == '__main__':
+    test_series_writer()
+    print("test_series_writer: OK")
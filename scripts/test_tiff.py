@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+import os
+from tempfile import TemporaryDirectory
+
+import numpy as np
+
+from temscript import TiffWriter, load_tiff
+
+
+def make_frames(count=5, shape=(64, 48), dtype=np.uint16):
+    rng = np.random.RandomState(0)
+    return [rng.randint(0, 4000, size=shape).astype(dtype) for n in range(count)]
+
+
+def test_tiff_writer():
+    with TemporaryDirectory() as directory:
+        frames = make_frames()
+        for compression in (None, "zlib"):
+            path = os.path.join(directory, "stack-%s.tif" % compression)
+            with TiffWriter(path, compression=compression, strip_size=1024) as writer:
+                for index, frame in enumerate(frames):
+                    writer.append(frame, metadata={"index": index, "defocus": index * 1e-6})
+
+            loaded, metadata = load_tiff(path)
+            assert len(loaded) == len(frames)
+            for frame, loaded_frame in zip(frames, loaded):
+                assert loaded_frame.dtype == frame.dtype
+                assert np.array_equal(loaded_frame, frame)
+            assert [item["index"] for item in metadata] == list(range(len(frames)))
+
+
+if __name__ == '__main__':
+    test_tiff_writer()
+    print("test_tiff_writer: OK")
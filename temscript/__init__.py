@@ -1,9 +1,34 @@
 from .version import __version__ as version
 from .enums import *
 from .instrument import *
-from .base_microscope import BaseMicroscope
+from .base_microscope import BaseMicroscope, STATE_FIELDS, TITAN_STATE_FIELDS, STEM_STATE_FIELDS, \
+    SETTABLE_STATE_FIELDS, STATE_FIELD_DEPENDENCIES
 from .microscope import Microscope
 from .null_microscope import NullMicroscope
+from .simulation import LatencyProfile, FixedLatency, NormalLatency, HistogramLatency, RealClock, ScaledClock, \
+    VirtualClock
+from .specimen import SyntheticSpecimen
+from .frame_pool import FramePool
 from .remote_microscope import RemoteMicroscope
+from .stage_move import StageMoveHandle
+from .forwarding_microscope import ForwardingMicroscope
+from .caching_microscope import CachingMicroscope, CachePolicy
+from .executor import MicroscopeExecutor
+import sys
+if sys.version_info >= (3, 7):
+    from .async_microscope import AsyncMicroscope
+del sys
+from .telemetry import TelemetryRecorder, load_telemetry
+from .tilt_series import TiltSeries
+from .montage import Montage, ImageShiftMontage
+from .calibration import ImageShiftCalibration
+from .autofocus import Autofocus
+from .correlation import DriftTracker
+from .averaging import StreamingAverager
+from .series_writer import SeriesWriter, load_series
+from .mrc import MrcWriter, load_mrc
+from .tiff import TiffWriter, load_tiff
+from .flatfield import ReferenceLibrary
+from .recording_microscope import RecordingMicroscope, ReplayMicroscope, load_recording
 from .server import run_server
 
@@ -0,0 +1,85 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def settle(microscope, seconds):
+    """
+    Wait *seconds* for the microscope to settle.
+
+    The wait is passed through the clock of the microscope (or of the backend it forwards to), e.g. the clock of a
+    :class:`NullMicroscope`. Microscopes without clock wait in real time.
+    """
+    if seconds <= 0.0:
+        return
+    while microscope is not None:
+        clock = getattr(microscope, "clock", None)
+        if clock is not None:
+            clock.sleep(seconds)
+            return
+        microscope = getattr(microscope, "backend", None)
+    time.sleep(seconds)
+
+
+class Pipeline:
+    """
+    Runs *func* for submitted items in worker threads, with a limited number of pending items.
+
+    Used by the acquisition engines to overlap the processing and writing of frames with the next stage movement
+    and acquisition. :meth:`submit` blocks, if *max_pending* items are not yet processed (back pressure). Exceptions
+    raised by *func* are reraised by the next call of :meth:`submit` or by :meth:`close`.
+    """
+    def __init__(self, func, workers=2, max_pending=4):
+        self._func = func
+        self._executor = ThreadPoolExecutor(max_workers=max(int(workers), 1))
+        self._max_pending = max(int(max_pending), 1)
+        self._slots = threading.BoundedSemaphore(self._max_pending)
+        self._lock = threading.Lock()
+        self._error = None
+        self.wait_time = 0.0        # Time submit() was blocked by back pressure
+
+    def _run(self, args):
+        try:
+            return self._func(*args)
+        except BaseException as exc:
+            with self._lock:
+                if self._error is None:
+                    self._error = exc
+            raise
+        finally:
+            self._slots.release()
+
+    def _check(self):
+        with self._lock:
+            if self._error is not None:
+                raise self._error
+
+    def submit(self, *args):
+        """Queue call of *func* with *args*."""
+        self._check()
+        start = time.perf_counter()
+        self._slots.acquire()
+        self.wait_time += time.perf_counter() - start
+        return self._executor.submit(self._run, args)
+
+    def join(self):
+        """Wait for all pending items, reraise the first exception raised by *func*. More items can be submitted."""
+        for n in range(self._max_pending):
+            self._slots.acquire()
+        for n in range(self._max_pending):
+            self._slots.release()
+        self._check()
+
+    def close(self):
+        """Wait for all pending items, reraise the first exception raised by *func*."""
+        self._executor.shutdown(wait=True)
+        self._check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._executor.shutdown(wait=True)
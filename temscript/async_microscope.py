@@ -0,0 +1,162 @@
+import asyncio
+import functools
+
+from .base_microscope import BaseMicroscope
+from .executor import MicroscopeExecutor
+
+
+# Methods of BaseMicroscope, which are not generated as coroutines calling the backend
+_EXCLUDED_METHODS = frozenset(("subscribe", "wait_for"))
+
+
+def _make_coroutine(name):
+    """Create coroutine method calling method *name* of the backend."""
+    async def method(self, *args, **kw):
+        return await self.call(name, *args, **kw)
+    method.__name__ = name
+    method.__qualname__ = "AsyncMicroscope." + name
+    method.__doc__ = getattr(BaseMicroscope, name).__doc__
+    return method
+
+
+class AsyncMicroscope:
+    """
+    Asyncio interface to any microscope.
+
+    The microscope is created by calling *backend_factory* in the thread of a :class:`MicroscopeExecutor`, all calls
+    are executed in this thread. Thus blocking calls (like COM calls of the local :class:`Microscope`) don't stall the
+    event loop.
+
+    All methods of the :class:`BaseMicroscope` interface are available as coroutines with the same name and
+    arguments. Calls are executed one after the other in the priority lanes of the executor, e.g.
+    ``set_beam_blanked`` is executed before queued stage movements. Use :meth:`run_in_thread` to process data
+    concurrently to the calls of the microscope.
+
+    Creating an instance blocks until the microscope was created. Use :meth:`create` within coroutines instead.
+
+    :param backend_factory: Callable without arguments returning the microscope, e.g. the :class:`Microscope` class.
+    :param priorities: Priority lanes by method name (see :class:`MicroscopeExecutor`)
+    :type priorities: Optional[Dict[str, int]]
+
+    Usage:
+
+        >>> async def main():
+        ...     async with await AsyncMicroscope.create(Microscope) as microscope:
+        ...         images = await microscope.acquire("BM-Ceta")
+        ...         # Move stage while the previous image is processed
+        ...         _, result = await asyncio.gather(microscope.set_stage_position({"x": 1e-6}),
+        ...                                          microscope.run_in_thread(process, images["BM-Ceta"]))
+        >>> asyncio.run(main())
+
+    .. versionadded:: 2.2.0
+    """
+    def __init__(self, backend_factory, priorities=None):
+        self._executor = MicroscopeExecutor(backend_factory, priorities=priorities, name="temscript-async")
+
+    @classmethod
+    async def create(cls, backend_factory, priorities=None):
+        """Create instance without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(cls, backend_factory, priorities=priorities))
+
+    @property
+    def executor(self):
+        """The :class:`MicroscopeExecutor` executing the calls."""
+        return self._executor
+
+    def call(self, method_name, *args, **kw):
+        """
+        Call method *method_name* of the microscope with the given arguments.
+
+        A keyword *priority* selects the priority lane of the call (see :meth:`MicroscopeExecutor.submit`).
+
+        :returns: Awaitable future of the call's result
+        """
+        return asyncio.wrap_future(self._executor.submit(method_name, *args, **kw))
+
+    def run_in_thread(self, func, *args):
+        """
+        Run *func* with *args* in the default executor of the event loop, e.g. for processing images concurrently
+        to calls of the microscope.
+
+        :returns: Awaitable future of the result of *func*
+        """
+        return asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def move_stage_while(self, pos, *awaitables, method=None, speed=None):
+        """
+        Move stage to *pos* while awaiting *awaitables*.
+
+        The stage movement is done concurrently to the awaitables (e.g. processing of the previous image started
+        with :meth:`run_in_thread`), the coroutine returns after both finished.
+
+        :returns: List with results of the *awaitables*
+        """
+        results = await asyncio.gather(self.set_stage_position(pos, method=method, speed=speed), *awaitables)
+        return list(results[1:])
+
+    async def wait_for(self, getter, predicate, timeout=10.0, poll_policy=None):
+        """
+        Wait until the value returned by a getter satisfies a predicate (see :meth:`BaseMicroscope.wait_for`).
+
+        Each poll is a separate call of the getter, the coroutine sleeps in the event loop between the polls. Thus
+        other calls (e.g. ``set_beam_blanked``) are executed while waiting.
+
+        :returns: The value satisfying the predicate
+        :raises TimeoutError: If the condition wasn't met within *timeout*
+        """
+        from .polling import PollPolicy, make_predicate, getter_name
+        predicate = make_predicate(predicate)
+        method_name = getter_name(getter)
+        if poll_policy is None:
+            poll_policy = PollPolicy()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout is not None else None
+        for interval in poll_policy.intervals():
+            value = await self.call(method_name)
+            if predicate(value):
+                return value
+            if deadline is not None:
+                remaining = deadline - loop.time()
+                if remaining <= 0.0:
+                    raise TimeoutError("Timeout while waiting for %s (last value: %r)" % (getter, value))
+                interval = min(interval, remaining)
+            await asyncio.sleep(interval)
+
+    def subscribe(self, fields, callback, min_interval=0.1, max_interval=2.0, error_callback=None):
+        """
+        Subscribe to changes of state fields (see :meth:`BaseMicroscope.subscribe`).
+
+        The callbacks are called in the event loop of the calling coroutine.
+        """
+        loop = asyncio.get_running_loop()
+
+        def threadsafe(func):
+            return (lambda arg: loop.call_soon_threadsafe(func, arg)) if func is not None else None
+
+        return self._executor.subscribe(fields, threadsafe(callback), min_interval=min_interval,
+                                        max_interval=max_interval, error_callback=threadsafe(error_callback))
+
+    def statistics(self):
+        """Return statistics of the executor (see :meth:`MicroscopeExecutor.statistics`)."""
+        return self._executor.statistics()
+
+    def close(self):
+        """Shut down the executor, blocks until all queued calls are executed."""
+        self._executor.shutdown()
+
+    async def aclose(self):
+        """Shut down the executor without blocking the event loop."""
+        await asyncio.get_running_loop().run_in_executor(None, self._executor.shutdown)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.aclose()
+
+
+for _name in dir(BaseMicroscope):
+    if not _name.startswith("_") and _name not in _EXCLUDED_METHODS and callable(getattr(BaseMicroscope, _name)):
+        setattr(AsyncMicroscope, _name, _make_coroutine(_name))
+del _name
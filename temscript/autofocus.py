@@ -0,0 +1,282 @@
+import math
+import time
+
+import numpy as np
+
+from ._pipeline import settle
+
+
+_EPSILON = 1e-12
+_GOLDEN = 0.5 * (3.0 - math.sqrt(5.0))     # 0.382, fraction of the golden section
+_EXPAND = 0.5 * (1.0 + math.sqrt(5.0))     # 1.618, expansion factor of the bracketing
+
+
+def _as_float(image):
+    return np.asarray(image, dtype=np.float32)
+
+
+def gradient_energy(image):
+    """
+    Return mean squared gradient of *image* (finite differences) normalized by the squared mean intensity.
+
+    .. versionadded:: 2.2.0
+    """
+    image = _as_float(image)
+    gx = np.diff(image, axis=1)
+    gy = np.diff(image, axis=0)
+    mean = float(image.mean())
+    return (float(np.mean(gx * gx)) + float(np.mean(gy * gy))) / max(mean * mean, _EPSILON)
+
+
+def normalized_variance(image):
+    """
+    Return variance of *image* normalized by the squared mean intensity.
+
+    .. versionadded:: 2.2.0
+    """
+    image = _as_float(image)
+    mean = float(image.mean())
+    return float(image.var()) / max(mean * mean, _EPSILON)
+
+
+def band_power(image, low=0.05, high=0.25):
+    """
+    Return power of *image* in the frequency band from *low* to *high* (in cycles per pixel, 0.5 is Nyquist)
+    normalized by the squared mean intensity.
+
+    .. versionadded:: 2.2.0
+    """
+    image = _as_float(image)
+    rows, cols = image.shape
+    mean = float(image.mean())
+    spectrum = np.fft.rfft2(image - mean)
+    ky = np.fft.fftfreq(rows).astype(np.float32)[:, np.newaxis]
+    kx = np.fft.rfftfreq(cols).astype(np.float32)[np.newaxis, :]
+    radius2 = ky * ky + kx * kx
+    mask = (radius2 >= low * low) & (radius2 <= high * high)
+    power = spectrum.real ** 2 + spectrum.imag ** 2
+    return float(power[mask].sum()) / (rows * cols) ** 2 / max(mean * mean, _EPSILON)
+
+
+# Sharpness metrics by name. Metrics are callables returning a (larger is sharper) score for an image.
+SHARPNESS_METRICS = {
+    "gradient": gradient_energy,
+    "variance": normalized_variance,
+    "band": band_power,
+}
+
+
+class _BudgetExhausted(Exception):
+    pass
+
+
+class Autofocus:
+    """
+    Autofocus by maximizing the sharpness of images over the defocus.
+
+    Starting at the current defocus, a bracket of the sharpest image is searched by steps of growing size (starting
+    with *step*). The bracket is then narrowed by parabolic interpolation (*method* "parabolic", falling back to golden
+    section steps, if the parabola is not trustworthy) or golden section search (*method* "golden"), until it is
+    smaller than *tolerance*. Each evaluation costs one exposure, defoci are never acquired twice. The search stops
+    after *max_exposures* exposures.
+
+    The images are scored by *metric*, either a name of :data:`SHARPNESS_METRICS` or a callable. To reduce time
+    and dose, the acquisition can use a larger *binning* and a smaller *image_size* (e.g. "QUARTER" for the central
+    region) and *exposure* time. These parameters are restored afterwards.
+
+    :param microscope: Microscope
+    :type microscope: BaseMicroscope
+    :param detector: Name of detector
+    :type detector: str
+    :param metric: Sharpness metric
+    :type metric: Union[str, Callable]
+    :param step: Initial step in meters
+    :type step: float
+    :param tolerance: Precision of the defocus in meters
+    :type tolerance: float
+    :param search_range: Maximum deviation from the initial defocus in meters
+    :type search_range: float
+    :param max_exposures: Maximum number of exposures
+    :type max_exposures: int
+    :param method: "parabolic" or "golden"
+    :type method: str
+    :param binning: Optional binning of the acquisitions
+    :type binning: Optional[int]
+    :param image_size: Optional image size of the acquisitions ("FULL", "HALF", "QUARTER")
+    :type image_size: Optional[str]
+    :param exposure: Optional exposure time of the acquisitions in seconds
+    :type exposure: Optional[float]
+    :param settle_time: Time in seconds to wait after changing the defocus (in clock time for a simulated microscope)
+    :type settle_time: float
+
+    Usage:
+
+        >>> autofocus = Autofocus(microscope, "BM-Ceta", step=1e-6, tolerance=20e-9, binning=4, image_size="HALF")
+        >>> result = autofocus.run()
+        >>> result["defocus"], result["exposures"]
+
+    .. versionadded:: 2.2.0
+    """
+    def __init__(self, microscope, detector, metric="gradient", step=0.5e-6, tolerance=20e-9, search_range=10e-6,
+                 max_exposures=15, method="parabolic", binning=None, image_size=None, exposure=None,
+                 settle_time=0.0):
+        if method not in ("parabolic", "golden"):
+            raise ValueError("Unknown search method: %r" % method)
+        if isinstance(metric, str):
+            try:
+                metric = SHARPNESS_METRICS[metric]
+            except KeyError:
+                raise KeyError("Unknown sharpness metric: %s" % metric)
+        self.microscope = microscope
+        self.detector = detector
+        self.metric = metric
+        self.step = abs(float(step))
+        self.tolerance = abs(float(tolerance))
+        self.search_range = abs(float(search_range))
+        self.max_exposures = int(max_exposures)
+        self.method = method
+        self.settle_time = float(settle_time)
+        self.acquisition_param = {}
+        if binning is not None:
+            self.acquisition_param["binning"] = int(binning)
+        if image_size is not None:
+            self.acquisition_param["image_size"] = image_size
+        if exposure is not None:
+            self.acquisition_param["exposure(s)"] = float(exposure)
+        self._scores = {}
+        self._evaluations = []
+        self._limits = (-np.inf, np.inf)
+
+    def _set_param(self, param):
+        """Set acquisition parameters of the detector, return previous values."""
+        if not param:
+            return {}
+        try:
+            previous = self.microscope.get_camera_param(self.detector)
+            setter = self.microscope.set_camera_param
+            args = (self.detector,)
+        except KeyError:
+            # STEM detector
+            previous = self.microscope.get_stem_acquisition_param()
+            setter = self.microscope.set_stem_acquisition_param
+            args = ()
+            param = {("dwell_time(s)" if key == "exposure(s)" else key): value for key, value in param.items()}
+        setter(*(args + (param,)))
+        return (setter, args, {key: previous[key] for key in param if key in previous})
+
+    def score(self, defocus):
+        """Return sharpness score at *defocus* (acquires an image, unless the defocus was evaluated before)."""
+        defocus = min(max(defocus, self._limits[0]), self._limits[1])
+        key = round(defocus * 1e12)
+        if key in self._scores:
+            return self._scores[key]
+        if len(self._evaluations) >= self.max_exposures:
+            raise _BudgetExhausted()
+        self.microscope.set_defocus(defocus)
+        settle(self.microscope, self.settle_time)
+        image = self.microscope.acquire(self.detector)[self.detector]
+        value = float(self.metric(image))
+        self._scores[key] = value
+        self._evaluations.append((defocus, value))
+        return value
+
+    def run(self, apply=True):
+        """
+        Search the defocus of the sharpest image.
+
+        :param apply: Whether the found defocus is set. Otherwise the initial defocus is restored.
+        :type apply: bool
+        :returns: Dict with the keys "defocus" (best defocus in meters), "score" (sharpness at this defocus),
+            "exposures" (number of acquired images), "converged" (whether the tolerance was reached), "evaluations"
+            (list of (defocus, score) tuples in acquisition order), and "time" (duration in seconds).
+        """
+        start_time = time.perf_counter()
+        initial = float(self.microscope.get_defocus())
+        self._limits = (initial - self.search_range, initial + self.search_range)
+        self._scores = {}
+        self._evaluations = []
+        previous = self._set_param(self.acquisition_param)
+        converged = False
+        try:
+            try:
+                converged = self._search(initial)
+            except _BudgetExhausted:
+                pass
+        finally:
+            if previous:
+                setter, args, values = previous
+                setter(*(args + (values,)))
+            if self._evaluations:
+                best, value = max(self._evaluations, key=lambda item: item[1])
+            else:
+                best, value = initial, None
+            self.microscope.set_defocus(best if apply else initial)
+
+        return {
+            "defocus": best,
+            "score": value,
+            "exposures": len(self._evaluations),
+            "converged": converged,
+            "evaluations": list(self._evaluations),
+            "time": time.perf_counter() - start_time
+        }
+
+    def _bracket(self, initial):
+        """Return (lower, middle, upper) defoci with score(middle) >= score(lower), score(upper)."""
+        low_limit, high_limit = self._limits
+        a, b = initial, min(initial + self.step, high_limit)
+        fa, fb = self.score(a), self.score(b)
+        if fb < fa:
+            # Search in the other direction
+            a, b, fa, fb = b, a, fb, fa
+        while True:
+            c = min(max(b + _EXPAND * (b - a), low_limit), high_limit)
+            if c == b:
+                # Maximum at the limit of the search range
+                return (a, b, b) if a < b else (b, b, a)
+            fc = self.score(c)
+            if fc <= fb:
+                return (a, b, c) if a < c else (c, b, a)
+            a, b, fa, fb = b, c, fb, fc
+
+    def _search(self, initial):
+        lower, middle, upper = self._bracket(initial)
+        while upper - lower > 2.0 * self.tolerance:
+            x = None
+            if self.method == "parabolic":
+                x = self._parabola_vertex(lower, middle, upper)
+            if x is None:
+                # Golden section step into the larger interval
+                if upper - middle > middle - lower:
+                    x = middle + _GOLDEN * (upper - middle)
+                else:
+                    x = middle - _GOLDEN * (middle - lower)
+            elif abs(x - middle) < 0.5 * self.tolerance:
+                # The parabola predicts the current maximum, check the other side of it
+                x = middle + (0.5 * self.tolerance if upper - middle > middle - lower else -0.5 * self.tolerance)
+            if self.score(x) > self.score(middle):
+                if x > middle:
+                    lower, middle = middle, x
+                else:
+                    upper, middle = middle, x
+            elif x > middle:
+                upper = x
+            else:
+                lower = x
+        return True
+
+    def _parabola_vertex(self, lower, middle, upper):
+        """Return vertex of parabola through the scores at the three defoci, None if not within the bracket."""
+        if not lower < middle < upper:
+            return None
+        fl, fm, fu = self.score(lower), self.score(middle), self.score(upper)
+        p = (middle - lower) ** 2 * (fm - fu) - (middle - upper) ** 2 * (fm - fl)
+        q = (middle - lower) * (fm - fu) - (middle - upper) * (fm - fl)
+        if abs(q) < _EPSILON * abs(p) or q == 0.0:
+            return None
+        x = middle - 0.5 * p / q
+        # Only trust vertex well inside the bracket
+        margin = 0.1 * (upper - lower)
+        if not lower + margin <= x <= upper - margin:
+            return None
+        return x
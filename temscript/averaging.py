@@ -0,0 +1,232 @@
+import threading
+import time
+
+import numpy as np
+
+from ._pipeline import Pipeline
+from .correlation import DriftTracker
+
+
+def _roll_into(frame, shift_x, shift_y, out):
+    """Store *frame* cyclically shifted by integer (*shift_x*, *shift_y*) in *out* (like numpy.roll)."""
+    rows, cols = frame.shape
+    sy, sx = shift_y % rows, shift_x % cols
+    for dst_rows, src_rows in ((slice(sy, rows), slice(0, rows - sy)), (slice(0, sy), slice(rows - sy, rows))):
+        for dst_cols, src_cols in ((slice(sx, cols), slice(0, cols - sx)), (slice(0, sx), slice(cols - sx, cols))):
+            out[dst_rows, dst_cols] = frame[src_rows, src_cols]
+
+
+def _fourier_shift_into(frame, shift_x, shift_y, out):
+    """Store *frame* cyclically shifted by subpixel (*shift_x*, *shift_y*) in *out*."""
+    rows, cols = frame.shape
+    spectrum = np.fft.rfft2(frame)
+    ky = np.fft.fftfreq(rows)[:, np.newaxis]
+    kx = np.fft.rfftfreq(cols)[np.newaxis, :]
+    spectrum *= np.exp(-2j * np.pi * ky * shift_y)
+    spectrum *= np.exp(-2j * np.pi * kx * shift_x)
+    out[...] = np.fft.irfft2(spectrum, s=frame.shape)
+
+
+class StreamingAverager:
+    """
+    Aligns and averages frames as they arrive, with memory independent of the number of frames.
+
+    Each frame passed to :meth:`add` is aligned to the reference by phase correlation (see :class:`DriftTracker`)
+    in a pool of *workers* threads, thus the alignment overlaps with the next exposure. The aligned frame is
+    accumulated into the running mean and the running sum of squared deviations (Welford's algorithm) in float64.
+    Only the accumulators and at most *max_pending* frames waiting for alignment are kept in memory.
+
+    The first frame is the reference. Every *reference_interval* accepted frames, the reference is replaced by the
+    running mean, which is less noisy than a single frame. Frames with a correlation peak below *min_peak* are
+    rejected.
+
+    Frames are shifted cyclically by whole pixels (*shift_mode* "integer"), or by subpixel shifts using the FFT
+    (*shift_mode* "fourier", slower). In both cases, pixels shifted out on one side come in on the other side.
+
+    :param workers: Number of alignment threads
+    :type workers: int
+    :param max_pending: Maximum number of frames waiting for the alignment
+    :type max_pending: int
+    :param align: Whether the frames are aligned. Otherwise they are just accumulated.
+    :type align: bool
+    :param shift_mode: "integer" or "fourier"
+    :type shift_mode: str
+    :param reference_interval: Number of frames after which the reference is updated, never if None
+    :type reference_interval: Optional[int]
+    :param min_peak: Minimum correlation peak of accepted frames
+    :type min_peak: float
+    :param max_size: Maximum size of frames for the alignment (see :class:`DriftTracker`)
+    :type max_size: int
+    :param upsample: Upsampling factor of the subpixel refinement (see :class:`DriftTracker`)
+    :type upsample: int
+
+    Usage:
+
+        >>> averager = StreamingAverager(workers=2)
+        >>> for n in range(50):
+        ...     averager.add(microscope.acquire("BM-Ceta")["BM-Ceta"])
+        >>> result = averager.result()
+        >>> result["mean"], result["variance"], result["count"]
+
+    .. versionadded:: 2.2.0
+    """
+    def __init__(self, workers=2, max_pending=2, align=True, shift_mode="integer", reference_interval=5,
+                 min_peak=0.02, max_size=512, upsample=10):
+        if shift_mode not in ("integer", "fourier"):
+            raise ValueError("Unknown shift mode: %r" % shift_mode)
+        self.align = align
+        self.shift_mode = shift_mode
+        self.reference_interval = int(reference_interval) if reference_interval else None
+        self.min_peak = float(min_peak)
+        self.max_size = int(max_size)
+        self.upsample = int(upsample)
+        self._pipeline = Pipeline(self._process, workers=workers, max_pending=max_pending)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._reference = None          # Tuple (version, reference frame)
+        self._shape = None
+        self._count = 0
+        self._submitted = 0
+        self._rejected = 0
+        self._mean = None
+        self._m2 = None
+        self._scratch = None
+        self._shifts = []
+        self._timings = {"align": 0.0, "accumulate": 0.0}
+
+    def add(self, frame):
+        """
+        Queue *frame* for alignment and accumulation. Blocks, if *max_pending* frames are waiting.
+
+        :raises ValueError: If the shape of *frame* doesn't match the first frame
+        """
+        frame = np.asarray(frame)
+        if frame.ndim != 2:
+            raise ValueError("Frames must be 2D arrays.")
+        with self._lock:
+            if self._shape is None:
+                self._allocate(frame.shape)
+                self._reference = (0, frame)
+            elif frame.shape != self._shape:
+                raise ValueError("Frame shape %s doesn't match shape %s." % (frame.shape, self._shape))
+            index = self._submitted
+            self._submitted += 1
+        if index == 0 or not self.align:
+            # Reference frame is accumulated without alignment
+            self._accumulate(index, frame, (0.0, 0.0), 1.0)
+        else:
+            self._pipeline.submit(index, frame)
+
+    def acquire(self, microscope, detector, count):
+        """
+        Acquire *count* frames of *detector* and add them. The frames are aligned while the next frame is acquired.
+
+        :returns: Result dict (see :meth:`result`)
+        """
+        for n in range(count):
+            self.add(microscope.acquire(detector)[detector])
+        return self.result()
+
+    def _allocate(self, shape):
+        self._shape = tuple(shape)
+        self._mean = np.zeros(shape, dtype=np.float64)
+        self._m2 = np.zeros(shape, dtype=np.float64)
+        self._scratch = (np.empty(shape, dtype=np.float64), np.empty(shape, dtype=np.float64))
+
+    def _tracker(self):
+        """Return the tracker of the current thread, updated to the current reference."""
+        with self._lock:
+            version, reference = self._reference
+        local = self._local
+        if getattr(local, "version", None) != version:
+            local.tracker = DriftTracker(reference, max_size=self.max_size, upsample=self.upsample)
+            local.version = version
+        return local.tracker
+
+    def _process(self, index, frame):
+        start = time.perf_counter()
+        shift, peak = self._tracker().measure(frame)
+        duration = time.perf_counter() - start
+        with self._lock:
+            self._timings["align"] += duration
+        self._accumulate(index, frame, shift, peak)
+
+    def _accumulate(self, index, frame, shift, peak):
+        with self._lock:
+            accepted = peak >= self.min_peak
+            self._shifts.append((index, shift[0], shift[1], peak, accepted))
+            if not accepted:
+                self._rejected += 1
+                return
+            start = time.perf_counter()
+            aligned, temp = self._scratch
+            if self.shift_mode == "fourier" and shift != (0.0, 0.0):
+                _fourier_shift_into(frame, -shift[0], -shift[1], aligned)
+            else:
+                _roll_into(frame, -int(round(shift[0])), -int(round(shift[1])), aligned)
+
+            # Welford update: delta = x - mean, mean += delta / n, m2 += delta * (x - new mean)
+            self._count += 1
+            count = self._count
+            delta = aligned
+            delta -= self._mean
+            np.multiply(delta, 1.0 / count, out=temp)
+            self._mean += temp
+            np.multiply(delta, delta, out=temp)
+            temp *= (count - 1.0) / count
+            self._m2 += temp
+
+            if self.reference_interval and count % self.reference_interval == 0:
+                self._reference = (self._reference[0] + 1, self._mean.copy())
+            self._timings["accumulate"] += time.perf_counter() - start
+
+    def join(self):
+        """Wait until all added frames are accumulated."""
+        self._pipeline.join()
+
+    def close(self):
+        """Wait until all added frames are accumulated and stop the worker threads."""
+        self._pipeline.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def count(self):
+        """Number of accumulated frames."""
+        with self._lock:
+            return self._count
+
+    def result(self):
+        """
+        Wait until all added frames are accumulated and return dict with the keys:
+
+            * "mean": Mean of the aligned frames (float64 array)
+            * "sum": Sum of the aligned frames (float64 array)
+            * "variance": Sample variance of each pixel (float64 array, zero for less than 2 frames)
+            * "count": Number of accumulated frames
+            * "rejected": Number of rejected frames
+            * "shifts": List of (index, x, y, peak, accepted) tuples of all frames sorted by index
+            * "align(s)": Total time of the alignment (in worker threads)
+            * "accumulate(s)": Total time of the accumulation
+
+        The arrays are copies, more frames can be added afterwards.
+        """
+        self.join()
+        with self._lock:
+            if self._mean is None:
+                raise ValueError("No frames added.")
+            count = self._count
+            return {
+                "mean": self._mean.copy(),
+                "sum": self._mean * count,
+                "variance": self._m2 / (count - 1) if count > 1 else np.zeros_like(self._m2),
+                "count": count,
+                "rejected": self._rejected,
+                "shifts": sorted(self._shifts),
+                "align(s)": self._timings["align"],
+                "accumulate(s)": self._timings["accumulate"]
+            }
@@ -1,3 +1,4 @@
+import threading
 from abc import ABC, abstractmethod
 
 
@@ -70,6 +71,121 @@ def set_enum_attr_from_dict(obj, attr_name, enum_type, mapping, key, ignore_erro
 # Allowed stage axes
 STAGE_AXES = frozenset(('x', 'y', 'z', 'a', 'b'))
 
+# Fields returned by BaseMicroscope.get_state() and the methods to read them
+STATE_FIELDS = {
+    "family": "get_family",
+    "microscope_id": "get_microscope_id",
+    "temscript_version": "get_version",
+    "voltage(kV)": "get_voltage",
+    "stage_holder": "get_stage_holder",
+    "stage_position": "get_stage_position",
+    "image_shift": "get_image_shift",
+    "beam_shift": "get_beam_shift",
+    "beam_tilt": "get_beam_tilt",
+    "projection_sub_mode": "get_projection_sub_mode",
+    "projection_mode": "get_projection_mode",
+    "projection_mode_string": "get_projection_mode_string",
+    "magnification_index": "get_magnification_index",
+    "indicated_camera_length": "get_indicated_camera_length",
+    "indicated_magnification": "get_indicated_magnification",
+    "defocus": "get_defocus",
+    "objective_excitation": "get_objective_excitation",
+    "intensity": "get_intensity",
+    "condenser_stigmator": "get_condenser_stigmator",
+    "objective_stigmator": "get_objective_stigmator",
+    "diffraction_shift": "get_diffraction_shift",
+    "screen_current": "get_screen_current",
+    "screen_position": "get_screen_position",
+    "spot_size_index": "get_spot_size_index",
+    "illumination_mode": "get_illumination_mode",
+    "beam_blanked": "get_beam_blanked",
+    "stem_available": "is_stem_available",
+    "instrument_mode": "get_instrument_mode",
+    "condenser_mode": "get_condenser_mode",
+    "illuminated_area": "get_illuminated_area",
+    "convergence_angle": "get_convergence_angle",
+    "probe_defocus": "get_probe_defocus",
+    "stem_magnification": "get_stem_magnification",
+    "stem_rotation": "get_stem_rotation",
+}
+
+# State fields only available on TITAN microscopes
+TITAN_STATE_FIELDS = frozenset(("condenser_mode", "illuminated_area", "convergence_angle", "probe_defocus"))
+
+# State fields only available in STEM mode
+STEM_STATE_FIELDS = frozenset(("stem_magnification", "stem_rotation"))
+
+# Lock for lazy creation of the pollers of BaseMicroscope.subscribe()
+_POLLER_LOCK = threading.Lock()
+
+# State fields written by BaseMicroscope.set_state() and their setters, in the order they are written
+SETTABLE_STATE_FIELDS = (
+    ("instrument_mode", "set_instrument_mode"),
+    ("projection_mode", "set_projection_mode"),
+    ("illumination_mode", "set_illumination_mode"),
+    ("condenser_mode", "set_condenser_mode"),
+    ("spot_size_index", "set_spot_size_index"),
+    ("magnification_index", "set_magnification_index"),
+    ("intensity", "set_intensity"),
+    ("illuminated_area", "set_illuminated_area"),
+    ("convergence_angle", "set_convergence_angle"),
+    ("probe_defocus", "set_probe_defocus"),
+    ("stem_magnification", "set_stem_magnification"),
+    ("stem_rotation", "set_stem_rotation"),
+    ("defocus", "set_defocus"),
+    ("condenser_stigmator", "set_condenser_stigmator"),
+    ("objective_stigmator", "set_objective_stigmator"),
+    ("beam_tilt", "set_beam_tilt"),
+    ("beam_shift", "set_beam_shift"),
+    ("image_shift", "set_image_shift"),
+    ("diffraction_shift", "set_diffraction_shift"),
+    ("screen_position", "set_screen_position"),
+    ("beam_blanked", "set_beam_blanked"),
+    ("stage_position", "set_stage_position"),
+)
+
+# Writing the key field invalidates the current value of the fields in the value (they are always written afterwards)
+STATE_FIELD_DEPENDENCIES = {
+    "instrument_mode": frozenset(field for field, setter in SETTABLE_STATE_FIELDS if field != "instrument_mode"),
+    "projection_mode": frozenset(("magnification_index",)),
+    "illumination_mode": frozenset(("spot_size_index", "intensity", "illuminated_area", "convergence_angle",
+                                    "probe_defocus", "beam_shift")),
+    "condenser_mode": frozenset(("intensity", "illuminated_area", "convergence_angle", "probe_defocus")),
+}
+
+
+def _restrict_keys(value, reference):
+    """If both are dicts, return *value* restricted to the keys in *reference* (e.g. for partial stage positions)."""
+    if isinstance(value, dict) and isinstance(reference, dict) and set(reference.keys()) <= set(value.keys()):
+        return {key: value[key] for key in reference.keys()}
+    return value
+
+
+def _state_values_equal(a, b, rel_tol=1e-9, abs_tol=1e-15):
+    """
+    Compare two state values. Sequences and dicts are compared elementwise, numbers with tolerance.
+    """
+    if isinstance(a, dict) or isinstance(b, dict):
+        if not isinstance(a, dict) or not isinstance(b, dict) or set(a.keys()) != set(b.keys()):
+            return False
+        return all(_state_values_equal(a[key], b[key], rel_tol, abs_tol) for key in a.keys())
+    if isinstance(a, (str, bytes)) or isinstance(b, (str, bytes)):
+        return a == b
+    if hasattr(a, "__len__") or hasattr(b, "__len__"):
+        try:
+            if len(a) != len(b):
+                return False
+        except TypeError:
+            return False
+        return all(_state_values_equal(x, y, rel_tol, abs_tol) for x, y in zip(a, b))
+    if isinstance(a, bool) or isinstance(b, bool):
+        return a == b
+    try:
+        a, b = float(a), float(b)
+    except (TypeError, ValueError):
+        return a == b
+    return abs(a - b) <= max(rel_tol * max(abs(a), abs(b)), abs_tol)
+
 
 class BaseMicroscope(ABC):
     """
@@ -184,7 +300,7 @@ class BaseMicroscope(ABC):
     def _set_stage_position(self, pos=None, method="GO", speed=None):
         raise NotImplementedError
 
-    def set_stage_position(self, pos=None, method=None, speed=None, **kw):
+    def set_stage_position(self, pos=None, method=None, speed=None, wait=True, **kw):
         """
         Set new stage position.
 
@@ -204,9 +320,17 @@ class BaseMicroscope(ABC):
             * "MOVE": Avoids pole piece touches, by first zeroing the
               angle, moving the stage than, and setting the angles again.
 
+        If *wait* is false, the method returns without waiting for the stage to arrive, and returns a
+        :class:`StageMoveHandle` instead. The handle can be polled, waited for, or awaited. Implementations, which
+        can't move the stage in the background (like the local :class:`Microscope`, unless wrapped by a
+        :class:`MicroscopeExecutor`), finish the movement before returning the handle.
+
         .. versionchanged:: 1.0.10
             "speed" keyword added.
 
+        .. versionchanged:: 2.2.0
+            "wait" keyword added.
+
         .. deprecated::
             In versions < 2.0.0 the "speed" and "method" keywords could also be passed within the `pos` dictionary.
             This is usage is deprecated since 2.0.0, use the `speed` and `method` keywords instead.
@@ -230,8 +354,24 @@ class BaseMicroscope(ABC):
                 method = pos.pop('method')
         if method is None:
             method = "GO"
+        if not wait:
+            return self._start_stage_move(pos, method=method, speed=speed)
         self._set_stage_position(pos, method=method, speed=speed)
 
+    def _start_stage_move(self, pos=None, method="GO", speed=None):
+        """
+        Start stage movement and return :class:`StageMoveHandle` (see :meth:`set_stage_position`).
+
+        The default implementation moves the stage by :meth:`_set_stage_position` and returns a finished handle.
+        Subclasses override this method to move the stage in the background.
+        """
+        from .stage_move import StageMoveHandle
+        try:
+            self._set_stage_position(pos, method=method, speed=speed)
+        except Exception as exc:
+            return StageMoveHandle.completed(exc)
+        return StageMoveHandle.completed()
+
     @abstractmethod
     def get_cameras(self):
         """
@@ -1123,54 +1263,224 @@ class BaseMicroscope(ABC):
         """
         raise NotImplementedError
 
-    def get_state(self):
+    def get_state(self, fields=None):
         """
         Return a dictionary with state of the microscope.
 
+        The keys of the dictionary are the names of the fields (see :data:`STATE_FIELDS` for all fields and the
+        methods used to read them). The fields in :data:`TITAN_STATE_FIELDS` are only present on microscopes of
+        the ``TITAN`` family, the fields in :data:`STEM_STATE_FIELDS` only in STEM mode.
+
+        If *fields* is given, only the selected fields are read. Each value is read only once per call.
+        Subclasses, which are able to read several values concurrently, might do so.
+
+        :param fields: Names of fields to return. By default, all fields are returned.
+        :type fields: Optional[Iterable[str]]
+        :raises KeyError: If an unknown field is requested
+
         .. versionadded:: 1.0.9
 
         .. versionchanged:: 2.0
             The method was renamed from get_optics_state() to get_state()
-        """
-        state = {
-            "family": self.get_family(),
-            "microscope_id": self.get_microscope_id(),
-            "temscript_version": self.get_version(),
-            "voltage(kV)": self.get_voltage(),
-            "stage_holder": self.get_stage_holder(),
-            "stage_position": self.get_stage_position(),
-            "image_shift": self.get_image_shift(),
-            "beam_shift": self.get_beam_shift(),
-            "beam_tilt": self.get_beam_tilt(),
-            "projection_sub_mode": self.get_projection_sub_mode(),
-            "projection_mode": self.get_projection_mode(),
-            "projection_mode_string": self.get_projection_mode_string(),
-            "magnification_index": self.get_magnification_index(),
-            "indicated_camera_length": self.get_indicated_camera_length(),
-            "indicated_magnification": self.get_indicated_magnification(),
-            "defocus": self.get_defocus(),
-            "objective_excitation": self.get_objective_excitation(),
-            "intensity": self.get_intensity(),
-            "condenser_stigmator": self.get_condenser_stigmator(),
-            "objective_stigmator": self.get_objective_stigmator(),
-            "diffraction_shift": self.get_diffraction_shift(),
-            "screen_current": self.get_screen_current(),
-            "screen_position": self.get_screen_position(),
-            "spot_size_index": self.get_spot_size_index(),
-            "illumination_mode": self.get_illumination_mode(),
-            "beam_blanked": self.get_beam_blanked(),
-            "stem_available": self.is_stem_available(),
-            "instrument_mode": self.get_instrument_mode(),
+
+        .. versionchanged:: 2.2.0
+            *fields* keyword added.
+        """
+        if fields is None:
+            fields = list(STATE_FIELDS.keys())
+        else:
+            fields = list(fields)
+            for field in fields:
+                if field not in STATE_FIELDS:
+                    raise KeyError("Unknown state field: '%s'" % (field,))
+
+        # Read fields deciding about availability of other fields first
+        conditions = set()
+        if "family" in fields or any(field in TITAN_STATE_FIELDS for field in fields):
+            conditions.add("family")
+        if "instrument_mode" in fields or any(field in STEM_STATE_FIELDS for field in fields):
+            conditions.add("instrument_mode")
+        values = self._read_state_fields(sorted(conditions)) if conditions else {}
+
+        if values.get("family") != "TITAN":
+            fields = [field for field in fields if field not in TITAN_STATE_FIELDS]
+        if values.get("instrument_mode") != "STEM":
+            fields = [field for field in fields if field not in STEM_STATE_FIELDS]
+        remaining = [field for field in fields if field not in values]
+        if remaining:
+            values.update(self._read_state_fields(remaining))
+        # Implementations of _read_state_fields may leave out unavailable fields
+        return {field: values[field] for field in fields if field in values}
+
+    def _read_state_fields(self, fields):
+        """
+        Read the values of the state *fields* (see :data:`STATE_FIELDS`) and return them as dict.
+
+        The default implementation reads the values one after another. Subclasses might override this method to
+        read the values concurrently.
+        """
+        return {field: getattr(self, STATE_FIELDS[field])() for field in fields}
+
+    def subscribe(self, fields, callback, min_interval=0.1, max_interval=2.0, error_callback=None):
+        """
+        Subscribe to changes of state fields.
+
+        The fields are polled by a background thread shared by all subscriptions of this microscope. Each poll reads
+        the union of the fields of all due subscriptions with a single :meth:`get_state` call. The polling interval of
+        a subscription starts at *min_interval*. While the values are stable, the interval is doubled after each
+        poll, up to *max_interval*. When a value changes, the interval is reset to *min_interval*.
+
+        The *callback* is called with a dict of the changed fields and their new values. The first call contains the
+        initial values of all (available) fields. Callbacks are called from the poller thread, thus they should
+        return quickly. If reading fails, *error_callback* is called with the exception (by default a warning is
+        issued).
+
+        The microscope is read from the poller thread, thus it must be usable from several threads. Wrap the local
+        :class:`Microscope` in a :class:`MicroscopeExecutor` to use subscriptions.
+
+        :param fields: Names of the fields (see :data:`STATE_FIELDS`). Additionally, all values with a getter without
+            arguments can be used, e.g. "stage_status" for :meth:`get_stage_status`.
+        :type fields: Union[str, Iterable[str]]
+        :param callback: Called with dict of changed fields
+        :param min_interval: Minimum polling interval in seconds
+        :type min_interval: float
+        :param max_interval: Maximum polling interval in seconds
+        :type max_interval: float
+        :param error_callback: Called with exception if polling fails
+        :returns: :class:`Subscription` instance, call its :meth:`Subscription.cancel` method to end the subscription.
+        :raises KeyError: If an unknown field is given
+
+        Usage:
+
+            >>> def on_change(changed):
+            ...     print(changed)
+            >>> subscription = microscope.subscribe(["stage_status", "stage_position"], on_change)
+            >>> ...
+            >>> subscription.cancel()
+
+        .. versionadded:: 2.2.0
+        """
+        from .polling import StatePoller
+        with _POLLER_LOCK:
+            poller = self.__dict__.get("_state_poller")
+            if poller is None:
+                poller = self._state_poller = StatePoller(self)
+        return poller.add(fields, callback, min_interval=min_interval, max_interval=max_interval,
+                          error_callback=error_callback)
+
+    def wait_for(self, getter, predicate, timeout=10.0, poll_policy=None):
+        """
+        Wait until the value returned by a getter satisfies a predicate.
+
+        The *predicate* is either a callable, which is called with the value, or a serializable predicate from
+        :mod:`temscript.polling` (:class:`~temscript.polling.Equals`, :class:`~temscript.polling.InRange`,
+        :class:`~temscript.polling.OneOf`), or any other value, which the returned value must be equal to. Serializable
+        predicates are evaluated next to the microscope by the :class:`RemoteMicroscope` (the server holds the
+        request until the condition is met).
+
+        :param getter: Name of the getter, with or without "get\_" prefix, e.g. "screen_position"
+        :type getter: str
+        :param predicate: Predicate or value
+        :param timeout: Maximum time to wait in seconds, `None` waits forever.
+        :type timeout: Optional[float]
+        :param poll_policy: Polling intervals, defaults to ``PollPolicy()``
+        :type poll_policy: Optional[PollPolicy]
+        :returns: The value satisfying the predicate
+        :raises TimeoutError: If the condition wasn't met within *timeout*
+
+        Usage:
+
+            >>> microscope.wait_for("screen_position", "UP")
+            >>> microscope.wait_for("vacuum", Equals("READY", key="status"), timeout=60.0)
+
+        .. versionadded:: 2.2.0
+        """
+        import time
+        from .polling import PollPolicy, make_predicate, getter_name
+        predicate = make_predicate(predicate)
+        method = getattr(self, getter_name(getter))
+        if poll_policy is None:
+            poll_policy = PollPolicy()
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        for interval in poll_policy.intervals():
+            value = method()
+            if predicate(value):
+                return value
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0.0:
+                    raise TimeoutError("Timeout while waiting for %s (last value: %r)" % (getter, value))
+                interval = min(interval, remaining)
+            time.sleep(interval)
+
+    def set_state(self, state, move_stage=False):
+        """
+        Apply a state as returned by :meth:`get_state` with as few writes as possible.
+
+        The *state* is compared against the current state of the microscope, only the fields which differ are
+        written. The fields are written in the order of their dependencies, e.g. the projection mode before the
+        magnification index, or the illumination mode before the intensity (see :data:`SETTABLE_STATE_FIELDS`). If a
+        field is written, the fields depending on it are always written afterwards
+        (see :data:`STATE_FIELD_DEPENDENCIES`).
+
+        Read-only fields (like "family" or "voltage(kV)") and fields not available on the microscope are ignored.
+        The stage is only moved if *move_stage* is set.
+
+        :param state: State to apply
+        :type state: dict
+        :param move_stage: Whether the "stage_position" field is applied.
+        :type move_stage: bool
+        :returns: Dict with report of the changes with the following keys:
+
+            * "changed": Dict of the written fields with (previous value, new value) tuples as values
+            * "unchanged": List of fields, which already had the requested value
+            * "ignored": List of fields, which were not written since they are read-only or not available
+
+        .. versionadded:: 2.2.0
+        """
+        state = dict(state)
+        settable = dict(SETTABLE_STATE_FIELDS)
+        if not move_stage:
+            del settable["stage_position"]
+        requested = [field for field in state.keys() if field in settable]
+        ignored = [field for field in state.keys() if field not in settable]
+        current = self.get_state(fields=requested)
+
+        changed = {}
+        unchanged = []
+        forced = set()
+        order = [field for field, setter in SETTABLE_STATE_FIELDS if field in state and field in settable]
+        if state.get("beam_blanked") and "beam_blanked" in order:
+            # Blank beam before anything else is changed
+            order.remove("beam_blanked")
+            order.insert(0, "beam_blanked")
+        for field in order:
+            value = state[field]
+            if field in STEM_STATE_FIELDS and state.get("instrument_mode", "STEM") != "STEM":
+                # Not available in target instrument mode
+                ignored.append(field)
+                continue
+            if field not in current:
+                # Unavailable fields only become available if instrument mode changes to STEM
+                if not ("instrument_mode" in changed and value is not None):
+                    ignored.append(field)
+                    continue
+            elif field not in forced and _state_values_equal(_restrict_keys(current[field], value), value):
+                unchanged.append(field)
+                continue
+            self._write_state_field(field, value)
+            changed[field] = (current.get(field), value)
+            forced.update(STATE_FIELD_DEPENDENCIES.get(field, ()))
+
+        return {
+            "changed": changed,
+            "unchanged": unchanged,
+            "ignored": ignored
         }
-        if self.get_family() == "TITAN":
-            state["condenser_mode"] = self.get_condenser_mode()
-            state["illuminated_area"] = self.get_illuminated_area()
-            state["convergence_angle"] = self.get_convergence_angle()
-            state["probe_defocus"] = self.get_probe_defocus()
-        if self.get_instrument_mode() == "STEM":
-            state["stem_magnification"] = self.get_stem_magnification()
-            state["stem_rotation"] = self.get_stem_rotation()
-        return state
+
+    def _write_state_field(self, field, value):
+        """Write *value* of state *field* (see :data:`SETTABLE_STATE_FIELDS`)."""
+        getattr(self, dict(SETTABLE_STATE_FIELDS)[field])(value)
 
     def get_optics_state(self):
         """
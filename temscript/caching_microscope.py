@@ -0,0 +1,332 @@
+import copy
+import threading
+import time
+
+from .base_microscope import BaseMicroscope, STATE_FIELDS
+from .forwarding_microscope import ForwardingMicroscope, _freeze
+
+
+class CachePolicy:
+    """
+    Caching policy of a getter of the :class:`CachingMicroscope`.
+
+    A cached value is dropped, if it is older than *ttl* seconds (if *ttl* is not `None`), or if a setter invalidating
+    the getter is called. Getters of *static* policies are never invalidated.
+
+    Use the predefined policies :data:`STATIC` and :data:`INVALIDATE_ON_WRITE`, or :func:`ttl` to create a policy.
+
+    :param ttl: Maximum age of a cached value in seconds, or `None`
+    :type ttl: Optional[float]
+    :param static: Whether the value never changes
+    :type static: bool
+
+    .. versionadded:: 2.2.0
+    """
+    def __init__(self, ttl=None, static=False):
+        self.ttl = float(ttl) if ttl is not None else None
+        self.static = bool(static)
+
+    def __repr__(self):
+        if self.static:
+            return "STATIC"
+        elif self.ttl is None:
+            return "INVALIDATE_ON_WRITE"
+        return "ttl(%r)" % self.ttl
+
+
+# Value never changes, it is read once
+STATIC = CachePolicy(static=True)
+
+# Value is cached until the getter is invalidated by a (related) setter
+INVALIDATE_ON_WRITE = CachePolicy()
+
+
+def ttl(seconds):
+    """
+    Return policy for values cached at most *seconds*, the values are also invalidated by (related) setters.
+
+    .. versionadded:: 2.2.0
+    """
+    return CachePolicy(ttl=seconds)
+
+
+def _derive_write_pairs():
+    """Return dict of all setters of :class:`BaseMicroscope` with a matching getter, mapped to that getter."""
+    pairs = {}
+    for name in dir(BaseMicroscope):
+        if name.startswith("set_") and hasattr(BaseMicroscope, "get_" + name[4:]):
+            pairs[name] = frozenset(("get_" + name[4:],))
+    pairs["_set_stage_position"] = frozenset(("get_stage_position", "get_stage_status"))
+    return pairs
+
+
+# Getters invalidated by setters in addition to their own getter (see set/get pairs of BaseMicroscope). A value of
+# `None` invalidates all non-static getters.
+RELATED_WRITES = {
+    "set_instrument_mode": None,
+    "normalize": None,
+    "set_state": None,
+    "set_column_valves_open": frozenset(("get_vacuum", "get_screen_current")),
+    "_set_stage_position": frozenset(("get_image_shift",)),
+    "set_stem_acquisition_param": frozenset(("get_detector_param",)),
+    "set_camera_param": frozenset(("get_detector_param",)),
+    "set_stem_detector_param": frozenset(("get_detector_param",)),
+    "set_detector_param": frozenset(("get_camera_param", "get_stem_detector_param", "get_stem_acquisition_param")),
+    "set_projection_mode": frozenset(("get_magnification_index", "get_projection_sub_mode",
+                                      "get_projection_mode_string", "get_indicated_magnification",
+                                      "get_indicated_camera_length", "get_objective_excitation")),
+    "set_magnification_index": frozenset(("get_projection_sub_mode", "get_projection_mode_string",
+                                          "get_indicated_magnification", "get_indicated_camera_length",
+                                          "get_objective_excitation", "get_screen_current")),
+    "set_defocus": frozenset(("get_objective_excitation",)),
+    "set_illumination_mode": frozenset(("get_spot_size_index", "get_intensity", "get_illuminated_area",
+                                        "get_convergence_angle", "get_probe_defocus", "get_beam_shift",
+                                        "get_screen_current")),
+    "set_condenser_mode": frozenset(("get_intensity", "get_illuminated_area", "get_convergence_angle",
+                                     "get_probe_defocus", "get_screen_current")),
+    "set_spot_size_index": frozenset(("get_screen_current",)),
+    "set_intensity": frozenset(("get_illuminated_area", "get_convergence_angle", "get_screen_current")),
+    "set_illuminated_area": frozenset(("get_intensity", "get_convergence_angle", "get_screen_current")),
+    "set_convergence_angle": frozenset(("get_intensity", "get_illuminated_area", "get_screen_current")),
+    "set_beam_tilt": frozenset(("get_dark_field_mode",)),
+    "set_dark_field_mode": frozenset(("get_beam_tilt",)),
+    "set_beam_blanked": frozenset(("get_screen_current",)),
+    "set_screen_position": frozenset(("get_screen_current",)),
+}
+
+# Default caching policies by getter name. Getters not listed are not cached.
+DEFAULT_POLICIES = {
+    "get_family": STATIC,
+    "get_microscope_id": STATIC,
+    "get_version": STATIC,
+    "get_cameras": STATIC,
+    "get_stem_detectors": STATIC,
+    "is_stem_available": STATIC,
+    "get_voltage": ttl(1.0),
+    "get_vacuum": ttl(0.5),
+    "get_column_valves_open": ttl(0.5),
+    "get_stage_holder": ttl(1.0),
+    "get_stage_limits": ttl(1.0),
+    "get_stage_status": ttl(0.1),
+    "get_stage_position": ttl(0.1),
+    "get_screen_current": ttl(0.1),
+    "get_camera_param": INVALIDATE_ON_WRITE,
+    "get_stem_detector_param": INVALIDATE_ON_WRITE,
+    "get_stem_acquisition_param": INVALIDATE_ON_WRITE,
+    "get_projection_sub_mode": INVALIDATE_ON_WRITE,
+    "get_projection_mode_string": INVALIDATE_ON_WRITE,
+    "get_indicated_camera_length": INVALIDATE_ON_WRITE,
+    "get_indicated_magnification": INVALIDATE_ON_WRITE,
+    "get_objective_excitation": INVALIDATE_ON_WRITE,
+}
+DEFAULT_POLICIES.update((getter, INVALIDATE_ON_WRITE) for getters in _derive_write_pairs().values()
+                        for getter in getters if getter not in DEFAULT_POLICIES)
+
+# Calls, which neither are cached nor invalidate anything
+_PASS_THROUGH = frozenset(("acquire", "get_detectors", "get_detector_param", "get_optics_state"))
+
+
+class CachingMicroscope(ForwardingMicroscope):
+    """
+    Microscope-like class, which caches the values read from another microscope.
+
+    Each getter has a caching policy (see :class:`CachePolicy`):
+
+        * :data:`STATIC`: The value is read once (e.g. "get_family").
+        * :data:`INVALIDATE_ON_WRITE`: The value is cached until the corresponding setter (e.g. "set_defocus" for
+          "get_defocus") or a related setter is called (see below).
+        * ``ttl(seconds)``: Like :data:`INVALIDATE_ON_WRITE`, additionally the value is read again after *seconds*.
+          Used for values, which change on their own, like the vacuum or the stage position.
+
+    Setters and getters are paired by name. Since some setters change the values of other getters, e.g.
+    "set_projection_mode" changes the magnification index, each setter also invalidates the getters listed in
+    :data:`RELATED_WRITES`. Unknown calls, :meth:`set_state`, :meth:`normalize` and "set_instrument_mode" invalidate
+    all non-static values. Getters without policy and :meth:`acquire` are passed through. Arguments are part of the
+    cache key, i.e. "get_camera_param" caches the parameters of each camera separately.
+
+    Changes done at the microscope itself (e.g. turning the focus knob) are not noticed until the value expires. Add a
+    *ttl* to the policies of these values if required. :meth:`get_state` serves cached fields from the cache and
+    reads the remaining fields from the backend in a single call.
+
+    The class is thread-safe, values are not cached, if they were invalidated while being read.
+
+    :param backend: Microscope to cache
+    :type backend: BaseMicroscope
+    :param policies: Policies by getter name, which replace the defaults of :data:`DEFAULT_POLICIES`. A value of `None`
+        disables caching for a getter.
+    :type policies: Optional[Dict[str, Optional[CachePolicy]]]
+    :param related_writes: Additional getters invalidated by setters. Merged into the defaults of
+        :data:`RELATED_WRITES`.
+    :type related_writes: Optional[Dict[str, Iterable[str]]]
+
+    Usage:
+
+        >>> microscope = CachingMicroscope(RemoteMicroscope(("tem", 8080)), policies={"get_defocus": ttl(0.5)})
+        >>> for n in range(1000):
+        ...     microscope.get_magnification_index()   # Only the first call is sent to the microscope
+        >>> microscope.statistics()["hit_rate"]
+
+    .. versionadded:: 2.2.0
+    """
+    def __init__(self, backend, policies=None, related_writes=None):
+        super(CachingMicroscope, self).__init__(backend)
+        self._policies = dict(DEFAULT_POLICIES)
+        if policies:
+            self._policies.update(policies)
+        self._invalidates = _derive_write_pairs()
+        for setter, getters in RELATED_WRITES.items():
+            if getters is None:
+                self._invalidates[setter] = None
+            else:
+                self._invalidates[setter] = self._invalidates.get(setter, frozenset()) | getters
+        for setter, getters in (related_writes or {}).items():
+            current = self._invalidates.get(setter, frozenset())
+            if current is not None:
+                self._invalidates[setter] = current | frozenset(getters)
+        self._lock = threading.Lock()
+        self._cache = {}            # (method, args, kw) -> (value, timestamp)
+        self._generation = 0        # Incremented on each invalidation
+        self._stats = {}            # method -> [hits, misses]
+        self._expired = 0
+        self._invalidations = 0
+
+    def get_policy(self, method_name):
+        """Return caching policy of getter *method_name* (`None` if not cached)."""
+        return self._policies.get(method_name)
+
+    def invalidate(self, method_names=None):
+        """
+        Drop cached values of the getters *method_names*. If `None`, all cached values except static ones are dropped.
+
+        :param method_names: Names of getters
+        :type method_names: Optional[Iterable[str]]
+        """
+        with self._lock:
+            self._invalidate_locked(method_names)
+
+    def _invalidate_locked(self, method_names):
+        self._generation += 1
+        if method_names is not None:
+            method_names = frozenset(method_names)
+        for key in list(self._cache.keys()):
+            policy = self._policies.get(key[0])
+            if policy is not None and policy.static:
+                continue
+            if method_names is None or key[0] in method_names:
+                del self._cache[key]
+                self._invalidations += 1
+
+    def clear(self):
+        """Drop all cached values (including static ones) and reset statistics."""
+        with self._lock:
+            self._generation += 1
+            self._cache.clear()
+            self._stats.clear()
+            self._expired = self._invalidations = 0
+
+    def statistics(self):
+        """
+        Return dict with statistics of the cache:
+
+            * "hits": Number of calls served from the cache
+            * "misses": Number of calls of cached getters forwarded to the backend
+            * "expired": Number of misses caused by expired values
+            * "invalidations": Number of cached values dropped by setters
+            * "hit_rate": Fraction of calls of cached getters served from the cache
+            * "entries": Number of cached values
+            * "methods": Dict with [hits, misses] lists by getter name
+        """
+        with self._lock:
+            hits = sum(counts[0] for counts in self._stats.values())
+            misses = sum(counts[1] for counts in self._stats.values())
+            return {
+                "hits": hits,
+                "misses": misses,
+                "expired": self._expired,
+                "invalidations": self._invalidations,
+                "hit_rate": float(hits) / (hits + misses) if hits + misses else 0.0,
+                "entries": len(self._cache),
+                "methods": {name: list(counts) for name, counts in self._stats.items()}
+            }
+
+    def _lookup(self, key, policy):
+        """Return (True, value) if *key* is cached and not expired, (False, generation) otherwise."""
+        with self._lock:
+            entry = self._cache.get(key)
+            counts = self._stats.setdefault(key[0], [0, 0])
+            if entry is not None:
+                if policy.ttl is None or time.monotonic() - entry[1] <= policy.ttl:
+                    counts[0] += 1
+                    return True, entry[0]
+                del self._cache[key]
+                self._expired += 1
+            counts[1] += 1
+            return False, self._generation
+
+    def _store(self, key, value, generation):
+        """Store *value*, unless values were invalidated since *generation*."""
+        with self._lock:
+            if generation == self._generation:
+                self._cache[key] = (value, time.monotonic())
+
+    def _forward(self, method_name, *args, **kw):
+        policy = self._policies.get(method_name)
+        if policy is not None:
+            key = (method_name, _freeze(args), _freeze(kw))
+            found, result = self._lookup(key, policy)
+            if found:
+                return _copy(result)
+            value = super(CachingMicroscope, self)._forward(method_name, *args, **kw)
+            self._store(key, value, result)
+            return _copy(value)
+        elif method_name in _PASS_THROUGH or method_name.startswith("get_") or method_name.startswith("is_"):
+            return super(CachingMicroscope, self)._forward(method_name, *args, **kw)
+
+        # Everything else is a write
+        invalidated = self._invalidates.get(method_name)
+        try:
+            return super(CachingMicroscope, self)._forward(method_name, *args, **kw)
+        finally:
+            self.invalidate(invalidated)
+
+    def get_state(self, fields=None):
+        return BaseMicroscope.get_state(self, fields=fields)
+
+    def _read_state_fields(self, fields):
+        result = {}
+        missing = []
+        for field in fields:
+            method_name = STATE_FIELDS[field]
+            policy = self._policies.get(method_name)
+            if policy is not None:
+                found, value = self._lookup((method_name, (), ()), policy)
+                if found:
+                    result[field] = _copy(value)
+                    continue
+            missing.append(field)
+        if missing:
+            with self._lock:
+                generation = self._generation
+            values = self._backend.get_state(fields=missing)
+            for field in missing:
+                method_name = STATE_FIELDS[field]
+                if field in values and self._policies.get(method_name) is not None:
+                    self._store((method_name, (), ()), values[field], generation)
+            omitted = False
+            for field in missing:
+                if field in values:
+                    result[field] = values[field]
+                else:
+                    omitted = True
+            if omitted:
+                # Backend considers fields unavailable, the cached family or instrument mode is stale. The fields are
+                # left out like BaseMicroscope.get_state does, the next call reads the mode again.
+                self.invalidate([STATE_FIELDS["family"], STATE_FIELDS["instrument_mode"]])
+        return result
+
+
+def _copy(value):
+    """Copy mutable values, thus the cached values can't be changed by the caller."""
+    if isinstance(value, (dict, list)):
+        return copy.deepcopy(value)
+    return value
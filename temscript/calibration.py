@@ -0,0 +1,182 @@
+import json
+import os
+import threading
+
+import numpy as np
+
+from .correlation import phase_correlation
+
+
+class ImageShiftCalibration:
+    """
+    Cache of calibrations, which map the image shift (beam shift in STEM mode) to the shift of acquired images.
+
+    A calibration is a 2x2 matrix converting a change of the image shift (in meters) to the (x, y) shift of the
+    image of a detector (in pixels of the acquired, possibly binned image). Calibrations are measured once by
+    :meth:`measure` and cached by instrument mode, projection mode, magnification (index), detector, and binning.
+    If a *filename* is given, the calibrations are loaded from this JSON file and new calibrations are stored in it.
+
+    The measurement shifts the image in x and y direction and determines the image shifts by phase correlation.
+    Starting with *step*, the step size is adapted until the image shifts by about *target_fraction* of the image
+    size. The original image shift is restored afterwards.
+
+    :param filename: Optional name of JSON file to persist the calibrations
+    :type filename: Optional[str]
+    :param step: Initial step of the measurement in meters
+    :type step: float
+    :param target_fraction: Image shift during the measurement relative to the image size
+    :type target_fraction: float
+    :param min_peak: Minimum peak height of the phase correlation (see :func:`phase_correlation`)
+    :type min_peak: float
+
+    Usage:
+
+        >>> calibration = ImageShiftCalibration("image_shift.json")
+        >>> pixels = calibration.shift_to_pixels(microscope, "BM-Ceta", (1e-7, 0.0))
+        >>> shift = calibration.pixels_to_shift(microscope, "BM-Ceta", (100.0, 0.0))
+
+    .. versionadded:: 2.2.0
+    """
+    MAX_ATTEMPTS = 8
+
+    def __init__(self, filename=None, step=1e-8, target_fraction=0.125, min_peak=0.05):
+        self.filename = filename
+        self.step = float(step)
+        self.target_fraction = float(target_fraction)
+        self.min_peak = float(min_peak)
+        self._lock = threading.Lock()
+        self._entries = {}
+        if filename is not None and os.path.exists(filename):
+            self.load(filename)
+
+    @staticmethod
+    def deflector(microscope):
+        """Return name of deflector used for shifting the image: "image_shift" or "beam_shift" (in STEM mode)."""
+        return "beam_shift" if microscope.get_instrument_mode() == "STEM" else "image_shift"
+
+    @staticmethod
+    def key(microscope, detector):
+        """Return key of the calibration for the current state of *microscope* and *detector*."""
+        if microscope.get_instrument_mode() == "STEM":
+            param = microscope.get_stem_acquisition_param()
+            return "STEM/%g/%s/%s/%d" % (microscope.get_stem_magnification(), detector, param["image_size"],
+                                         param["binning"])
+        param = microscope.get_camera_param(detector)
+        return "TEM/%s/%d/%s/%d" % (microscope.get_projection_mode(), microscope.get_magnification_index(), detector,
+                                    param["binning"])
+
+    def get(self, microscope, detector, refresh=False):
+        """
+        Return calibration matrix for the current state. Missing calibrations are measured.
+
+        :param microscope: Microscope
+        :type microscope: BaseMicroscope
+        :param detector: Name of detector
+        :type detector: str
+        :param refresh: Whether the calibration is measured again
+        :type refresh: bool
+        :returns: 2x2 array converting image shift in meters to (x, y) pixels
+        :rtype: numpy.ndarray
+        """
+        return self._get_entry(microscope, detector, refresh)[0]
+
+    def image_shape(self, microscope, detector):
+        """Return (rows, columns) shape of the images of *detector* in the current state."""
+        return self._get_entry(microscope, detector, False)[1]
+
+    def _get_entry(self, microscope, detector, refresh):
+        key = self.key(microscope, detector)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or refresh:
+            matrix, shape = self.measure(microscope, detector)
+            entry = (matrix, shape)
+            with self._lock:
+                self._entries[key] = entry
+                if self.filename is not None:
+                    self._save(self.filename)
+        return entry
+
+    def shift_to_pixels(self, microscope, detector, shift):
+        """Convert change of image shift (in meters) to (x, y) image shift in pixels."""
+        return tuple(float(value) for value in self.get(microscope, detector).dot(np.asarray(shift, dtype=float)))
+
+    def pixels_to_shift(self, microscope, detector, pixels):
+        """Convert (x, y) image shift in pixels to change of image shift (in meters)."""
+        matrix = self.get(microscope, detector)
+        return tuple(float(value) for value in np.linalg.solve(matrix, np.asarray(pixels, dtype=float)))
+
+    def measure(self, microscope, detector):
+        """
+        Measure calibration for the current state, without caching it.
+
+        :returns: Tuple (matrix, image shape)
+        :raises RuntimeError: If the image shift couldn't be measured
+        """
+        deflector = self.deflector(microscope)
+        getter = getattr(microscope, "get_" + deflector)
+        setter = getattr(microscope, "set_" + deflector)
+        origin = np.array(getter(), dtype=float)
+        try:
+            reference = microscope.acquire(detector)[detector]
+            target = self.target_fraction * min(reference.shape)
+            step = self.step
+            for attempt in range(self.MAX_ATTEMPTS):
+                matrix = self._measure_matrix(microscope, detector, setter, origin, reference, step)
+                if matrix is None:
+                    # Shifted out of the image, decrease step
+                    step *= 0.1
+                    continue
+                pixels = np.abs(matrix).max() * step
+                if pixels < 1.0:
+                    step *= 10.0
+                    continue
+                if 0.5 * target <= pixels <= 2.0 * target:
+                    return matrix, reference.shape
+                step *= target / pixels
+            raise RuntimeError("Calibration of %s failed." % deflector)
+        finally:
+            setter(tuple(origin))
+
+    def _measure_matrix(self, microscope, detector, setter, origin, reference, step):
+        columns = []
+        for axis in range(2):
+            delta = np.zeros(2)
+            delta[axis] = step
+            setter(tuple(origin + delta))
+            image = microscope.acquire(detector)[detector]
+            shift, peak = phase_correlation(reference, image)
+            if peak < self.min_peak:
+                return None
+            columns.append(np.array(shift) / step)
+        return np.column_stack(columns)
+
+    def clear(self):
+        """Remove all calibrations."""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def save(self, filename=None):
+        """Save calibrations to JSON file *filename* (defaults to :attr:`filename`)."""
+        with self._lock:
+            self._save(filename if filename is not None else self.filename)
+
+    def _save(self, filename):
+        data = {key: {"matrix": matrix.tolist(), "shape": list(shape)}
+                for key, (matrix, shape) in self._entries.items()}
+        temp_name = filename + ".tmp"
+        with open(temp_name, "w") as fp:
+            json.dump(data, fp, indent=2, sort_keys=True)
+        os.replace(temp_name, filename)
+
+    def load(self, filename):
+        """Load calibrations from JSON file *filename*, replacing calibrations with the same key."""
+        with open(filename, "r") as fp:
+            data = json.load(fp)
+        with self._lock:
+            for key, value in data.items():
+                self._entries[key] = (np.array(value["matrix"], dtype=float), tuple(value["shape"]))
@@ -0,0 +1,308 @@
+import math
+
+import numpy as np
+
+
+def hann_window(shape, dtype=np.float32):
+    """
+    Return 2D Hann window of *shape*, used to suppress the edges of images before correlation.
+
+    .. versionadded:: 2.2.0
+    """
+    rows, cols = shape
+    wy = np.hanning(rows).astype(dtype) if rows > 1 else np.ones(1, dtype=dtype)
+    wx = np.hanning(cols).astype(dtype) if cols > 1 else np.ones(1, dtype=dtype)
+    return wy[:, np.newaxis] * wx[np.newaxis, :]
+
+
+def _prepare(image, window):
+    """Return float32 image with mean removed, multiplied by *window* (if not None)."""
+    image = np.asarray(image, dtype=np.float32)
+    image = image - image.mean()
+    if window is not None:
+        image *= window
+    return image
+
+
+def _parabolic_offset(minus, center, plus):
+    """Return subpixel offset of the maximum of a parabola through three points."""
+    denominator = minus - 2.0 * center + plus
+    if denominator >= 0.0:
+        return 0.0
+    return float(np.clip(0.5 * (minus - plus) / denominator, -0.5, 0.5))
+
+
+def _peak(correlation, subpixel=True):
+    """
+    Return ((x, y) shift, peak height) of the maximum of a (periodic) correlation map. If *subpixel* is true, the
+    position is refined by fitting parabolas to the neighbors of the maximum.
+    """
+    rows, cols = correlation.shape
+    iy, ix = np.unravel_index(int(np.argmax(correlation)), correlation.shape)
+    center = float(correlation[iy, ix])
+    dx = dy = 0.0
+    if subpixel:
+        dy = _parabolic_offset(float(correlation[(iy - 1) % rows, ix]), center,
+                               float(correlation[(iy + 1) % rows, ix]))
+        dx = _parabolic_offset(float(correlation[iy, (ix - 1) % cols]), center,
+                               float(correlation[iy, (ix + 1) % cols]))
+    # Wrap shifts to [-size/2, size/2)
+    y = (iy + rows // 2) % rows - rows // 2 + dy
+    x = (ix + cols // 2) % cols - cols // 2 + dx
+    return (float(x), float(y)), center
+
+
+def _frequencies(shape):
+    """Return frequencies (rows, columns) and column weights of spectra of *shape* computed by rfft2."""
+    rows, cols = shape
+    fy = np.fft.fftfreq(rows)
+    fx = np.fft.rfftfreq(cols)
+    weights = np.full(fx.shape, 2.0)       # Columns of the omitted half of the spectrum
+    weights[0] = 1.0
+    if cols % 2 == 0:
+        weights[-1] = 1.0
+    return fy, fx, weights
+
+
+def _upsampled_peak(cross, frequencies, x0, y0, upsample):
+    """
+    Return (x, y) position of the maximum of the correlation within one pixel of (*x0*, *y0*).
+
+    The correlation is evaluated on a grid upsampled by *upsample* by matrix multiplication DFT of the cross power
+    spectrum, which is much cheaper than an upsampled FFT. The position is refined by fitting parabolas.
+    """
+    fy, fx, weights = frequencies
+    offsets = np.arange(-upsample, upsample + 1) / float(upsample)
+    ys = y0 + offsets
+    xs = x0 + offsets
+    ey = np.exp(2j * np.pi * np.outer(ys, fy))
+    ex = np.exp(2j * np.pi * np.outer(fx, xs))
+    values = ey.dot(cross * weights).dot(ex).real
+    iy, ix = np.unravel_index(int(np.argmax(values)), values.shape)
+    y, x = ys[iy], xs[ix]
+    if 0 < iy < len(ys) - 1:
+        y += _parabolic_offset(values[iy - 1, ix], values[iy, ix], values[iy + 1, ix]) / upsample
+    if 0 < ix < len(xs) - 1:
+        x += _parabolic_offset(values[iy, ix - 1], values[iy, ix], values[iy, ix + 1]) / upsample
+    return float(x), float(y)
+
+
+def _cross_power(reference_fft, image_fft, out=None):
+    """Return normalized cross power spectrum of two spectra computed by rfft2."""
+    cross = np.multiply(image_fft, np.conj(reference_fft), out=out)
+    cross /= np.abs(cross) + 1e-12
+    return cross
+
+
+def phase_correlation(reference, image, window=True, upsample=10):
+    """
+    Return shift of *image* relative to *reference* by phase correlation.
+
+    The shift (x, y) is given in pixels, such that ``image[y, x]`` shows the feature of ``reference[y - dy, x - dx]``.
+    The shift is refined to subpixel precision by evaluating the correlation around the peak on a grid upsampled by
+    *upsample* (precision about 0.1 / *upsample* pixels). If *upsample* is 1, a parabola is fitted to the neighbors
+    of the correlation peak instead, which is faster but less precise.
+    Shifts are determined modulo the image size, i.e. they are within half the image size.
+
+    :param reference: Reference image
+    :type reference: numpy.ndarray
+    :param image: Image of same shape
+    :type image: numpy.ndarray
+    :param window: Whether the images are multiplied by a Hann window to suppress edge effects
+    :type window: bool
+    :param upsample: Upsampling factor of the subpixel refinement
+    :type upsample: int
+    :returns: Tuple ((x, y) shift, peak height). The peak height (1 for identical images, close to 0 for uncorrelated
+        images) is a measure of the reliability of the shift.
+
+    Usage:
+
+        >>> (dx, dy), peak = phase_correlation(reference, image)
+
+    .. versionadded:: 2.2.0
+    """
+    reference = np.asarray(reference)
+    image = np.asarray(image)
+    if reference.shape != image.shape or reference.ndim != 2:
+        raise ValueError("Images must be 2D arrays of same shape.")
+    win = hann_window(reference.shape) if window else None
+    reference_fft = np.fft.rfft2(_prepare(reference, win))
+    image_fft = np.fft.rfft2(_prepare(image, win))
+    cross = _cross_power(reference_fft, image_fft, out=image_fft)
+    upsample = int(upsample)
+    (x, y), peak = _peak(np.fft.irfft2(cross, s=reference.shape), subpixel=upsample <= 1)
+    if upsample > 1:
+        x, y = _upsampled_peak(cross, _frequencies(reference.shape), x, y, upsample)
+    return (x, y), peak
+
+
+class DriftTracker:
+    """
+    Measures the drift of frames relative to a reference frame by phase correlation.
+
+    The window and the FFT of the reference are computed once by :meth:`set_reference` and reused for every frame
+    passed to :meth:`measure`. Frames larger than *max_size* pixels are downsampled by averaging blocks of pixels
+    (the factor can be given by *downsample*), and the downsampled frames are stored in preallocated buffers. Thus
+    4k frames can be tracked at several frames per second. Frequencies of downsampled frames above
+    :attr:`LOWPASS` (in cycles per pixel) are ignored, since they are distorted by aliasing. The drift is refined
+    to subpixel precision as by :func:`phase_correlation`.
+
+    If *correct* is true, the measured drift is compensated by changing the image shift (beam shift in STEM mode)
+    of *microscope*. The image shift is converted to pixels of the *detector* by *calibration*
+    (see :class:`ImageShiftCalibration`, a new calibration is created if omitted). The correction is multiplied by
+    *gain*. Drifts with a correlation peak below *min_peak* are not corrected.
+
+    :param reference: Optional reference frame, otherwise the first measured frame becomes the reference
+    :type reference: Optional[numpy.ndarray]
+    :param max_size: Maximum size of the (downsampled) frames used for the correlation
+    :type max_size: int
+    :param downsample: Downsampling factor, computed from *max_size* if omitted
+    :type downsample: Optional[int]
+    :param window: Whether the frames are multiplied by a Hann window
+    :type window: bool
+    :param upsample: Upsampling factor of the subpixel refinement
+    :type upsample: int
+    :param microscope: Microscope for drift correction
+    :type microscope: Optional[BaseMicroscope]
+    :param detector: Detector of the frames for drift correction
+    :type detector: Optional[str]
+    :param calibration: Image shift calibration for drift correction
+    :type calibration: Optional[ImageShiftCalibration]
+    :param correct: Whether the drift is corrected
+    :type correct: bool
+    :param gain: Fraction of the drift corrected
+    :type gain: float
+    :param min_peak: Minimum correlation peak for corrections
+    :type min_peak: float
+
+    Usage:
+
+        >>> tracker = DriftTracker(microscope=microscope, detector="BM-Ceta", correct=True)
+        >>> for n in range(100):
+        ...     image = microscope.acquire("BM-Ceta")["BM-Ceta"]
+        ...     (dx, dy), peak = tracker.measure(image)
+
+    .. versionadded:: 2.2.0
+    """
+    LOWPASS = 0.35
+
+    def __init__(self, reference=None, max_size=512, downsample=None, window=True, upsample=10, microscope=None,
+                 detector=None, calibration=None, correct=False, gain=1.0, min_peak=0.05):
+        if correct and (microscope is None or detector is None):
+            raise ValueError("Drift correction requires microscope and detector.")
+        self.max_size = int(max_size)
+        self.downsample = int(downsample) if downsample is not None else None
+        self.window = window
+        self.upsample = int(upsample)
+        self.microscope = microscope
+        self.detector = detector
+        self.calibration = calibration
+        self.correct = correct
+        self.gain = float(gain)
+        self.min_peak = float(min_peak)
+        self.drift = (0.0, 0.0)         # Last measured drift in pixels
+        self.peak = None                # Last correlation peak
+        self.frames = 0                 # Number of measured frames
+        self._shape = None
+        self._factor = 1
+        self._buffer = None
+        self._window = None
+        self._frequencies = None
+        self._mask = None
+        self._cross = None
+        self._reference_conj = None
+        if reference is not None:
+            self.set_reference(reference)
+
+    @property
+    def factor(self):
+        """Downsampling factor of the current reference."""
+        return self._factor
+
+    def _setup(self, shape):
+        """Allocate buffers and window for frames of *shape*."""
+        if self.downsample is not None:
+            factor = max(self.downsample, 1)
+        else:
+            factor = max(int(math.ceil(max(shape) / float(self.max_size))), 1)
+        small_shape = (shape[0] // factor, shape[1] // factor)
+        if min(small_shape) < 2:
+            raise ValueError("Frame too small for downsampling factor %d." % factor)
+        self._shape = tuple(shape)
+        self._factor = factor
+        self._buffer = np.empty(small_shape, dtype=np.float32)
+        self._window = hann_window(small_shape) if self.window else None
+        self._frequencies = _frequencies(small_shape)
+        self._cross = np.empty((small_shape[0], small_shape[1] // 2 + 1), dtype=np.complex128)
+        if factor > 1:
+            fy, fx, _ = self._frequencies
+            self._mask = (fy[:, np.newaxis] ** 2 + fx[np.newaxis, :] ** 2) <= self.LOWPASS ** 2
+        else:
+            self._mask = None
+
+    def _prepare(self, image):
+        """Return downsampled, windowed frame (in the preallocated buffer)."""
+        image = np.asarray(image)
+        if image.shape != self._shape:
+            raise ValueError("Frame shape %s doesn't match reference shape %s." % (image.shape, self._shape))
+        buffer = self._buffer
+        factor = self._factor
+        rows, cols = buffer.shape
+        if factor > 1:
+            blocks = image[:rows * factor, :cols * factor].reshape(rows, factor, cols, factor)
+            np.mean(blocks, axis=(1, 3), dtype=np.float32, out=buffer)
+        else:
+            buffer[...] = image
+        buffer -= buffer.mean()
+        if self._window is not None:
+            buffer *= self._window
+        return buffer
+
+    def set_reference(self, image):
+        """Set new reference frame, resets the drift."""
+        image = np.asarray(image)
+        if image.ndim != 2:
+            raise ValueError("Frames must be 2D arrays.")
+        if self._shape != image.shape:
+            self._setup(image.shape)
+        # Conjugate, as used in the cross power spectrum
+        self._reference_conj = np.conj(np.fft.rfft2(self._prepare(image)))
+        self.drift = (0.0, 0.0)
+        self.peak = None
+        self.frames = 0
+
+    def measure(self, image):
+        """
+        Measure drift of *image* relative to the reference and correct it (if enabled).
+
+        If no reference was set, *image* becomes the reference.
+
+        :returns: Tuple ((x, y) drift in pixels of *image*, correlation peak)
+        """
+        if self._reference_conj is None:
+            self.set_reference(image)
+            return (0.0, 0.0), 1.0
+        cross = np.multiply(np.fft.rfft2(self._prepare(image)), self._reference_conj, out=self._cross)
+        cross /= np.abs(cross) + 1e-12
+        if self._mask is not None:
+            cross *= self._mask
+        (x, y), peak = _peak(np.fft.irfft2(cross, s=self._buffer.shape), subpixel=self.upsample <= 1)
+        if self.upsample > 1:
+            x, y = _upsampled_peak(cross, self._frequencies, x, y, self.upsample)
+        drift = (x * self._factor, y * self._factor)
+        self.drift = drift
+        self.peak = peak
+        self.frames += 1
+        if self.correct and peak >= self.min_peak:
+            self._correct(drift)
+        return drift, peak
+
+    def _correct(self, drift):
+        if self.calibration is None:
+            from .calibration import ImageShiftCalibration
+            self.calibration = ImageShiftCalibration()
+        deflector = self.calibration.deflector(self.microscope)
+        delta = self.calibration.pixels_to_shift(self.microscope, self.detector,
+                                                 (-self.gain * drift[0], -self.gain * drift[1]))
+        shift = getattr(self.microscope, "get_" + deflector)()
+        getattr(self.microscope, "set_" + deflector)((shift[0] + delta[0], shift[1] + delta[1]))
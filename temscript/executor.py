@@ -0,0 +1,287 @@
+import heapq
+import itertools
+import platform
+import threading
+import time
+from concurrent.futures import Future
+
+from .forwarding_microscope import ForwardingMicroscope
+
+
+# Priority lanes, lower values are executed first
+HIGH_PRIORITY = 0
+NORMAL_PRIORITY = 1
+LOW_PRIORITY = 2
+
+_LANE_NAMES = {HIGH_PRIORITY: "HIGH", NORMAL_PRIORITY: "NORMAL", LOW_PRIORITY: "LOW"}
+
+# Methods, which poll the microscope. They run in a separate thread and submit each poll as a call, thus other
+# calls are not blocked while waiting.
+_POLLING_METHODS = frozenset(("wait_for",))
+
+# Priority lanes of methods, methods not listed use NORMAL_PRIORITY
+DEFAULT_PRIORITIES = {
+    "set_beam_blanked": HIGH_PRIORITY,
+    "set_column_valves_open": HIGH_PRIORITY,
+    "set_stage_position": LOW_PRIORITY,
+    "_set_stage_position": LOW_PRIORITY,
+    "acquire": LOW_PRIORITY,
+    "normalize": LOW_PRIORITY,
+}
+
+
+class _LaneStatistics:
+    def __init__(self):
+        self.submitted = 0
+        self.completed = 0
+        self.depth = 0
+        self.max_depth = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.run_time = 0.0
+
+    def as_dict(self):
+        return {
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "queued": self.depth,
+            "max_queued": self.max_depth,
+            "mean_wait(s)": self.wait_time / self.completed if self.completed else 0.0,
+            "max_wait(s)": self.max_wait_time,
+            "mean_run(s)": self.run_time / self.completed if self.completed else 0.0
+        }
+
+
+class _FutureProxy:
+    """Proxy returning futures for all methods of the executor's backend."""
+    def __init__(self, executor):
+        self._executor = executor
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+
+        def submit(*args, **kw):
+            return self._executor.submit(name, *args, **kw)
+        submit.__name__ = name
+        return submit
+
+
+class MicroscopeExecutor(ForwardingMicroscope):
+    """
+    Microscope-like class, which executes all calls of a microscope in a single, dedicated thread.
+
+    The COM objects used by the local :class:`Microscope` are bound to the thread which created them. The executor
+    creates the microscope by calling *factory* in its own thread (on Windows after initializing COM for this thread)
+    and executes all calls of this microscope in this thread. Thus the executor can be used from any number of
+    threads.
+
+    The methods of the :class:`BaseMicroscope` interface are blocking calls, as usual. Every method is also
+    available as :class:`concurrent.futures.Future` returning call, either by :meth:`submit` or by the :attr:`futures`
+    proxy.
+
+    Calls are queued in priority lanes (:data:`HIGH_PRIORITY`, :data:`NORMAL_PRIORITY`, :data:`LOW_PRIORITY`),
+    within a lane calls are executed in order. Queued calls of higher priority are executed first, e.g. by default
+    ``set_beam_blanked`` is executed before already queued stage movements or acquisitions
+    (see :data:`DEFAULT_PRIORITIES`). A running call is never interrupted. :meth:`~BaseMicroscope.wait_for` is not a
+    single call: it polls from a separate thread, each poll is queued in the lane of the getter.
+
+    :param factory: Callable without arguments returning the microscope, e.g. the :class:`Microscope` class.
+    :param priorities: Priority lanes by method name, which replace the defaults of :data:`DEFAULT_PRIORITIES`.
+    :type priorities: Optional[Dict[str, int]]
+    :param name: Name of the thread
+    :type name: str
+    :raises Exception: Any exception raised by *factory*
+
+    Usage:
+
+        >>> executor = MicroscopeExecutor(Microscope)
+        >>> executor.get_family()                                   # Blocking call
+        >>> future = executor.futures.acquire("BM-Ceta")           # Returns future
+        >>> executor.set_beam_blanked(True)                         # Goes ahead of queued low priority calls
+        >>> images = future.result()
+        >>> executor.shutdown()
+
+    .. versionadded:: 2.2.0
+    """
+    def __init__(self, factory, priorities=None, name="temscript-executor"):
+        super(MicroscopeExecutor, self).__init__(None)
+        self._priorities = dict(DEFAULT_PRIORITIES)
+        if priorities:
+            self._priorities.update(priorities)
+        self._condition = threading.Condition()
+        self._queue = []
+        self._counter = itertools.count()
+        self._shutdown = False
+        self._statistics = {}
+        self._futures = _FutureProxy(self)
+
+        started = Future()
+        self._thread = threading.Thread(target=self._run, args=(factory, started), name=name)
+        self._thread.daemon = True
+        self._thread.start()
+        started.result()
+
+    @property
+    def futures(self):
+        """
+        Proxy returning futures for all methods of the microscope, e.g. ``executor.futures.get_state()`` returns a
+        future of the state.
+        """
+        return self._futures
+
+    @property
+    def thread(self):
+        """The thread executing the calls."""
+        return self._thread
+
+    def get_priority(self, method_name):
+        """Return priority lane of *method_name*."""
+        return self._priorities.get(method_name, NORMAL_PRIORITY)
+
+    def submit(self, method_name, *args, **kw):
+        """
+        Queue call of method *method_name* of the microscope with the given arguments.
+
+        :param method_name: Name of method to call
+        :type method_name: str
+        :param priority: Keyword only: Priority lane of the call, by default the lane of the method is used.
+        :type priority: Optional[int]
+        :returns: :class:`concurrent.futures.Future` of the call's result
+        :raises RuntimeError: If the executor was shut down
+        """
+        if method_name in _POLLING_METHODS:
+            return self._submit_polling(method_name, args, kw)
+        priority = kw.pop("priority", None)
+        if priority is None:
+            priority = self.get_priority(method_name)
+        future = Future()
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("Executor was shut down.")
+            stats = self._statistics.setdefault(priority, _LaneStatistics())
+            stats.submitted += 1
+            stats.depth += 1
+            stats.max_depth = max(stats.max_depth, stats.depth)
+            heapq.heappush(self._queue, (priority, next(self._counter), time.perf_counter(), future, method_name,
+                                         args, kw))
+            self._condition.notify()
+        return future
+
+    def _submit_polling(self, method_name, args, kw):
+        """Run polling method in a new thread, the polls are queued in the lanes of the getters."""
+        kw.pop("priority", None)
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("Executor was shut down.")
+        future = Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                result = getattr(self, method_name)(*args, **kw)
+            except BaseException as exc:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+        thread = threading.Thread(target=run, name="%s-%s" % (self._thread.name, method_name))
+        thread.daemon = True
+        thread.start()
+        return future
+
+    def _forward(self, method_name, *args, **kw):
+        if threading.current_thread() is self._thread:
+            # Called from within a call (e.g. by a callback), avoid deadlock
+            return getattr(self._backend, method_name)(*args, **kw)
+        return self.submit(method_name, *args, **kw).result()
+
+    def _start_stage_move(self, pos=None, method="GO", speed=None):
+        from .stage_move import StageMoveHandle
+        return StageMoveHandle(self.submit("_set_stage_position", pos=pos, method=method, speed=speed))
+
+    def statistics(self):
+        """
+        Return dict with statistics by priority lane ("HIGH", "NORMAL", "LOW"). Each lane has a dict with the
+        following keys:
+
+            * "submitted": Number of submitted calls
+            * "completed": Number of executed calls
+            * "queued": Number of currently queued calls
+            * "max_queued": Maximum number of queued calls
+            * "mean_wait(s)": Mean time calls were queued in seconds
+            * "max_wait(s)": Maximum time a call was queued in seconds
+            * "mean_run(s)": Mean execution time of calls in seconds
+        """
+        with self._condition:
+            return {_LANE_NAMES.get(priority, priority): stats.as_dict()
+                    for priority, stats in sorted(self._statistics.items())}
+
+    def shutdown(self, wait=True, cancel_pending=False):
+        """
+        Stop executor. The microscope is released by the executor thread.
+
+        :param wait: Whether to wait for the thread to finish
+        :type wait: bool
+        :param cancel_pending: Whether queued calls are cancelled. Otherwise they are executed before the executor
+            stops.
+        :type cancel_pending: bool
+        """
+        with self._condition:
+            self._shutdown = True
+            if cancel_pending:
+                for entry in self._queue:
+                    entry[3].cancel()
+                    self._statistics[entry[0]].depth -= 1
+                self._queue = []
+            self._condition.notify()
+        if wait and threading.current_thread() is not self._thread:
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+    def _run(self, factory, started):
+        try:
+            if platform.system() == "Windows":
+                from ._com import initialize_com
+                initialize_com()
+            self._backend = factory()
+        except BaseException as exc:
+            with self._condition:
+                self._shutdown = True
+            started.set_exception(exc)
+            return
+        started.set_result(None)
+
+        while True:
+            with self._condition:
+                while not self._queue and not self._shutdown:
+                    self._condition.wait()
+                if not self._queue:
+                    break
+                priority, _, submitted, future, method_name, args, kw = heapq.heappop(self._queue)
+                stats = self._statistics[priority]
+                stats.depth -= 1
+            if not future.set_running_or_notify_cancel():
+                continue
+            start = time.perf_counter()
+            try:
+                result = getattr(self._backend, method_name)(*args, **kw)
+            except BaseException as exc:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+            end = time.perf_counter()
+            with self._condition:
+                stats.completed += 1
+                stats.wait_time += start - submitted
+                stats.max_wait_time = max(stats.max_wait_time, start - submitted)
+                stats.run_time += end - start
+
+        # Release microscope in its own thread
+        self._backend = None
@@ -0,0 +1,292 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+# Number of pixels corrected at once for integer outputs (size of the float32 scratch buffer)
+_CHUNK_PIXELS = 1 << 18
+
+
+def flat_field_correct(image, dark=None, gain=None, out=None):
+    """
+    Return dark and gain corrected *image*: ``(image - dark) * gain``.
+
+    The correction is vectorized and computed in float32. Float32 images are corrected in place, if *out* is the
+    image. For integer outputs (by default the output has the dtype of *image*), the result is rounded and clipped to
+    the range of the dtype, thus no overflow or underflow occurs. Other outputs are corrected in chunks of rows with a
+    single float32 scratch buffer, thus the additional memory doesn't depend on the image size.
+
+    :param image: Raw image
+    :type image: numpy.ndarray
+    :param dark: Optional dark reference (float32)
+    :type dark: Optional[numpy.ndarray]
+    :param gain: Optional gain reference (float32), i.e. the inverse of the normalized flat field
+    :type gain: Optional[numpy.ndarray]
+    :param out: Optional output array, may be *image*
+    :type out: Optional[numpy.ndarray]
+    :returns: Corrected image (*out* if given)
+
+    .. versionadded:: 2.2.0
+    """
+    image = np.asarray(image)
+    if out is None:
+        out = np.empty_like(image)
+    if out.dtype == np.float32:
+        if dark is not None:
+            np.subtract(image, dark, out=out)
+        elif out is not image:
+            out[...] = image
+        if gain is not None:
+            out *= gain
+        return out
+
+    if dark is not None:
+        dark = np.broadcast_to(dark, image.shape)
+    if gain is not None:
+        gain = np.broadcast_to(gain, image.shape)
+    info = np.iinfo(out.dtype) if out.dtype.kind in "iu" else None
+    row_pixels = max(int(np.prod(image.shape[1:])), 1)
+    chunk_rows = max(_CHUNK_PIXELS // row_pixels, 1)
+    scratch = np.empty((min(chunk_rows, len(image)),) + image.shape[1:], dtype=np.float32)
+    for start in range(0, len(image), chunk_rows):
+        stop = min(start + chunk_rows, len(image))
+        work = scratch[:stop - start]
+        if dark is not None:
+            np.subtract(image[start:stop], dark[start:stop], out=work)
+        else:
+            work[...] = image[start:stop]
+        if gain is not None:
+            work *= gain[start:stop]
+        if info is not None:
+            np.rint(work, out=work)
+            np.clip(work, info.min, info.max, out=work)
+        out[start:stop] = work
+    return out
+
+
+def _file_name(key):
+    return "".join(c if c.isalnum() or c in "-." else "_" for c in key) + ".npz"
+
+
+class ReferenceLibrary:
+    """
+    Library of dark and gain references of cameras.
+
+    References are keyed by camera name, binning, image size, and exposure time (see :meth:`key`). They are created
+    from averaged acquisitions by :meth:`acquire_dark` and :meth:`acquire_gain`, or added by :meth:`put`. At most
+    *max_entries* references are kept in memory, the least recently used references are evicted. If a *directory*
+    is given, references are stored there (one .npz file per key) and loaded again when needed.
+
+    :meth:`correct_images` applies the references to images acquired with the correction "UNPROCESSED". It is used by
+    the server to correct images before they are sent (see ``--flatfield`` option of :func:`run_server`), but can as
+    well be used by clients.
+
+    :param directory: Optional directory to persist the references (created if necessary)
+    :type directory: Optional[str]
+    :param max_entries: Maximum number of references in memory
+    :type max_entries: int
+
+    Usage:
+
+        >>> library = ReferenceLibrary("references")
+        >>> microscope.set_camera_param("BM-Ceta", {"correction": "UNPROCESSED"})
+        >>> library.acquire_dark(microscope, "BM-Ceta", count=20)
+        >>> library.acquire_gain(microscope, "BM-Ceta", count=20)    # With flat illumination
+        >>> images = library.correct_images(microscope, microscope.acquire("BM-Ceta"))
+
+    .. versionadded:: 2.2.0
+    """
+    def __init__(self, directory=None, max_entries=8):
+        self.directory = directory
+        self.max_entries = max(int(max_entries), 1)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()       # LRU order, most recently used last
+        self._files = {}
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        if directory is not None:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            for name in os.listdir(directory):
+                if name.endswith(".npz") and not name.endswith(".tmp.npz"):
+                    path = os.path.join(directory, name)
+                    with np.load(path) as data:
+                        self._files[str(data["key"])] = path
+
+    @staticmethod
+    def key(microscope, camera):
+        """Return key of the references for the current parameters of *camera*."""
+        param = microscope.get_camera_param(camera)
+        return ReferenceLibrary.make_key(camera, param["binning"], param["image_size"], param["exposure(s)"])
+
+    @staticmethod
+    def make_key(camera, binning, image_size, exposure):
+        """Return key of the references for the given camera parameters."""
+        return "%s/%d/%s/%g" % (camera, binning, image_size, exposure)
+
+    def keys(self):
+        """Return keys of all references (in memory and on disk)."""
+        with self._lock:
+            return sorted(set(self._entries.keys()) | set(self._files.keys()))
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries or key in self._files
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, key):
+        """
+        Return tuple (dark, gain) of references for *key*. Missing references are None.
+
+        :raises KeyError: If there are no references for *key*
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return entry
+            path = self._files.get(key)
+            if path is None:
+                raise KeyError("No references for '%s'" % key)
+            self._misses += 1
+            entry = self._load(path)
+            self._insert(key, entry)
+            return entry
+
+    def put(self, key, dark=None, gain=None):
+        """Store references for *key*, replacing existing ones. References not given are kept."""
+        dark = np.asarray(dark, dtype=np.float32) if dark is not None else None
+        gain = np.asarray(gain, dtype=np.float32) if gain is not None else None
+        # Read, merge, and insert under one lock, thus concurrent puts of dark and gain references are both kept
+        with self._lock:
+            previous = self._entries.get(key)
+            if previous is None and key in self._files:
+                previous = self._load(self._files[key])
+            if previous is not None:
+                dark = dark if dark is not None else previous[0]
+                gain = gain if gain is not None else previous[1]
+            entry = dark, gain
+            self._insert(key, entry)
+            if self.directory is not None:
+                path = os.path.join(self.directory, _file_name(key))
+                temp_name = path + ".tmp.npz"
+                np.savez(temp_name, key=np.array(key),
+                         dark=entry[0] if entry[0] is not None else np.array(0.0),
+                         gain=entry[1] if entry[1] is not None else np.array(0.0))
+                os.replace(temp_name, path)
+                self._files[key] = path
+
+    @staticmethod
+    def _load(path):
+        with np.load(path) as data:
+            return data["dark"] if data["dark"].ndim else None, data["gain"] if data["gain"].ndim else None
+
+    def _insert(self, key, entry):
+        # Called with lock held
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    def remove(self, key):
+        """Remove references for *key* (also from disk)."""
+        with self._lock:
+            self._entries.pop(key, None)
+            path = self._files.pop(key, None)
+        if path is not None:
+            os.remove(path)
+
+    @staticmethod
+    def _average(microscope, camera, count):
+        total = None
+        for n in range(count):
+            image = microscope.acquire(camera)[camera]
+            if total is None:
+                total = np.zeros(image.shape, dtype=np.float64)
+            total += image
+        return (total / count).astype(np.float32)
+
+    def acquire_dark(self, microscope, camera, count=10):
+        """
+        Acquire dark reference of *camera* for its current parameters, by averaging *count* images with blanked beam.
+
+        :returns: The dark reference
+        """
+        key = self.key(microscope, camera)
+        blanked = microscope.get_beam_blanked()
+        microscope.set_beam_blanked(True)
+        try:
+            dark = self._average(microscope, camera, count)
+        finally:
+            if not blanked:
+                microscope.set_beam_blanked(False)
+        self.put(key, dark=dark)
+        return dark
+
+    def acquire_gain(self, microscope, camera, count=10):
+        """
+        Acquire gain reference of *camera* for its current parameters, by averaging *count* images of flat
+        illumination. The dark reference is subtracted, if available. The gain of pixels without signal is zero.
+
+        :returns: The gain reference
+        """
+        key = self.key(microscope, camera)
+        flat = self._average(microscope, camera, count)
+        try:
+            dark = self.get(key)[0]
+        except KeyError:
+            dark = None
+        if dark is not None:
+            flat -= dark
+        valid = flat > 0.0
+        if not np.any(valid):
+            raise ValueError("No signal in flat field images.")
+        gain = np.zeros(flat.shape, dtype=np.float32)
+        gain[valid] = float(flat[valid].mean()) / flat[valid]
+        self.put(key, gain=gain)
+        return gain
+
+    def correct(self, key, image, out=None):
+        """Return *image* corrected by the references of *key* (see :func:`flat_field_correct`)."""
+        dark, gain = self.get(key)
+        image = np.asarray(image)
+        for reference in (dark, gain):
+            if reference is not None and reference.shape != image.shape:
+                raise ValueError("Reference shape %s doesn't match image shape %s." % (reference.shape, image.shape))
+        return flat_field_correct(image, dark, gain, out=out)
+
+    def correct_images(self, microscope, images):
+        """
+        Correct images of cameras acquired with the correction "UNPROCESSED", for which references exist.
+
+        :param microscope: Microscope used to read the camera parameters
+        :type microscope: BaseMicroscope
+        :param images: Dict with images by detector name, as returned by :meth:`BaseMicroscope.acquire`. The
+            images are corrected in place.
+        :returns: *images*
+        """
+        for name, image in images.items():
+            try:
+                param = microscope.get_camera_param(name)
+            except KeyError:
+                # STEM detector
+                continue
+            if param.get("correction") != "UNPROCESSED":
+                continue
+            key = self.make_key(name, param["binning"], param["image_size"], param["exposure(s)"])
+            if key in self:
+                images[name] = self.correct(key, image, out=image if image.flags.writeable else None)
+        return images
+
+    def statistics(self):
+        """Return dict with the number of references in memory ("entries"), "hits", "misses", and "evictions"."""
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self._hits, "misses": self._misses,
+                    "evictions": self._evictions}
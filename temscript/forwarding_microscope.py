@@ -0,0 +1,273 @@
+from .base_microscope import BaseMicroscope
+
+
+def _freeze(value):
+    """Convert *value* into a hashable representation, used as lookup key for recorded or cached calls."""
+    if isinstance(value, dict):
+        return tuple(sorted((str(k), _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if hasattr(value, "tolist"):
+        return _freeze(value.tolist())
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+    return value
+
+
+class ForwardingMicroscope(BaseMicroscope):
+    """
+    Microscope-like class, which forwards all calls to another microscope.
+
+    All methods of the :class:`BaseMicroscope` interface are routed through the :meth:`_forward` method, which by
+    default calls the method of the same name of the *backend*. Subclasses override :meth:`_forward` to add behavior
+    (like recording or caching) to an arbitrary microscope implementation.
+
+    :param backend: Microscope the calls are forwarded to
+    :type backend: BaseMicroscope
+
+    .. versionadded:: 2.2.0
+    """
+    def __init__(self, backend):
+        self._backend = backend
+
+    @property
+    def backend(self):
+        """The microscope calls are forwarded to."""
+        return self._backend
+
+    def _forward(self, method_name, *args, **kw):
+        """
+        Forward call of method *method_name* with the given arguments to the backend.
+
+        :param method_name: Name of the method to call
+        :type method_name: str
+        :returns: Result of the call
+        """
+        return getattr(self._backend, method_name)(*args, **kw)
+
+    def get_family(self):
+        return self._forward("get_family")
+
+    def get_microscope_id(self):
+        return self._forward("get_microscope_id")
+
+    def get_version(self):
+        return self._forward("get_version")
+
+    def get_voltage(self):
+        return self._forward("get_voltage")
+
+    def get_vacuum(self):
+        return self._forward("get_vacuum")
+
+    def get_column_valves_open(self):
+        return self._forward("get_column_valves_open")
+
+    def set_column_valves_open(self, state):
+        return self._forward("set_column_valves_open", state)
+
+    def get_stage_holder(self):
+        return self._forward("get_stage_holder")
+
+    def get_stage_status(self):
+        return self._forward("get_stage_status")
+
+    def get_stage_limits(self):
+        return self._forward("get_stage_limits")
+
+    def get_stage_position(self):
+        return self._forward("get_stage_position")
+
+    def _set_stage_position(self, pos=None, method="GO", speed=None):
+        return self._forward("_set_stage_position", pos=pos, method=method, speed=speed)
+
+    def get_cameras(self):
+        return self._forward("get_cameras")
+
+    def get_stem_detectors(self):
+        return self._forward("get_stem_detectors")
+
+    def get_camera_param(self, name):
+        return self._forward("get_camera_param", name)
+
+    def set_camera_param(self, name, values, ignore_errors=False):
+        return self._forward("set_camera_param", name, values, ignore_errors=ignore_errors)
+
+    def get_stem_detector_param(self, name):
+        return self._forward("get_stem_detector_param", name)
+
+    def set_stem_detector_param(self, name, values, ignore_errors=False):
+        return self._forward("set_stem_detector_param", name, values, ignore_errors=ignore_errors)
+
+    def get_stem_acquisition_param(self):
+        return self._forward("get_stem_acquisition_param")
+
+    def set_stem_acquisition_param(self, values, ignore_errors=False):
+        return self._forward("set_stem_acquisition_param", values, ignore_errors=ignore_errors)
+
+    def acquire(self, *args):
+        return self._forward("acquire", *args)
+
+    def get_image_shift(self):
+        return self._forward("get_image_shift")
+
+    def set_image_shift(self, pos):
+        return self._forward("set_image_shift", pos)
+
+    def get_beam_shift(self):
+        return self._forward("get_beam_shift")
+
+    def set_beam_shift(self, shift):
+        return self._forward("set_beam_shift", shift)
+
+    def get_beam_tilt(self):
+        return self._forward("get_beam_tilt")
+
+    def set_beam_tilt(self, tilt):
+        return self._forward("set_beam_tilt", tilt)
+
+    def normalize(self, mode="ALL"):
+        return self._forward("normalize", mode=mode)
+
+    def get_projection_sub_mode(self):
+        return self._forward("get_projection_sub_mode")
+
+    def get_projection_mode(self):
+        return self._forward("get_projection_mode")
+
+    def set_projection_mode(self, mode):
+        return self._forward("set_projection_mode", mode)
+
+    def get_projection_mode_string(self):
+        return self._forward("get_projection_mode_string")
+
+    def get_magnification_index(self):
+        return self._forward("get_magnification_index")
+
+    def set_magnification_index(self, index):
+        return self._forward("set_magnification_index", index)
+
+    def get_indicated_camera_length(self):
+        return self._forward("get_indicated_camera_length")
+
+    def get_indicated_magnification(self):
+        return self._forward("get_indicated_magnification")
+
+    def get_defocus(self):
+        return self._forward("get_defocus")
+
+    def set_defocus(self, value):
+        return self._forward("set_defocus", value)
+
+    def get_objective_excitation(self):
+        return self._forward("get_objective_excitation")
+
+    def get_intensity(self):
+        return self._forward("get_intensity")
+
+    def set_intensity(self, value):
+        return self._forward("set_intensity", value)
+
+    def get_objective_stigmator(self):
+        return self._forward("get_objective_stigmator")
+
+    def set_objective_stigmator(self, value):
+        return self._forward("set_objective_stigmator", value)
+
+    def get_condenser_stigmator(self):
+        return self._forward("get_condenser_stigmator")
+
+    def set_condenser_stigmator(self, value):
+        return self._forward("set_condenser_stigmator", value)
+
+    def get_diffraction_shift(self):
+        return self._forward("get_diffraction_shift")
+
+    def set_diffraction_shift(self, value):
+        return self._forward("set_diffraction_shift", value)
+
+    def get_screen_current(self):
+        return self._forward("get_screen_current")
+
+    def get_screen_position(self):
+        return self._forward("get_screen_position")
+
+    def set_screen_position(self, mode):
+        return self._forward("set_screen_position", mode)
+
+    def get_illumination_mode(self):
+        return self._forward("get_illumination_mode")
+
+    def set_illumination_mode(self, mode):
+        return self._forward("set_illumination_mode", mode)
+
+    def get_condenser_mode(self):
+        return self._forward("get_condenser_mode")
+
+    def set_condenser_mode(self, mode):
+        return self._forward("set_condenser_mode", mode)
+
+    def get_stem_magnification(self):
+        return self._forward("get_stem_magnification")
+
+    def set_stem_magnification(self, value):
+        return self._forward("set_stem_magnification", value)
+
+    def get_stem_rotation(self):
+        return self._forward("get_stem_rotation")
+
+    def set_stem_rotation(self, value):
+        return self._forward("set_stem_rotation", value)
+
+    def get_illuminated_area(self):
+        return self._forward("get_illuminated_area")
+
+    def set_illuminated_area(self, value):
+        return self._forward("set_illuminated_area", value)
+
+    def get_probe_defocus(self):
+        return self._forward("get_probe_defocus")
+
+    def set_probe_defocus(self, value):
+        return self._forward("set_probe_defocus", value)
+
+    def get_convergence_angle(self):
+        return self._forward("get_convergence_angle")
+
+    def set_convergence_angle(self, value):
+        return self._forward("set_convergence_angle", value)
+
+    def get_spot_size_index(self):
+        return self._forward("get_spot_size_index")
+
+    def set_spot_size_index(self, index):
+        return self._forward("set_spot_size_index", index)
+
+    def get_dark_field_mode(self):
+        return self._forward("get_dark_field_mode")
+
+    def set_dark_field_mode(self, mode):
+        return self._forward("set_dark_field_mode", mode)
+
+    def get_beam_blanked(self):
+        return self._forward("get_beam_blanked")
+
+    def set_beam_blanked(self, mode):
+        return self._forward("set_beam_blanked", mode)
+
+    def is_stem_available(self):
+        return self._forward("is_stem_available")
+
+    def get_instrument_mode(self):
+        return self._forward("get_instrument_mode")
+
+    def set_instrument_mode(self, mode):
+        return self._forward("set_instrument_mode", mode)
+
+    def get_state(self, fields=None):
+        return self._forward("get_state", fields=fields)
+
+    def set_state(self, state, move_stage=False):
+        return self._forward("set_state", state, move_stage=move_stage)
@@ -0,0 +1,120 @@
+import threading
+from collections import deque
+
+import numpy as np
+
+
+class FramePool:
+    """
+    Pool of preallocated image buffers, which are recycled for subsequent acquisitions.
+
+    Buffers are kept separately for each (shape, dtype) combination. For each combination at most *size* buffers
+    are allocated. A requested frame is served from the buffers released by the consumer (see :meth:`release`).
+    If no released buffer is available and all buffers are allocated, the pool wraps around and the oldest buffer
+    in use is handed out again, overwriting its content. This resembles cameras with a fixed set of DMA buffers.
+
+    The pool is thread-safe.
+
+    :param size: Number of buffers per (shape, dtype) combination
+    :type size: int
+
+    Usage:
+
+        >>> pool = FramePool(size=4)
+        >>> microscope = NullMicroscope(frame_pool=pool)
+        >>> image = microscope.acquire("CCD")["CCD"]
+        >>> pool.release(image)
+        >>> pool.statistics()["hit_rate"]
+
+    .. versionadded:: 2.2.0
+    """
+    def __init__(self, size=4):
+        size = int(size)
+        if size < 1:
+            raise ValueError("Pool size must be positive.")
+        self.size = size
+        self._lock = threading.Lock()
+        self._buffers = {}      # key -> list of all buffers
+        self._in_use = {}       # key -> deque of buffers handed out, oldest first
+        self._free = {}         # key -> deque of released buffers
+        self._hits = 0
+        self._misses = 0
+        self._wraps = 0
+
+    def get(self, shape, dtype):
+        """
+        Return buffer for a frame of *shape* and *dtype*.
+
+        The content of the returned buffer is undefined.
+        """
+        dtype = np.dtype(dtype)
+        shape = tuple(int(n) for n in shape)
+        key = shape, dtype.str
+        with self._lock:
+            buffers = self._buffers.setdefault(key, [])
+            in_use = self._in_use.setdefault(key, deque())
+            free = self._free.setdefault(key, deque())
+            if free:
+                frame = free.popleft()
+                self._hits += 1
+            elif len(buffers) < self.size:
+                frame = np.empty(shape, dtype=dtype)
+                buffers.append(frame)
+                self._misses += 1
+            else:
+                frame = in_use.popleft()
+                self._hits += 1
+                self._wraps += 1
+            in_use.append(frame)
+        return frame
+
+    def release(self, frame):
+        """
+        Return *frame* to the pool.
+
+        The frame must not be used afterwards. Frames not allocated by this pool are ignored.
+        """
+        frame = np.asarray(frame)
+        while frame.base is not None and isinstance(frame.base, np.ndarray):
+            frame = frame.base
+        key = frame.shape, frame.dtype.str
+        with self._lock:
+            in_use = self._in_use.get(key)
+            if not in_use:
+                return
+            for index, buffer in enumerate(in_use):
+                if buffer is frame:
+                    del in_use[index]
+                    self._free[key].append(buffer)
+                    break
+
+    def clear(self):
+        """Drop all buffers and reset statistics."""
+        with self._lock:
+            self._buffers.clear()
+            self._in_use.clear()
+            self._free.clear()
+            self._hits = self._misses = self._wraps = 0
+
+    def statistics(self):
+        """
+        Return dict with statistics of the pool:
+
+            * "hits": Number of frames served from recycled buffers
+            * "misses": Number of frames, which required allocation of a new buffer
+            * "wraps": Number of hits, which reused a buffer not released by the consumer
+            * "hit_rate": Fraction of frames served from recycled buffers
+            * "buffers": Number of allocated buffers
+            * "allocated(bytes)": Total size of allocated buffers
+        """
+        with self._lock:
+            total = self._hits + self._misses
+            buffers = [buffer for key_buffers in self._buffers.values() for buffer in key_buffers]
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "wraps": self._wraps,
+                "hit_rate": float(self._hits) / total if total else 0.0,
+                "buffers": len(buffers),
+                "allocated(bytes)": sum(buffer.nbytes for buffer in buffers)
+            }
@@ -0,0 +1,606 @@
+import json
+import math
+import os
+import threading
+import time
+
+import numpy as np
+
+from ._pipeline import Pipeline, settle
+from .calibration import ImageShiftCalibration
+from .stage_move import StageMoveHandle
+from .tilt_series import DEFAULT_METADATA_FIELDS
+
+
+def montage_tiles(region, tile_size, overlap=0.1, limits=None):
+    """
+    Return tiles covering a rectangular region.
+
+    The tiles are arranged in a regular grid centered on the region. Adjacent tiles overlap by the fraction *overlap*
+    of the tile size. If stage *limits* are given (as returned by :meth:`BaseMicroscope.get_stage_limits`), tile
+    centers are clipped to the limits of the "x" and "y" axes. Tiles, which coincide after clipping, are removed.
+
+    Each tile is a dict with the keys "index", "row", "col", "x", and "y" (the center in meters).
+
+    :param region: (x_min, x_max, y_min, y_max) tuple in meters
+    :param tile_size: Size of a tile in meters, either a number or a (width, height) tuple
+    :param overlap: Overlap of adjacent tiles as fraction of the tile size
+    :type overlap: float
+    :param limits: Optional stage limits
+    :type limits: Optional[Dict[str, Tuple[float, float]]]
+    :returns: List of tiles in row order
+
+    .. versionadded:: 2.2.0
+    """
+    x_min, x_max, y_min, y_max = [float(value) for value in region]
+    if np.ndim(tile_size) == 0:
+        tile_size = (tile_size, tile_size)
+    width, height = float(tile_size[0]), float(tile_size[1])
+    if not 0.0 <= overlap < 1.0:
+        raise ValueError("Overlap must be within [0, 1).")
+    if width <= 0.0 or height <= 0.0:
+        raise ValueError("Tile size must be positive.")
+    step_x, step_y = width * (1.0 - overlap), height * (1.0 - overlap)
+    cols = max(int(math.ceil((x_max - x_min - width) / step_x - 1e-9)) + 1, 1)
+    rows = max(int(math.ceil((y_max - y_min - height) / step_y - 1e-9)) + 1, 1)
+    center_x, center_y = 0.5 * (x_min + x_max), 0.5 * (y_min + y_max)
+
+    tiles = []
+    seen = set()
+    for row in range(rows):
+        y = center_y + (row - 0.5 * (rows - 1)) * step_y
+        for col in range(cols):
+            x = center_x + (col - 0.5 * (cols - 1)) * step_x
+            if limits is not None:
+                if "x" in limits:
+                    x = min(max(x, limits["x"][0]), limits["x"][1])
+                if "y" in limits:
+                    y = min(max(y, limits["y"][0]), limits["y"][1])
+            key = (round(x * 1e9), round(y * 1e9))
+            if key in seen:
+                continue
+            seen.add(key)
+            tiles.append({"index": len(tiles), "row": row, "col": col, "x": x, "y": y})
+    return tiles
+
+
+def _distances(points, index, metric):
+    """Return distances of point *index* to all *points*."""
+    delta = np.abs(points - points[index])
+    if metric == "chebyshev":
+        return delta.max(axis=1)
+    return np.sqrt((delta ** 2).sum(axis=1))
+
+
+def path_length(tiles, metric="chebyshev"):
+    """
+    Return length of the path visiting *tiles* in order.
+
+    .. versionadded:: 2.2.0
+    """
+    if len(tiles) < 2:
+        return 0.0
+    points = np.array([(tile["x"], tile["y"]) for tile in tiles])
+    delta = np.abs(np.diff(points, axis=0))
+    if metric == "chebyshev":
+        return float(delta.max(axis=1).sum())
+    return float(np.sqrt((delta ** 2).sum(axis=1)).sum())
+
+
+def _nearest_neighbor(points, start, metric):
+    count = len(points)
+    visited = np.zeros(count, dtype=bool)
+    order = [start]
+    visited[start] = True
+    current = start
+    for n in range(count - 1):
+        distances = _distances(points, current, metric)
+        distances[visited] = np.inf
+        current = int(np.argmin(distances))
+        visited[current] = True
+        order.append(current)
+    return order
+
+
+def _two_opt(points, order, metric, max_passes):
+    """Improve open path *order* by reversing segments, as long as the path gets shorter."""
+    if metric == "chebyshev":
+        def dist(p, q):
+            return np.abs(p - q).max(axis=-1)
+    else:
+        def dist(p, q):
+            return np.sqrt(((p - q) ** 2).sum(axis=-1))
+
+    order = np.array(order)
+    count = len(order)
+    for n in range(max_passes):
+        improved = False
+        for i in range(count - 2):
+            path = points[order]
+            a, b = path[i], path[i + 1]
+            c = path[i + 2:]                                    # Candidates for the end of the reversed segment
+            d = np.vstack((path[i + 3:], np.full((1, 2), np.nan)))  # Successors of c (none for the last tile)
+            old = dist(a, b) + np.nan_to_num(dist(c, d))
+            new = dist(a, c) + np.nan_to_num(dist(b, d))
+            gain = old - new
+            j = int(np.argmax(gain))
+            if gain[j] > 1e-12:
+                # Reverse segment from i+1 to i+2+j
+                order[i + 1:i + 3 + j] = order[i + 1:i + 3 + j][::-1].copy()
+                improved = True
+        if not improved:
+            break
+    return order.tolist()
+
+
+def order_tiles(tiles, method="2opt", start=None, metric="chebyshev", max_passes=10):
+    """
+    Return *tiles* in the order of a short stage path.
+
+    Methods:
+
+        * "serpentine": Row by row, alternating the direction of the rows.
+        * "nearest": Nearest neighbor path from *start*.
+        * "2opt": Nearest neighbor path improved by 2-opt moves (segment reversals), at most *max_passes* passes.
+
+    The *metric* is "chebyshev" (the maximum of the distance in x and y, i.e. the travel time if both axes move
+    simultaneously) or "euclidean".
+
+    :param tiles: Tiles as returned by :func:`montage_tiles`
+    :param method: Ordering method
+    :type method: str
+    :param start: (x, y) position the path starts from, e.g. the current stage position. Defaults to the first tile.
+    :param metric: Distance metric
+    :type metric: str
+    :param max_passes: Maximum number of 2-opt passes
+    :type max_passes: int
+    :returns: List of tiles
+
+    .. versionadded:: 2.2.0
+    """
+    tiles = list(tiles)
+    if len(tiles) < 2:
+        return tiles
+    if metric not in ("chebyshev", "euclidean"):
+        raise ValueError("Unknown metric: %r" % metric)
+    if method == "serpentine":
+        rows = {}
+        for tile in tiles:
+            rows.setdefault(tile["row"], []).append(tile)
+        result = []
+        for n, row in enumerate(sorted(rows.keys())):
+            row_tiles = sorted(rows[row], key=lambda tile: tile["col"])
+            result.extend(row_tiles if n % 2 == 0 else row_tiles[::-1])
+        return result
+    elif method not in ("nearest", "2opt"):
+        raise ValueError("Unknown ordering method: %r" % method)
+
+    points = np.array([(tile["x"], tile["y"]) for tile in tiles])
+    if start is None:
+        first = 0
+    else:
+        first = int(np.argmin(_distances(np.vstack((points, [start])), len(points), metric)[:-1]))
+    order = _nearest_neighbor(points, first, metric)
+    if method == "2opt":
+        order = _two_opt(points, order, metric, max_passes)
+    return [tiles[index] for index in order]
+
+
+class Montage:
+    """
+    Pipelined acquisition of montages.
+
+    The stage is moved to the center of each tile, the state fields given by *metadata_fields* are read, and the
+    *detectors* are acquired. The frames are passed to *writer* in worker threads, while the stage already moves to
+    the next tile. The tiles are acquired in the given order, use :func:`order_tiles` to minimize the stage travel.
+
+    The *writer* is called as ``writer(tile, images, metadata)`` with the tile dict, the dict of images returned by
+    :meth:`BaseMicroscope.acquire`, and the metadata dict (keys "tile", "time", and "state"). If no *writer* is given,
+    the images are kept in memory and stored in the metadata dicts with the key "images".
+
+    If a *checkpoint* file is given, the indices of the tiles are stored in this file as soon as their frames are
+    written. Running a montage with the same tiles and checkpoint again skips the tiles already written, thus
+    interrupted montages can be resumed. The checkpoint is a journal: the first line is a JSON header identifying the
+    tiles, each written tile appends a line with its index. An incomplete last line (after a crash) is ignored.
+
+    :param microscope: Microscope
+    :type microscope: BaseMicroscope
+    :param detectors: Names of detectors to acquire
+    :type detectors: Union[str, Iterable[str]]
+    :param tiles: Tiles in acquisition order (see :func:`montage_tiles` and :func:`order_tiles`)
+    :param writer: Callable writing the frames
+    :param settle_time: Time in seconds to wait after the stage arrived (in clock time for a simulated microscope)
+    :type settle_time: float
+    :param checkpoint: Optional name of checkpoint file
+    :type checkpoint: Optional[str]
+    :param metadata_fields: State fields recorded for each frame
+    :type metadata_fields: Iterable[str]
+    :param workers: Number of writer threads
+    :type workers: int
+    :param max_pending: Maximum number of frames waiting for the writers
+    :type max_pending: int
+    :param callback: Optional callable called with the metadata dict after each acquisition
+
+    Usage:
+
+        >>> tiles = montage_tiles((-50e-6, 50e-6, -50e-6, 50e-6), 5e-6, overlap=0.1,
+        ...                       limits=microscope.get_stage_limits())
+        >>> tiles = order_tiles(tiles, "2opt", start=(pos["x"], pos["y"]))
+        >>> montage = Montage(microscope, "BM-Ceta", tiles, writer=write_tile, checkpoint="map.checkpoint")
+        >>> montage.run()
+
+    .. versionadded:: 2.2.0
+    """
+    def __init__(self, microscope, detectors, tiles, writer=None, settle_time=0.0, checkpoint=None,
+                 metadata_fields=DEFAULT_METADATA_FIELDS, workers=2, max_pending=4, callback=None):
+        self.microscope = microscope
+        self.detectors = [detectors] if isinstance(detectors, str) else list(detectors)
+        self.tiles = list(tiles)
+        self.writer = writer
+        self.settle_time = float(settle_time)
+        self.checkpoint = checkpoint
+        self.metadata_fields = list(metadata_fields) if metadata_fields is not None else []
+        self.workers = int(workers)
+        self.max_pending = int(max_pending)
+        self.callback = callback
+        self._lock = threading.Lock()
+        self._completed = set()
+        self._journal = None
+        self._timings = {}
+
+    def _signature(self):
+        """Return list identifying the tiles of the montage (stored in the checkpoint)."""
+        return [[tile["index"], round(tile["x"] * 1e9), round(tile["y"] * 1e9)] for tile in self.tiles]
+
+    def load_checkpoint(self):
+        """
+        Load indices of completed tiles from the checkpoint file.
+
+        :returns: Set of completed tile indices (empty, if there is no checkpoint)
+        :raises ValueError: If the checkpoint belongs to a montage with other tiles
+        """
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            return set()
+        with open(self.checkpoint, "r") as fp:
+            header = json.loads(fp.readline())
+            if header.get("tiles") != self._signature():
+                raise ValueError("Checkpoint '%s' belongs to a different montage." % self.checkpoint)
+            completed = set(header.get("completed", ()))
+            for line in fp:
+                if not line.endswith("\n"):
+                    # Incomplete last line
+                    break
+                completed.add(int(line))
+        return completed
+
+    def _open_journal(self):
+        """Open checkpoint for appending, a new checkpoint (with header) is created atomically."""
+        if not os.path.exists(self.checkpoint):
+            temp_name = self.checkpoint + ".tmp"
+            with open(temp_name, "w") as fp:
+                fp.write(json.dumps({"tiles": self._signature()}) + "\n")
+            os.replace(temp_name, self.checkpoint)
+        else:
+            # Remove incomplete last line
+            with open(self.checkpoint, "r+b") as fp:
+                data = fp.read()
+                if not data.endswith(b"\n"):
+                    fp.truncate(data.rfind(b"\n") + 1)
+        return open(self.checkpoint, "a")
+
+    @property
+    def completed(self):
+        """Set of indices of tiles written."""
+        with self._lock:
+            return set(self._completed)
+
+    def run(self):
+        """
+        Acquire all tiles not completed yet.
+
+        :returns: List of metadata dicts of the tiles acquired by this call
+        """
+        self._completed = self.load_checkpoint()
+        remaining = [tile for tile in self.tiles if tile["index"] not in self._completed]
+        self._timings = {}
+        frames = []
+        if not remaining:
+            return frames
+
+        start_total = time.perf_counter()
+        if self.checkpoint is not None:
+            self._journal = self._open_journal()
+        pipeline = Pipeline(self._write, workers=self.workers, max_pending=self.max_pending)
+        try:
+            move = self.microscope.set_stage_position(x=remaining[0]["x"], y=remaining[0]["y"], wait=False)
+            for index, tile in enumerate(remaining):
+                start = time.perf_counter()
+                move.result()
+                self._time("move_wait", start)
+                settle(self.microscope, self.settle_time)
+
+                start = time.perf_counter()
+                state = self.microscope.get_state(fields=self.metadata_fields) if self.metadata_fields else {}
+                self._time("metadata", start)
+
+                timestamp = time.time()
+                start = time.perf_counter()
+                images = self.microscope.acquire(*self.detectors)
+                self._time("acquire", start)
+
+                # Start moving to the next tile, while the frame is written
+                if index + 1 < len(remaining):
+                    following = remaining[index + 1]
+                    move = self.microscope.set_stage_position(x=following["x"], y=following["y"], wait=False)
+
+                metadata = {
+                    "tile": tile,
+                    "time": timestamp,
+                    "state": state
+                }
+                frames.append(metadata)
+                if self.callback is not None:
+                    self.callback(metadata)
+                pipeline.submit(tile, images, metadata)
+        finally:
+            try:
+                pipeline.close()
+            finally:
+                if self._journal is not None:
+                    self._journal.close()
+                    self._journal = None
+                with self._lock:
+                    self._timings["write_wait"] = pipeline.wait_time
+                    self._timings["total"] = time.perf_counter() - start_total
+        return frames
+
+    def _time(self, phase, start):
+        duration = time.perf_counter() - start
+        with self._lock:
+            self._timings[phase] = self._timings.get(phase, 0.0) + duration
+
+    def _write(self, tile, images, metadata):
+        start = time.perf_counter()
+        if self.writer is None:
+            metadata["images"] = images
+        else:
+            self.writer(tile, images, metadata)
+        with self._lock:
+            self._completed.add(tile["index"])
+            if self._journal is not None:
+                self._journal.write("%d\n" % tile["index"])
+                self._journal.flush()
+            self._timings["write"] = self._timings.get("write", 0.0) + time.perf_counter() - start
+
+    def statistics(self):
+        """
+        Return dict with the accumulated times (in seconds) of the last run (see :meth:`TiltSeries.statistics`).
+        """
+        with self._lock:
+            return dict(self._timings)
+
+
+def image_shift_offsets(matrix, image_shape, rows=3, cols=3, overlap=0.1):
+    """
+    Return image shift offsets of a local montage of *rows* x *cols* tiles centered on the current image.
+
+    The tiles are returned in serpentine order as dicts with the keys "row", "col", and "shift" ((x, y) change of
+    the image shift in meters).
+
+    :param matrix: Calibration matrix converting image shift in meters to (x, y) pixels
+        (see :class:`ImageShiftCalibration`)
+    :param image_shape: (rows, columns) shape of the images
+    :param rows: Number of rows
+    :type rows: int
+    :param cols: Number of columns
+    :type cols: int
+    :param overlap: Overlap of adjacent tiles as fraction of the image size
+    :type overlap: float
+
+    .. versionadded:: 2.2.0
+    """
+    if not 0.0 <= overlap < 1.0:
+        raise ValueError("Overlap must be within [0, 1).")
+    height, width = image_shape
+    inverse = np.linalg.inv(np.asarray(matrix, dtype=float))
+    offsets = []
+    for row in range(rows):
+        columns = range(cols) if row % 2 == 0 else reversed(range(cols))
+        for col in columns:
+            pixels = np.array([(col - 0.5 * (cols - 1)) * width * (1.0 - overlap),
+                               (row - 0.5 * (rows - 1)) * height * (1.0 - overlap)])
+            offsets.append({"row": row, "col": col, "shift": tuple(float(value) for value in inverse.dot(pixels))})
+    return offsets
+
+
+class ImageShiftMontage:
+    """
+    Pipelined acquisition of small local montages using the image shift.
+
+    For each target the stage is moved to the target, then *rows* x *cols* tiles around it are acquired by changing
+    the image shift (the beam shift in STEM mode), which is much faster than moving the stage. The stage only moves
+    between the targets, overlapped with writing the frames of the previous target. The image shift is restored
+    after the montage.
+
+    The offsets of the tiles are computed from the calibration of the image shift for the current magnification
+    and *detector*, which is measured once at the first target and cached by *calibration*
+    (see :class:`ImageShiftCalibration`).
+
+    The *writer* is called as ``writer(tile, images, metadata)`` like for :class:`Montage`. The tile dicts have the
+    keys "index", "target" (index of target), "row", "col", "x", "y" (stage position of the target), and "shift"
+    (image shift of the tile).
+
+    :param microscope: Microscope
+    :type microscope: BaseMicroscope
+    :param detector: Name of detector to acquire
+    :type detector: str
+    :param targets: (x, y) stage positions in meters, e.g. ordered by :func:`order_tiles`. Defaults to the current
+        stage position.
+    :param rows: Number of rows of each local montage
+    :type rows: int
+    :param cols: Number of columns of each local montage
+    :type cols: int
+    :param overlap: Overlap of adjacent tiles as fraction of the image size
+    :type overlap: float
+    :param calibration: Calibration cache (a new one is created, if omitted)
+    :type calibration: Optional[ImageShiftCalibration]
+    :param writer: Callable writing the frames
+    :param settle_time: Time in seconds to wait after the stage arrived (in clock time for a simulated microscope)
+    :type settle_time: float
+    :param shift_settle_time: Time in seconds to wait after changing the image shift (in clock time for a simulated
+        microscope)
+    :type shift_settle_time: float
+    :param max_shift: Maximum absolute image shift in meters (per axis)
+    :type max_shift: Optional[float]
+    :param metadata_fields: State fields recorded for each frame
+    :type metadata_fields: Iterable[str]
+    :param workers: Number of writer threads
+    :type workers: int
+    :param max_pending: Maximum number of frames waiting for the writers
+    :type max_pending: int
+    :param callback: Optional callable called with the metadata dict after each acquisition
+
+    Usage:
+
+        >>> montage = ImageShiftMontage(microscope, "BM-Ceta", targets, rows=5, cols=5, writer=write_tile,
+        ...                             calibration=ImageShiftCalibration("image_shift.json"))
+        >>> montage.run()
+
+    .. versionadded:: 2.2.0
+    """
+    def __init__(self, microscope, detector, targets=None, rows=3, cols=3, overlap=0.1, calibration=None,
+                 writer=None, settle_time=0.0, shift_settle_time=0.0, max_shift=None,
+                 metadata_fields=DEFAULT_METADATA_FIELDS, workers=2, max_pending=4, callback=None):
+        self.microscope = microscope
+        self.detector = detector
+        self.targets = [tuple(target) for target in targets] if targets is not None else None
+        self.rows = int(rows)
+        self.cols = int(cols)
+        self.overlap = float(overlap)
+        self.calibration = calibration if calibration is not None else ImageShiftCalibration()
+        self.writer = writer
+        self.settle_time = float(settle_time)
+        self.shift_settle_time = float(shift_settle_time)
+        self.max_shift = max_shift
+        self.metadata_fields = list(metadata_fields) if metadata_fields is not None else []
+        self.workers = int(workers)
+        self.max_pending = int(max_pending)
+        self.callback = callback
+        self._lock = threading.Lock()
+        self._timings = {}
+
+    def _time(self, phase, start):
+        duration = time.perf_counter() - start
+        with self._lock:
+            self._timings[phase] = self._timings.get(phase, 0.0) + duration
+
+    def offsets(self):
+        """Return image shift offsets of the tiles (see :func:`image_shift_offsets`), measures the calibration."""
+        matrix = self.calibration.get(self.microscope, self.detector)
+        shape = self.calibration.image_shape(self.microscope, self.detector)
+        return image_shift_offsets(matrix, shape, self.rows, self.cols, self.overlap)
+
+    def run(self):
+        """
+        Acquire the montages of all targets.
+
+        :returns: List of metadata dicts of the frames
+        """
+        self._timings = {}
+        frames = []
+        start_total = time.perf_counter()
+        deflector = ImageShiftCalibration.deflector(self.microscope)
+        set_shift = getattr(self.microscope, "set_" + deflector)
+        origin = np.array(getattr(self.microscope, "get_" + deflector)(), dtype=float)
+        targets = self.targets
+        if targets is None:
+            position = self.microscope.get_stage_position()
+            targets = [(position["x"], position["y"])]
+            move = StageMoveHandle.completed()
+        else:
+            move = self.microscope.set_stage_position(x=targets[0][0], y=targets[0][1], wait=False)
+
+        pipeline = Pipeline(self._write, workers=self.workers, max_pending=self.max_pending)
+        try:
+            offsets = None
+            index = 0
+            for target_index, target in enumerate(targets):
+                start = time.perf_counter()
+                move.result()
+                self._time("move_wait", start)
+                settle(self.microscope, self.settle_time)
+
+                if offsets is None:
+                    start = time.perf_counter()
+                    offsets = self.offsets()
+                    self._time("calibration", start)
+                    if self.max_shift is not None:
+                        limit = max(abs(origin + offset["shift"]).max() for offset in offsets)
+                        if limit > self.max_shift:
+                            raise ValueError("Image shift of %g m exceeds maximum of %g m." % (limit, self.max_shift))
+
+                for offset_index, offset in enumerate(offsets):
+                    shift = tuple(float(value) for value in origin + offset["shift"])
+                    start = time.perf_counter()
+                    set_shift(shift)
+                    settle(self.microscope, self.shift_settle_time)
+                    self._time("shift", start)
+
+                    start = time.perf_counter()
+                    state = self.microscope.get_state(fields=self.metadata_fields) if self.metadata_fields else {}
+                    self._time("metadata", start)
+
+                    timestamp = time.time()
+                    start = time.perf_counter()
+                    images = self.microscope.acquire(self.detector)
+                    self._time("acquire", start)
+
+                    # After the last tile, start moving to the next target, while the frames are written
+                    if offset_index + 1 == len(offsets) and target_index + 1 < len(targets):
+                        following = targets[target_index + 1]
+                        move = self.microscope.set_stage_position(x=following[0], y=following[1], wait=False)
+
+                    tile = {
+                        "index": index,
+                        "target": target_index,
+                        "row": offset["row"],
+                        "col": offset["col"],
+                        "x": target[0],
+                        "y": target[1],
+                        "shift": shift
+                    }
+                    metadata = {
+                        "tile": tile,
+                        "time": timestamp,
+                        "state": state
+                    }
+                    frames.append(metadata)
+                    if self.callback is not None:
+                        self.callback(metadata)
+                    pipeline.submit(tile, images, metadata)
+                    index += 1
+        finally:
+            try:
+                set_shift(tuple(origin))
+            finally:
+                pipeline.close()
+                with self._lock:
+                    self._timings["write_wait"] = pipeline.wait_time
+                    self._timings["total"] = time.perf_counter() - start_total
+        return frames
+
+    def _write(self, tile, images, metadata):
+        start = time.perf_counter()
+        if self.writer is None:
+            metadata["images"] = images
+        else:
+            self.writer(tile, images, metadata)
+        self._time("write", start)
+
+    def statistics(self):
+        """
+        Return dict with the accumulated times (in seconds) of the last run (see :meth:`TiltSeries.statistics`).
+        Additional keys are "calibration" (measuring the calibration) and "shift" (changing the image shift).
+        """
+        with self._lock:
+            return dict(self._timings)
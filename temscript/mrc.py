@@ -0,0 +1,341 @@
+import math
+import os
+import threading
+import time
+
+import numpy as np
+
+from .version import __version__
+
+
+MRC_HEADER_SIZE = 1024
+MRC_LABEL_SIZE = 80
+
+# MRC modes by numpy dtype
+_MODES = {
+    np.dtype(np.int8): 0,
+    np.dtype(np.int16): 1,
+    np.dtype(np.float32): 2,
+    np.dtype(np.uint16): 6,
+    np.dtype(np.float16): 12,
+}
+_DTYPES = {mode: dtype for dtype, mode in _MODES.items()}
+
+# Dtypes converted before writing
+_CONVERSIONS = {
+    np.dtype(np.uint8): np.dtype(np.uint16),
+    np.dtype(np.int32): np.dtype(np.float32),
+    np.dtype(np.uint32): np.dtype(np.float32),
+    np.dtype(np.float64): np.dtype(np.float32),
+}
+
+# Extended header in IMOD "SERI" format: tilt angle (flag 1) and stage position (flag 4) per section
+_EXT_FLAGS = 1 | 4
+_EXT_SECTION_DTYPE = np.dtype([("tilt", "<i2"), ("stage", "<i2", (2,))])
+
+
+def _sum_of_squares(frame, chunk_size=1 << 18):
+    """Return sum of squared values of *frame* in float64, converting at most *chunk_size* values at once."""
+    values = frame.reshape(-1)
+    total = 0.0
+    for start in range(0, values.size, chunk_size):
+        chunk = values[start:start + chunk_size].astype(np.float64)
+        total += float(np.dot(chunk, chunk))
+    return total
+
+
+class MrcWriter:
+    """
+    Writes frames incrementally into a MRC (2014) stack.
+
+    The frames are appended to the memory mapped file, which is preallocated for *capacity* frames and grows if
+    required. The header (number of sections and the statistics minimum, maximum, mean, and RMS) is updated after
+    each frame from the statistics of this frame, the written data is never read again. Thus the file is valid at any
+    time. :meth:`close` removes the unused capacity.
+
+    The tilt angle and the stage position of each frame are stored in the extended header (IMOD "SERI" format), which
+    is reserved for *max_sections* frames. If a *microscope* is given, the acceleration voltage is stored as label.
+    The *pixel_size* defines the cell dimensions.
+
+    Supported dtypes are int8, int16, uint16, float16, and float32. Frames of uint8 are stored as uint16, frames of
+    other dtypes as float32.
+
+    The writer can be used as *writer* of the acquisition engines (e.g. :class:`TiltSeries`), then the image of
+    *detector* (defaults to the only image) is stored, with the tilt angle and stage position of the recorded state.
+
+    :param filename: Name of MRC file
+    :type filename: str
+    :param pixel_size: Optional pixel size in meters
+    :type pixel_size: Optional[float]
+    :param microscope: Optional microscope to read the voltage from
+    :type microscope: Optional[BaseMicroscope]
+    :param detector: Detector written if used as writer of acquisition engines
+    :type detector: Optional[str]
+    :param labels: Additional labels (at most 80 characters each)
+    :type labels: Iterable[str]
+    :param capacity: Number of preallocated frames
+    :type capacity: int
+    :param max_sections: Maximum number of frames with tilt angles and stage positions
+    :type max_sections: int
+
+    Usage:
+
+        >>> with MrcWriter("tomo.mrc", pixel_size=2e-10, microscope=microscope) as writer:
+        ...     TiltSeries(microscope, "BM-Ceta", dose_symmetric_angles(60, 3), writer=writer).run()
+
+    .. versionadded:: 2.2.0
+    """
+    def __init__(self, filename, pixel_size=None, microscope=None, detector=None, labels=(), capacity=64,
+                 max_sections=1024):
+        self.filename = filename
+        self.pixel_size = pixel_size
+        self.detector = detector
+        self.capacity = max(int(capacity), 1)
+        self.max_sections = int(max_sections)
+        self.labels = ["temscript %s, %s" % (__version__, time.strftime("%Y-%m-%d %H:%M:%S"))]
+        if microscope is not None:
+            self.labels.append("voltage %g kV" % microscope.get_voltage())
+        self.labels.extend(labels)
+        if len(self.labels) > 10:
+            raise ValueError("At most 10 labels are supported.")
+
+        self._lock = threading.Lock()
+        self._fp = open(filename, "w+b")
+        self._map = None
+        self._dtype = None
+        self._shape = None
+        self._count = 0
+        self._ext_size = self.max_sections * _EXT_SECTION_DTYPE.itemsize
+        self._data_offset = MRC_HEADER_SIZE + self._ext_size
+        self._extended = np.zeros(self.max_sections, dtype=_EXT_SECTION_DTYPE)
+        self._min = float("inf")
+        self._max = float("-inf")
+        self._sum = 0.0
+        self._sum2 = 0.0
+
+    @property
+    def count(self):
+        """Number of written frames."""
+        with self._lock:
+            return self._count
+
+    def _header(self):
+        """Return header for the current state."""
+        header = np.zeros(MRC_HEADER_SIZE // 4, dtype="<i4")
+        floats = header.view("<f4")
+        rows, cols = self._shape
+        header[0:3] = (cols, rows, self._count)
+        header[3] = _MODES[self._dtype]
+        header[7:10] = (cols, rows, max(self._count, 1))
+        if self.pixel_size is not None:
+            angstrom = self.pixel_size * 1e10
+            floats[10:13] = (cols * angstrom, rows * angstrom, max(self._count, 1) * angstrom)
+        floats[13:16] = 90.0
+        header[16:19] = (1, 2, 3)
+        if self._count:
+            pixels = float(self._count) * rows * cols
+            mean = self._sum / pixels
+            floats[19:22] = (self._min, self._max, mean)
+            floats[54] = math.sqrt(max(self._sum2 / pixels - mean * mean, 0.0))
+        else:
+            floats[19:22] = (0.0, -1.0, -2.0)    # Statistics not determined
+            floats[54] = -1.0
+        header[23] = self._ext_size
+        raw = header.view(np.uint8)
+        raw[104:108] = np.frombuffer(b"SERI", dtype=np.uint8)
+        header[27] = 20140
+        raw[128:132] = np.array([_EXT_SECTION_DTYPE.itemsize, _EXT_FLAGS], dtype="<i2").view(np.uint8)
+        raw[208:212] = np.frombuffer(b"MAP ", dtype=np.uint8)
+        raw[212:216] = (0x44, 0x44, 0x00, 0x00)     # Little endian
+        header[55] = len(self.labels)
+        for index, label in enumerate(self.labels):
+            text = label.encode("ascii", "replace")[:MRC_LABEL_SIZE].ljust(MRC_LABEL_SIZE)
+            offset = 224 + index * MRC_LABEL_SIZE
+            raw[offset:offset + MRC_LABEL_SIZE] = np.frombuffer(text, dtype=np.uint8)
+        return header.tobytes()
+
+    def _start(self, frame):
+        dtype = _CONVERSIONS.get(frame.dtype, frame.dtype)
+        if dtype not in _MODES:
+            raise ValueError("Unsupported dtype for MRC files: %s" % frame.dtype)
+        self._dtype = dtype
+        self._shape = frame.shape
+        self._frame_size = dtype.itemsize * frame.shape[0] * frame.shape[1]
+        self._fp.truncate(self._data_offset + self.capacity * self._frame_size)
+        self._map = self._open_map()
+
+    def _open_map(self):
+        return np.memmap(self._fp, dtype=self._dtype, mode="r+", offset=self._data_offset,
+                         shape=(self.capacity,) + self._shape)
+
+    def append(self, frame, tilt_angle=None, stage_position=None):
+        """
+        Append *frame*.
+
+        :param frame: Image
+        :type frame: numpy.ndarray
+        :param tilt_angle: Optional tilt angle in degrees
+        :type tilt_angle: Optional[float]
+        :param stage_position: Optional stage position dict (in meters), as returned by
+            :meth:`BaseMicroscope.get_stage_position`. If *tilt_angle* is None, the tilt angle is taken from the
+            "a" axis.
+        :type stage_position: Optional[Dict[str, float]]
+        """
+        frame = np.asarray(frame)
+        if frame.ndim != 2:
+            raise ValueError("Frames must be 2D arrays.")
+        with self._lock:
+            if self._fp is None:
+                raise ValueError("Writer is closed.")
+            if self._shape is None:
+                self._start(frame)
+            elif frame.shape != self._shape:
+                raise ValueError("Frame shape %s doesn't match shape %s." % (frame.shape, self._shape))
+            if self._count >= self.capacity:
+                self._map.flush()
+                self._map = None
+                self.capacity *= 2
+                self._fp.truncate(self._data_offset + self.capacity * self._frame_size)
+                self._map = self._open_map()
+
+            section = self._map[self._count]
+            section[...] = frame
+            self._min = min(self._min, float(frame.min()))
+            self._max = max(self._max, float(frame.max()))
+            self._sum += float(frame.sum(dtype=np.float64))
+            self._sum2 += _sum_of_squares(frame)
+
+            if self._count < self.max_sections:
+                if tilt_angle is None and stage_position is not None and "a" in stage_position:
+                    tilt_angle = math.degrees(stage_position["a"])
+                entry = self._extended[self._count]
+                if tilt_angle is not None:
+                    entry["tilt"] = int(round(tilt_angle * 100.0))
+                if stage_position is not None:
+                    entry["stage"] = [int(np.clip(round(stage_position.get(axis, 0.0) * 1e6 * 25.0), -32768, 32767))
+                                      for axis in ("x", "y")]
+                self._fp.seek(MRC_HEADER_SIZE + self._count * _EXT_SECTION_DTYPE.itemsize)
+                self._fp.write(entry.tobytes())
+
+            self._count += 1
+            # Update header after the data was written
+            self._fp.seek(0)
+            self._fp.write(self._header())
+
+    def acquire(self, microscope, detector):
+        """
+        Acquire *detector* and append the image with the current stage position.
+
+        :returns: The image
+        """
+        stage_position = microscope.get_stage_position()
+        image = microscope.acquire(detector)[detector]
+        self.append(image, stage_position=stage_position)
+        return image
+
+    def __call__(self, key, images, metadata):
+        # Writer interface of the acquisition engines
+        if self.detector is not None:
+            image = images[self.detector]
+        elif len(images) == 1:
+            image = next(iter(images.values()))
+        else:
+            raise ValueError("Detector must be given for acquisitions of several detectors.")
+        stage_position = metadata.get("state", {}).get("stage_position")
+        self.append(image, tilt_angle=metadata.get("angle(deg)"), stage_position=stage_position)
+
+    def statistics(self):
+        """Return dict with the "min", "max", "mean", and "rms" of all written frames (as stored in the header)."""
+        with self._lock:
+            if not self._count:
+                return {}
+            pixels = float(self._count) * self._shape[0] * self._shape[1]
+            mean = self._sum / pixels
+            return {"min": self._min, "max": self._max, "mean": mean,
+                    "rms": math.sqrt(max(self._sum2 / pixels - mean * mean, 0.0))}
+
+    def flush(self):
+        """Flush written frames to disk."""
+        with self._lock:
+            if self._map is not None:
+                self._map.flush()
+            if self._fp is not None:
+                self._fp.flush()
+
+    def close(self):
+        """Close file, the unused capacity is removed."""
+        with self._lock:
+            if self._fp is None:
+                return
+            if self._map is not None:
+                self._map.flush()
+                self._map = None
+            if self._shape is None:
+                # No frames, remove empty file
+                self._fp.close()
+                self._fp = None
+                os.remove(self.filename)
+                return
+            self._fp.truncate(self._data_offset + self._count * self._frame_size)
+            self._fp.close()
+            self._fp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def load_mrc(filename, mmap_mode="r"):
+    """
+    Load MRC stack, e.g. written by :class:`MrcWriter`.
+
+    :param filename: Name of MRC file
+    :type filename: str
+    :param mmap_mode: Memory mapping mode (see :func:`numpy.memmap`), None to read the data into memory
+    :type mmap_mode: Optional[str]
+    :returns: Tuple (data, header dict). The header dict has the keys "shape", "mode", "pixel_size" (in meters, None
+        if unknown), "min", "max", "mean", "rms", "labels", and "tilt_angles" (in degrees, if present in the
+        extended header).
+
+    .. versionadded:: 2.2.0
+    """
+    with open(filename, "rb") as fp:
+        raw = np.frombuffer(fp.read(MRC_HEADER_SIZE), dtype=np.uint8)
+    if len(raw) < MRC_HEADER_SIZE or bytes(raw[208:211]) != b"MAP":
+        raise ValueError("File '%s' is not a MRC file." % filename)
+    header = raw.view("<i4")
+    floats = raw.view("<f4")
+    cols, rows, sections = [int(value) for value in header[0:3]]
+    mode = int(header[3])
+    if mode not in _DTYPES:
+        raise ValueError("Unsupported MRC mode: %d" % mode)
+    ext_size = int(header[23])
+    labels = [bytes(raw[224 + n * MRC_LABEL_SIZE:224 + (n + 1) * MRC_LABEL_SIZE]).decode("ascii").rstrip()
+              for n in range(int(header[55]))]
+    result = {
+        "shape": (sections, rows, cols),
+        "mode": mode,
+        "pixel_size": float(floats[10]) / cols * 1e-10 if floats[10] > 0.0 else None,
+        "min": float(floats[19]),
+        "max": float(floats[20]),
+        "mean": float(floats[21]),
+        "rms": float(floats[54]),
+        "labels": labels
+    }
+    nint, nreal = [int(value) for value in raw[128:132].view("<i2")]
+    if bytes(raw[104:108]) == b"SERI" and nreal & 1 and nint > 0 and ext_size >= nint * sections:
+        with open(filename, "rb") as fp:
+            fp.seek(MRC_HEADER_SIZE)
+            extended = np.frombuffer(fp.read(nint * sections), dtype=np.uint8).reshape(sections, nint)
+        result["tilt_angles"] = extended[:, 0:2].copy().view("<i2").ravel() / 100.0
+
+    offset = MRC_HEADER_SIZE + ext_size
+    dtype = _DTYPES[mode]
+    if mmap_mode is None:
+        data = np.fromfile(filename, dtype=dtype, count=sections * rows * cols, offset=offset)
+        data = data.reshape(sections, rows, cols)
+    else:
+        data = np.memmap(filename, dtype=dtype, mode=mmap_mode, offset=offset, shape=(sections, rows, cols))
+    return data, result
@@ -1,10 +1,16 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from enum import Enum
+from functools import wraps
 
 import numpy as np
 from math import pi
 
 from .enums import *
-from .base_microscope import BaseMicroscope, parse_enum
+from .base_microscope import BaseMicroscope, parse_enum, STATE_FIELDS
+from .simulation import make_clock
+from .specimen import SyntheticSpecimen
+from .stage_move import StageMoveHandle
 
 
 def try_update(dest, source, key, cast=None, min_value=None, max_value=None, ignore_errors=False):
@@ -47,6 +53,19 @@ def try_update_enum(dest, source, key, enum_type, ignore_errors=False):
     return True
 
 
+def simulated(method):
+    """Decorator for methods of :class:`NullMicroscope`, which applies the latency profile before each call."""
+    method_name = method.__name__
+
+    @wraps(method)
+    def wrapper(self, *args, **kw):
+        if self._latency_profile is not None:
+            self._latency_profile.simulate_call(method_name, self._clock)
+        return method(self, *args, **kw)
+
+    return wrapper
+
+
 def unpack_enums(mapping):
     result = {}
     for key, value in mapping.items():
@@ -65,6 +84,36 @@ class NullMicroscope(BaseMicroscope):
     :type wait_exposure: bool
     :param voltage: High tension value the microscope report in kV
     :type voltage: float
+    :param latency_profile: Latencies and injected faults of the calls, see :class:`LatencyProfile`. If omitted, all
+        calls (except for the exposure time of acquisitions) return immediately.
+    :type latency_profile: Optional[LatencyProfile]
+    :param clock: Clock all simulated delays (exposures, stage movements, latencies) are waited on. Either a clock
+        instance (see :class:`RealClock`, :class:`ScaledClock`, and :class:`VirtualClock`), "real" (default),
+        "virtual", or a number, which is the speed up factor of a :class:`ScaledClock`.
+    :type clock: Union[RealClock, ScaledClock, VirtualClock, str, float, None]
+    :param specimen: Specimen model used to render the acquired images. If omitted, a :class:`SyntheticSpecimen`
+        with default parameters is used.
+    :type specimen: Optional[SyntheticSpecimen]
+    :param cameras: Simulated cameras as dict indexed by camera name. The values are dicts with the optional keys
+        "width", "height" (size in pixels), "dtype" (numpy data type of the images, like "uint16"),
+        "pixel_size(um)", and "binnings". Missing keys are taken from :attr:`DEFAULT_CAMERA`. If omitted, a single
+        camera "CCD" is simulated.
+    :type cameras: Optional[Dict[str, Dict]]
+    :param stem_detectors: Simulated STEM detectors as dict indexed by detector name. The values are dicts with the
+        optional keys "dtype" and "binnings". Missing keys are taken from :attr:`DEFAULT_STEM_DETECTOR`. If omitted,
+        no STEM detectors are simulated and STEM is not available.
+    :type stem_detectors: Optional[Dict[str, Dict]]
+    :param frame_pool: If given, the acquired images are stored in buffers recycled by this pool instead of newly
+        allocated arrays. See :class:`FramePool` for details.
+    :type frame_pool: Optional[FramePool]
+
+    All cameras and STEM detectors passed to :meth:`acquire` are acquired simultaneously. The call takes the
+    longest exposure time of the cameras or the scan time of the STEM detectors (dwell time times number of pixels),
+    respectively. STEM detectors are only acquired in STEM mode, unknown detectors are ignored.
+
+    .. versionchanged:: 2.2.0
+        *latency_profile*, *clock*, *specimen*, *cameras*, *stem_detectors*, and *frame_pool* keywords added.
+        Acquired images show a synthetic specimen instead of zeros.
     """
     STAGE_XY_RANGE = 1e-3       # meters
     STAGE_Z_RANGE = 0.3e-3      # meters
@@ -73,23 +122,73 @@ class NullMicroscope(BaseMicroscope):
     CCD_SIZE = 2048
     CCD_BINNINGS = [1, 2, 4, 8]
 
+    DEFAULT_CAMERA = {
+        "width": CCD_SIZE,
+        "height": CCD_SIZE,
+        "dtype": "int16",
+        "pixel_size(um)": 24.0,
+        "binnings": CCD_BINNINGS
+    }
+
+    STEM_SCAN_SIZE = 1024
+    STEM_PIXEL_SIZE = 24e-6     # meters, divided by STEM magnification gives scan pixel size on specimen
+    STEM_DOSE_RATE = 1e8        # Counts per second on STEM detectors
+
+    DEFAULT_STEM_DETECTOR = {
+        "dtype": "uint16",
+        "binnings": [1, 2, 4, 8]
+    }
+
+    STATE_READ_WORKERS = 8      # Number of threads reading state fields concurrently with latency profile
+
     NORMALIZATION_MODES = ("SPOTSIZE", "INTENSITY", "CONDENSER", "MINI_CONDENSER", "OBJECTIVE", "PROJECTOR",
                            "OBJECTIVE_CONDENSER", "OBJECTIVE_PROJECTOR", "ALL")
 
-    def __init__(self, wait_exposure=None, voltage=200.0):
+    def __init__(self, wait_exposure=None, voltage=200.0, latency_profile=None, clock=None, specimen=None,
+                 cameras=None, stem_detectors=None, frame_pool=None):
+        self._latency_profile = latency_profile
+        self._frame_pool = frame_pool
+        # Pool reading state fields concurrently, only useful with latencies
+        self._state_executor = None
+        if latency_profile is not None:
+            self._state_executor = ThreadPoolExecutor(max_workers=self.STATE_READ_WORKERS)
+        self._clock = make_clock(clock)
+        self._specimen = specimen if specimen is not None else SyntheticSpecimen()
         self._column_valves = False
         self._stage_pos = {'x': 0.0, 'y': 0.0, 'z': 0.0, 'a': 0.0, 'b': 0.0}
+        self._stage_status = StageStatus.READY
         self._wait_exposure = bool(wait_exposure) if wait_exposure is not None else True
-        self._ccd_param = {
-            "image_size": AcqImageSize.FULL,
-            "exposure(s)": 1.0,
-            "binning": 1,
-            "correction": AcqImageCorrection.DEFAULT,
-            "exposure_mode": AcqExposureMode.NONE,
-            "shutter_mode": AcqShutterMode.POST_SPECIMEN,
-            "pre_exposure(s)": 0.0,
-            "pre_exposure_pause(s)": 0.0
-        }
+        if cameras is None:
+            cameras = {"CCD": {}}
+        self._cameras = {}
+        self._camera_param = {}
+        for name, config in cameras.items():
+            camera = dict(self.DEFAULT_CAMERA)
+            camera.update(config)
+            camera["dtype"] = np.dtype(camera["dtype"])
+            self._cameras[name] = camera
+            self._camera_param[name] = {
+                "image_size": AcqImageSize.FULL,
+                "exposure(s)": 1.0,
+                "binning": 1,
+                "correction": AcqImageCorrection.DEFAULT,
+                "exposure_mode": AcqExposureMode.NONE,
+                "shutter_mode": AcqShutterMode.POST_SPECIMEN,
+                "pre_exposure(s)": 0.0,
+                "pre_exposure_pause(s)": 0.0
+            }
+        self._stem_detectors = {}
+        self._stem_detector_param = {}
+        for name, config in (stem_detectors or {}).items():
+            detector = dict(self.DEFAULT_STEM_DETECTOR)
+            detector.update(config)
+            detector["dtype"] = np.dtype(detector["dtype"])
+            self._stem_detectors[name] = detector
+            self._stem_detector_param[name] = {
+                "brightness": 0.5,
+                "contrast": 0.5
+            }
+        self._instrument_mode = InstrumentMode.TEM
         self._stem_acq_param = {
             "image_size": AcqImageSize.FULL,
             "dwell_time(s)": 1e-6,
@@ -119,20 +218,59 @@ class NullMicroscope(BaseMicroscope):
         self._dark_field_mode = DarkFieldMode.OFF
         self._beam_blanked = False
 
+    @property
+    def clock(self):
+        """Clock used for all simulated delays."""
+        return self._clock
+
+    @property
+    def frame_pool(self):
+        """Pool of image buffers (`None` if acquired images are not pooled)."""
+        return self._frame_pool
+
+    def close(self):
+        """
+        Release the threads reading state fields concurrently. Afterwards fields are read one after the other.
+
+        .. versionadded:: 2.2.0
+        """
+        executor, self._state_executor = self._state_executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _read_state_fields(self, fields):
+        # Without latencies, reading concurrently has no benefit
+        executor = self._state_executor
+        if executor is None or len(fields) < 2:
+            return super(NullMicroscope, self)._read_state_fields(fields)
+        futures = {field: executor.submit(getattr(self, STATE_FIELDS[field])) for field in fields}
+        return {field: future.result() for field, future in futures.items()}
+
+    @simulated
     def get_family(self):
         return "NULL"
 
+    @simulated
     def get_microscope_id(self):
         import socket
         return socket.gethostname()
 
+    @simulated
     def get_version(self):
         from .version import __version__
         return __version__
 
+    @simulated
     def get_voltage(self):
         return self._voltage
 
+    @simulated
     def get_vacuum(self):
         return {
             "status": VacuumStatus.READY.name,
@@ -141,19 +279,27 @@ class NullMicroscope(BaseMicroscope):
             "gauges(Pa)": {},
         }
 
+    @simulated
     def get_column_valves_open(self):
         return self._column_valves
 
+    @simulated
     def set_column_valves_open(self, state):
         self._column_valves = bool(state)
 
+    @simulated
     def get_stage_holder(self):
         return StageHolderType.SINGLE_TILT.name
 
+    @simulated
     def get_stage_status(self):
-        return StageStatus.READY.name
+        return self._stage_status.name
 
+    @simulated
     def get_stage_limits(self):
+        return self._stage_limits()
+
+    def _stage_limits(self):
         return {
             "x": (-self.STAGE_XY_RANGE, +self.STAGE_XY_RANGE),
             "y": (-self.STAGE_XY_RANGE, +self.STAGE_XY_RANGE),
@@ -162,106 +308,211 @@ class NullMicroscope(BaseMicroscope):
             "b": (-self.STAGE_AB_RANGE, +self.STAGE_AB_RANGE)
         }
 
+    @simulated
     def get_stage_position(self):
         return dict(self._stage_pos)
 
+    @simulated
     def _set_stage_position(self, pos=None, method="GO", speed=None):
         if method not in ["GO", "MOVE"]:
             raise ValueError("Unknown movement methods.")
-        limit = self.get_stage_limits()
+        limit = self._stage_limits()
+        new_pos = {}
         for key in self._stage_pos.keys():
             if key not in pos:
                 continue
             mn, mx = limit[key]
-            value = max(mn, min(mx, float(pos[key])))
-            self._stage_pos[key] = value
-
+            new_pos[key] = max(mn, min(mx, float(pos[key])))
+
+        if self._latency_profile is not None:
+            travel_time = self._latency_profile.stage_travel_time(self._stage_pos, new_pos, method=method, speed=speed)
+            if travel_time > 0.0:
+                self._stage_status = StageStatus.MOVING
+                try:
+                    self._clock.sleep(travel_time)
+                finally:
+                    self._stage_status = StageStatus.READY
+        self._stage_pos.update(new_pos)
+
+    def _start_stage_move(self, pos=None, method="GO", speed=None):
+        # Move stage in background thread
+        future = Future()
+
+        def move():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                self._set_stage_position(pos, method=method, speed=speed)
+            except BaseException as exc:
+                future.set_exception(exc)
+            else:
+                future.set_result(None)
+
+        thread = threading.Thread(target=move, name="temscript-stage-move")
+        thread.daemon = True
+        thread.start()
+        return StageMoveHandle(future)
+
+    @simulated
     def get_cameras(self):
-        return {
-            "CCD": {
+        cameras = {}
+        for name, camera in self._cameras.items():
+            cameras[name] = {
                 "type": "CAMERA",
-                "width": self.CCD_SIZE,
-                "height": self.CCD_SIZE,
-                "pixel_size(um)": 24,
-                "binnings": self.CCD_BINNINGS,
+                "width": camera["width"],
+                "height": camera["height"],
+                "pixel_size(um)": camera["pixel_size(um)"],
+                "binnings": list(camera["binnings"]),
                 "shutter_modes": ["POST_SPECIMEN"],
                 "pre_exposure_limits": (0.0, 0.0),
                 "pre_exposure_pause_limits": (0.0, 0.0),
             }
-        }
+        return cameras
 
+    @simulated
     def get_stem_detectors(self):
-        return {}
+        detectors = {}
+        for name, detector in self._stem_detectors.items():
+            detectors[name] = {
+                "type": "STEM_DETECTOR",
+                "binnings": list(detector["binnings"]),
+            }
+        return detectors
 
+    @simulated
     def get_camera_param(self, name):
-        if name == "CCD":
-            return unpack_enums(self._ccd_param)
-        else:
+        try:
+            return unpack_enums(self._camera_param[name])
+        except KeyError:
             raise KeyError("Unknown detector")
 
+    @simulated
     def set_camera_param(self, name, param, ignore_errors=False):
         # Not implemented: raise error on unknown keys in param
-        if name == "CCD":
-            param = dict(param)
-            try_update_enum(self._ccd_param, param, 'image_size', AcqImageSize, ignore_errors=ignore_errors)
-            try_update(self._ccd_param, param, 'exposure(s)', cast=float, min_value=0.0, ignore_errors=ignore_errors)
-            try_update(self._ccd_param, param, 'binning', cast=int, min_value=1, ignore_errors=ignore_errors)
-            try_update_enum(self._ccd_param, param, 'correction', AcqImageCorrection, ignore_errors=ignore_errors)
-        else:
-            raise TypeError("Unknown detector.")
+        try:
+            camera_param = self._camera_param[name]
+        except KeyError:
+            raise KeyError("Unknown detector")
+        param = dict(param)
+        try_update_enum(camera_param, param, 'image_size', AcqImageSize, ignore_errors=ignore_errors)
+        try_update(camera_param, param, 'exposure(s)', cast=float, min_value=0.0, ignore_errors=ignore_errors)
+        try_update(camera_param, param, 'binning', cast=int, min_value=1, ignore_errors=ignore_errors)
+        try_update_enum(camera_param, param, 'correction', AcqImageCorrection, ignore_errors=ignore_errors)
 
+    @simulated
     def get_stem_detector_param(self, name):
-        raise KeyError("Unknown detector")
+        try:
+            return dict(self._stem_detector_param[name])
+        except KeyError:
+            raise KeyError("Unknown detector")
 
+    @simulated
     def set_stem_detector_param(self, name, values, ignore_errors=False):
-        raise KeyError("Unknown detector")
+        try:
+            detector_param = self._stem_detector_param[name]
+        except KeyError:
+            raise KeyError("Unknown detector")
+        values = dict(values)
+        try_update(detector_param, values, 'brightness', cast=float, min_value=0.0, max_value=1.0,
+                   ignore_errors=ignore_errors)
+        try_update(detector_param, values, 'contrast', cast=float, min_value=0.0, max_value=1.0,
+                   ignore_errors=ignore_errors)
+        if not ignore_errors and values:
+            raise ValueError("Unknown keys in parameter dictionary.")
 
+    @simulated
     def get_stem_acquisition_param(self):
         return unpack_enums(self._stem_acq_param)
 
+    @simulated
     def set_stem_acquisition_param(self, param, ignore_errors=False):
         # Not implemented: raise error on unknown keys in param
         param = dict(param)
         try_update_enum(self._stem_acq_param, param, 'image_size', AcqImageSize, ignore_errors=ignore_errors)
         try_update(self._stem_acq_param, param, 'dwell_time(s)', cast=float, min_value=1e-9,
                    ignore_errors=ignore_errors)
-        try_update(self._stem_acq_param, param, 'image_size', cast=int, min_value=1, ignore_errors=ignore_errors)
+        try_update(self._stem_acq_param, param, 'binning', cast=int, min_value=1, ignore_errors=ignore_errors)
         if not ignore_errors and param:
             raise ValueError("Unknown keys in parameter dictionary.")
 
+    @simulated
     def acquire(self, *args):
         result = {}
-        detectors = set(args)
-        for det in detectors:
-            if det == "CCD":
-                size = self.CCD_SIZE // self._ccd_param["binning"]
-                if self._ccd_param["image_size"] == AcqImageSize.HALF:
-                    size //= 2
-                elif self._ccd_param["image_size"] == AcqImageSize.QUARTER:
-                    size //= 4
-                if self._wait_exposure:
-                    import time
-                    time.sleep(self._ccd_param["exposure(s)"])
-                result["CCD"] = np.zeros((size, size), dtype=np.int16)
+        duration = 0.0
+        stem_mode = self._instrument_mode == InstrumentMode.STEM
+        for det in set(args):
+            if det in self._cameras:
+                camera = self._cameras[det]
+                param = self._camera_param[det]
+                exposure = param["exposure(s)"]
+                shape = self._binned_shape((camera["height"], camera["width"]), param["binning"],
+                                           param["image_size"])
+                pixel_size = camera["pixel_size(um)"] * 1e-6 / max(self._magnification_index * 10000, 1)
+                result[det] = self._render_image((camera["height"], camera["width"]), pixel_size,
+                                                 param["binning"], shape, self._defocus,
+                                                 self._specimen.dose_rate * exposure, camera["dtype"])
+                duration = max(duration, exposure)
+            elif det in self._stem_detectors and stem_mode:
+                param = self._stem_acq_param
+                shape = self._binned_shape((self.STEM_SCAN_SIZE, self.STEM_SCAN_SIZE), param["binning"],
+                                           param["image_size"])
+                pixel_size = self.STEM_PIXEL_SIZE / max(self._stem_magnification, 1.0)
+                dwell_time = param["dwell_time(s)"]
+                binning = param["binning"]
+                result[det] = self._render_image(self.STEM_SCAN_SIZE, pixel_size * binning, 1, shape,
+                                                 self._probe_defocus, self.STEM_DOSE_RATE * dwell_time,
+                                                 self._stem_detectors[det]["dtype"])
+                duration = max(duration, dwell_time * shape[0] * shape[1])
+        if self._wait_exposure:
+            self._clock.sleep(duration)
         return result
 
+    @staticmethod
+    def _binned_shape(shape, binning, image_size):
+        """Return shape of the acquired image for detector *shape*, *binning*, and *image_size*."""
+        shape = shape[0] // binning, shape[1] // binning
+        if image_size == AcqImageSize.HALF:
+            shape = shape[0] // 2, shape[1] // 2
+        elif image_size == AcqImageSize.QUARTER:
+            shape = shape[0] // 4, shape[1] // 4
+        return shape
+
+    def _render_image(self, detector_shape, pixel_size, binning, shape, defocus, dose, dtype):
+        """Render image of specimen for the current optics state."""
+        shift = ((self._image_shift[0] - self._stage_pos['x']) / pixel_size,
+                 (self._image_shift[1] - self._stage_pos['y']) / pixel_size)
+        defocus = defocus + self._stage_pos['z']
+        if self._beam_blanked:
+            dose = 0.0
+        else:
+            dose *= self._specimen.relative_dose(self._spot_size, self._intensity)
+        out = self._frame_pool.get(shape, dtype) if self._frame_pool is not None else None
+        return self._specimen.render(detector_shape, binning=binning, shift=shift, defocus=defocus, dose=dose,
+                                     crop=shape, dtype=dtype, out=out)
+
+    @simulated
     def get_image_shift(self):
         return tuple(self._image_shift)
 
+    @simulated
     def set_image_shift(self, pos):
         pos = np.atleast_1d(pos)
         self._image_shift[...] = pos
 
+    @simulated
     def get_beam_shift(self):
         return tuple(self._beam_shift)
 
+    @simulated
     def set_beam_shift(self, pos):
         pos = np.atleast_1d(pos)
         self._beam_shift[...] = pos
 
+    @simulated
     def get_beam_tilt(self):
         return tuple(self._beam_tilt)
 
+    @simulated
     def set_beam_tilt(self, tilt):
         tilt = np.atleast_1d(tilt)
         self._beam_tilt[...] = tilt
@@ -270,157 +521,204 @@ class NullMicroscope(BaseMicroscope):
         elif self._dark_field_mode != DarkFieldMode.OFF:
             self._dark_field_mode = DarkFieldMode.CARTESIAN
 
+    @simulated
     def normalize(self, mode="ALL"):
         if mode.upper() not in NullMicroscope.NORMALIZATION_MODES:
             raise ValueError("Unknown normalization mode: %s" % mode)
 
+    @simulated
     def get_projection_sub_mode(self):
         return self._projection_sub_mode.name
 
+    @simulated
     def get_projection_mode(self):
         return self._projection_mode.name
 
+    @simulated
     def set_projection_mode(self, mode):
         mode = parse_enum(ProjectionMode, mode)
         self._projection_mode = mode
 
+    @simulated
     def get_projection_mode_string(self):
         return "SA"
 
+    @simulated
     def get_magnification_index(self):
         return self._magnification_index
 
+    @simulated
     def set_magnification_index(self, index):
         self._magnification_index = index
 
+    @simulated
     def get_indicated_camera_length(self):
         if self._projection_mode == ProjectionMode.DIFFRACTION:
             return self._magnification_index * 0.1
         else:
             return 0
 
+    @simulated
     def get_indicated_magnification(self):
         if self._projection_mode == ProjectionMode.IMAGING:
             return self._magnification_index * 10000
         else:
             return 0
 
+    @simulated
     def get_defocus(self):
         return self._defocus
 
+    @simulated
     def set_defocus(self, value):
         self._defocus = float(value)
 
+    @simulated
     def get_objective_excitation(self):
         return self._defocus
 
+    @simulated
     def get_intensity(self):
         return self._intensity
 
+    @simulated
     def set_intensity(self, value):
         self._intensity = float(value)
 
+    @simulated
     def get_objective_stigmator(self):
         return tuple(self._objective_stigmator)
 
+    @simulated
     def set_objective_stigmator(self, value):
         value = np.atleast_1d(value)
         self._objective_stigmator[...] = value
 
+    @simulated
     def get_condenser_stigmator(self):
         return tuple(self._condenser_stigmator)
 
+    @simulated
     def set_condenser_stigmator(self, value):
         value = np.atleast_1d(value)
         self._condenser_stigmator[...] = value
 
+    @simulated
     def get_diffraction_shift(self):
         return tuple(self._diffraction_shift)
 
+    @simulated
     def set_diffraction_shift(self, value):
         value = np.atleast_1d(value)
         self._diffraction_shift[...] = value
 
+    @simulated
     def get_screen_current(self):
         return 1e-9
 
+    @simulated
     def get_screen_position(self):
         return self._screen_position.name
 
+    @simulated
     def set_screen_position(self, mode):
         mode = parse_enum(ScreenPosition, mode)
         self._screen_position = mode
 
+    @simulated
     def get_illumination_mode(self):
         return self._illumination_mode.name
 
+    @simulated
     def set_illumination_mode(self, mode):
         mode = parse_enum(IlluminationMode, mode)
         self._illumination_mode = mode
 
+    @simulated
     def get_condenser_mode(self):
         return self._condenser_mode.name
 
+    @simulated
     def set_condenser_mode(self, mode):
         mode = parse_enum(CondenserMode, mode)
         self._condenser_mode = mode
 
+    @simulated
     def get_stem_magnification(self):
         return self._stem_magnification
 
+    @simulated
     def set_stem_magnification(self, value):
         self._stem_magnification = float(value)
 
+    @simulated
     def get_stem_rotation(self):
         return self._stem_rotation
 
+    @simulated
     def set_stem_rotation(self, value):
         self._stem_rotation = float(value)
 
+    @simulated
     def get_illuminated_area(self):
         return self._illuminated_area
 
+    @simulated
     def set_illuminated_area(self, value):
         self._illuminated_area = float(value)
 
+    @simulated
     def get_probe_defocus(self):
         return self._probe_defocus
 
+    @simulated
     def set_probe_defocus(self, value):
         self._probe_defocus = float(value)
 
+    @simulated
     def get_convergence_angle(self):
         return self._convergence_angle
 
+    @simulated
     def set_convergence_angle(self, value):
         self._convergence_angle = float(value)
 
+    @simulated
     def get_spot_size_index(self):
         return self._spot_size
 
+    @simulated
     def set_spot_size_index(self, index):
         self._spot_size = min(max(index, 1), 11)
 
+    @simulated
     def get_dark_field_mode(self):
         return self._dark_field_mode.name
 
+    @simulated
     def set_dark_field_mode(self, mode):
         mode = parse_enum(DarkFieldMode, mode)
         self._dark_field_mode = mode
 
+    @simulated
     def get_beam_blanked(self):
         return self._beam_blanked
 
+    @simulated
     def set_beam_blanked(self, mode):
         self._beam_blanked = bool(mode)
 
+    @simulated
     def is_stem_available(self):
-        return False
+        return bool(self._stem_detectors)
 
+    @simulated
     def get_instrument_mode(self):
-        return InstrumentMode.TEM.name
+        return self._instrument_mode.name
 
+    @simulated
     def set_instrument_mode(self, mode):
         mode = parse_enum(InstrumentMode, mode)
-        if mode != InstrumentMode.TEM:
+        if mode != InstrumentMode.TEM and not self._stem_detectors:
             raise ValueError("STEM not available.")
+        self._instrument_mode = mode
@@ -0,0 +1,384 @@
+import json
+import threading
+import time
+import warnings
+
+from .base_microscope import STATE_FIELDS, _state_values_equal
+
+
+class Subscription:
+    """
+    Subscription to changes of state fields, returned by :meth:`BaseMicroscope.subscribe`.
+
+    The polling interval of the subscription starts at *min_interval*. It is multiplied by the
+    :attr:`StatePoller.BACKOFF_FACTOR` after each poll without changes, up to *max_interval*. As soon as a field
+    changes, the interval is reset to *min_interval*.
+
+    .. versionadded:: 2.2.0
+    """
+    def __init__(self, poller, fields, callback, min_interval, max_interval, error_callback=None):
+        self.fields = tuple(fields)
+        self.callback = callback
+        self.error_callback = error_callback
+        self.min_interval = float(min_interval)
+        self.max_interval = float(max_interval)
+        self.interval = self.min_interval
+        self.due = 0.0
+        self.values = {}
+        self._poller = poller
+        self._active = True
+
+    @property
+    def active(self):
+        """Whether the subscription is still active."""
+        return self._active
+
+    def cancel(self):
+        """Cancel subscription. The callback is not called afterwards (unless it is currently executed)."""
+        self._poller.remove(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.cancel()
+
+    def _update(self, values, now):
+        """Process sampled *values*, return dict with changed fields."""
+        changed = {}
+        for field in self.fields:
+            if field not in values:
+                continue
+            value = values[field]
+            if field not in self.values or not _state_values_equal(self.values[field], value):
+                changed[field] = value
+                self.values[field] = value
+        if changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * StatePoller.BACKOFF_FACTOR, self.max_interval)
+        self.due = now + self.interval
+        return changed
+
+
+class StatePoller:
+    """
+    Shared poller of the subscriptions of a microscope (see :meth:`BaseMicroscope.subscribe`).
+
+    The poller runs a single background thread. Whenever subscriptions are due, the union of their fields is read
+    with a single :meth:`BaseMicroscope.get_state` call. Fields, which are not part of the state (like "vacuum" or
+    "stage_status") are read by their getters. The thread is started with the first subscription and ends
+    after the last subscription was cancelled.
+
+    :param microscope: Microscope to poll
+    :type microscope: BaseMicroscope
+
+    .. versionadded:: 2.2.0
+    """
+    BACKOFF_FACTOR = 2.0
+
+    def __init__(self, microscope):
+        self._microscope = microscope
+        self._condition = threading.Condition()
+        self._subscriptions = []
+        self._thread = None
+        self._polls = 0
+
+    def add(self, fields, callback, min_interval=0.1, max_interval=2.0, error_callback=None):
+        """Add subscription and return it (see :meth:`BaseMicroscope.subscribe`)."""
+        if isinstance(fields, str):
+            fields = [fields]
+        fields = list(fields)
+        for field in fields:
+            if field not in STATE_FIELDS and not callable(getattr(self._microscope, "get_" + field, None)):
+                raise KeyError("Unknown state field: '%s'" % (field,))
+        if not fields:
+            raise ValueError("No fields given.")
+        if min_interval <= 0.0 or max_interval < min_interval:
+            raise ValueError("Expected 0 < min_interval <= max_interval.")
+        subscription = Subscription(self, fields, callback, min_interval, max_interval, error_callback=error_callback)
+        with self._condition:
+            self._subscriptions.append(subscription)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="temscript-poller")
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+        return subscription
+
+    def remove(self, subscription):
+        """Cancel *subscription*."""
+        with self._condition:
+            subscription._active = False
+            try:
+                self._subscriptions.remove(subscription)
+            except ValueError:
+                pass
+            self._condition.notify()
+
+    @property
+    def subscriptions(self):
+        """List of active subscriptions."""
+        with self._condition:
+            return list(self._subscriptions)
+
+    @property
+    def polls(self):
+        """Number of :meth:`BaseMicroscope.get_state` calls done by the poller."""
+        return self._polls
+
+    def _next_due(self):
+        """Wait for due subscriptions and return them, return `None` if there are no subscriptions left."""
+        with self._condition:
+            while True:
+                if not self._subscriptions:
+                    self._thread = None
+                    return None
+                now = time.monotonic()
+                due = [subscription for subscription in self._subscriptions if subscription.due <= now]
+                if due:
+                    return due
+                self._condition.wait(min(subscription.due for subscription in self._subscriptions) - now)
+
+    def _run(self):
+        while True:
+            due = self._next_due()
+            if due is None:
+                break
+            fields = sorted(set(field for subscription in due for field in subscription.fields))
+            try:
+                values = self._read(fields)
+                error = None
+            except Exception as exc:
+                values = {}
+                error = exc
+            self._polls += 1
+            now = time.monotonic()
+            for subscription in due:
+                if not subscription.active:
+                    continue
+                if error is not None:
+                    subscription.interval = min(subscription.interval * self.BACKOFF_FACTOR,
+                                                subscription.max_interval)
+                    subscription.due = now + subscription.interval
+                    self._call(subscription, subscription.error_callback, error, error)
+                    continue
+                changed = subscription._update(values, now)
+                if changed:
+                    self._call(subscription, subscription.callback, changed, None)
+
+    def _read(self, fields):
+        """Read state *fields* with a single :meth:`BaseMicroscope.get_state` call, other fields by their getters."""
+        state_fields = [field for field in fields if field in STATE_FIELDS]
+        values = self._microscope.get_state(fields=state_fields) if state_fields else {}
+        for field in fields:
+            if field not in STATE_FIELDS:
+                values[field] = getattr(self._microscope, "get_" + field)()
+        return values
+
+    @staticmethod
+    def _call(subscription, callback, arg, error):
+        """Call callback of *subscription*, exceptions are reported as warnings."""
+        try:
+            if callback is None:
+                warnings.warn("Polling of %s failed: %r" % (", ".join(subscription.fields), error), RuntimeWarning)
+            else:
+                callback(arg)
+        except Exception as exc:
+            warnings.warn("Subscriber callback raised exception: %r" % exc, RuntimeWarning)
+
+
+class PollPolicy:
+    """
+    Polling intervals of :meth:`BaseMicroscope.wait_for`.
+
+    The first poll is done immediately, the interval starts at *interval* and is multiplied by *factor* after each
+    poll, up to *max_interval*.
+
+    :param interval: Initial interval in seconds
+    :type interval: float
+    :param max_interval: Maximum interval in seconds
+    :type max_interval: float
+    :param factor: Factor applied to the interval after each poll
+    :type factor: float
+
+    .. versionadded:: 2.2.0
+    """
+    def __init__(self, interval=0.05, max_interval=0.5, factor=1.5):
+        self.interval = float(interval)
+        self.max_interval = max(float(max_interval), self.interval)
+        self.factor = max(float(factor), 1.0)
+        if self.interval <= 0.0:
+            raise ValueError("Interval must be positive.")
+
+    def intervals(self):
+        """Iterate over the intervals."""
+        interval = self.interval
+        while True:
+            yield interval
+            interval = min(interval * self.factor, self.max_interval)
+
+    def to_dict(self):
+        return {"interval": self.interval, "max_interval": self.max_interval, "factor": self.factor}
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**values)
+
+
+class Predicate:
+    """
+    Base class of serializable predicates of :meth:`BaseMicroscope.wait_for`.
+
+    Predicates are evaluated on the value returned by the getter, or if *key* is given, on an item of this value.
+    The *key* is either a single key (e.g. "status" for the dict returned by :meth:`BaseMicroscope.get_vacuum`) or a
+    sequence of keys for nested values (e.g. ("gauges(Pa)", "P1")).
+
+    Since predicates can be serialized, the :class:`RemoteMicroscope` evaluates them at the server.
+
+    .. versionadded:: 2.2.0
+    """
+    OPERATOR = None
+
+    def __init__(self, key=None):
+        if key is not None and not isinstance(key, (list, tuple)):
+            key = (key,)
+        self.key = tuple(key) if key is not None else None
+
+    def select(self, value):
+        """Return the item of *value* selected by the key."""
+        if self.key is not None:
+            for key in self.key:
+                value = value[key]
+        return value
+
+    def __call__(self, value):
+        return self.test(self.select(value))
+
+    def test(self, value):
+        """Return whether the predicate holds for the selected *value*."""
+        raise NotImplementedError
+
+    def to_dict(self):
+        """Return dict with serialized predicate."""
+        return {"op": self.OPERATOR, "key": list(self.key) if self.key is not None else None}
+
+    @staticmethod
+    def from_dict(values):
+        """Create predicate from dict created by :meth:`to_dict`."""
+        values = dict(values)
+        op = values.pop("op", None)
+        for cls in (Equals, InRange, OneOf):
+            if cls.OPERATOR == op:
+                return cls(**values)
+        raise ValueError("Unknown predicate operator: %r" % op)
+
+
+class Equals(Predicate):
+    """
+    Predicate, which holds if the value equals *value* (numbers with relative tolerance *rel_tol*).
+
+    .. versionadded:: 2.2.0
+    """
+    OPERATOR = "eq"
+
+    def __init__(self, value, key=None, rel_tol=1e-9):
+        super(Equals, self).__init__(key=key)
+        self.value = value
+        self.rel_tol = float(rel_tol)
+
+    def test(self, value):
+        return _state_values_equal(value, self.value, rel_tol=self.rel_tol)
+
+    def to_dict(self):
+        result = super(Equals, self).to_dict()
+        result.update(value=self.value, rel_tol=self.rel_tol)
+        return result
+
+    def __repr__(self):
+        return "Equals(%r, key=%r)" % (self.value, self.key)
+
+
+class InRange(Predicate):
+    """
+    Predicate, which holds if *minimum* <= value <= *maximum*. Either bound might be `None`.
+
+    .. versionadded:: 2.2.0
+    """
+    OPERATOR = "range"
+
+    def __init__(self, minimum=None, maximum=None, key=None):
+        super(InRange, self).__init__(key=key)
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def test(self, value):
+        if self.minimum is not None and not value >= self.minimum:
+            return False
+        if self.maximum is not None and not value <= self.maximum:
+            return False
+        return True
+
+    def to_dict(self):
+        result = super(InRange, self).to_dict()
+        result.update(minimum=self.minimum, maximum=self.maximum)
+        return result
+
+    def __repr__(self):
+        return "InRange(%r, %r, key=%r)" % (self.minimum, self.maximum, self.key)
+
+
+class OneOf(Predicate):
+    """
+    Predicate, which holds if the value is one of *values*.
+
+    .. versionadded:: 2.2.0
+    """
+    OPERATOR = "in"
+
+    def __init__(self, values, key=None):
+        super(OneOf, self).__init__(key=key)
+        self.values = list(values)
+
+    def test(self, value):
+        return any(_state_values_equal(value, item) for item in self.values)
+
+    def to_dict(self):
+        result = super(OneOf, self).to_dict()
+        result.update(values=self.values)
+        return result
+
+    def __repr__(self):
+        return "OneOf(%r, key=%r)" % (self.values, self.key)
+
+
+def make_predicate(predicate):
+    """
+    Return predicate for :meth:`BaseMicroscope.wait_for`: callables are returned as is, dicts are deserialized
+    (see :meth:`Predicate.to_dict`), any other value is converted to an :class:`Equals` predicate.
+
+    .. versionadded:: 2.2.0
+    """
+    if callable(predicate):
+        return predicate
+    elif isinstance(predicate, dict) and "op" in predicate:
+        return Predicate.from_dict(predicate)
+    return Equals(predicate)
+
+
+def encode_predicate(predicate):
+    """Return JSON string of serializable *predicate*, `None` if the predicate can't be serialized."""
+    predicate = make_predicate(predicate)
+    if not isinstance(predicate, Predicate):
+        return None
+    try:
+        return json.dumps(predicate.to_dict())
+    except (TypeError, ValueError):
+        return None
+
+
+def getter_name(getter):
+    """Return name of getter method for *getter* (e.g. "get_screen_position" for "screen_position")."""
+    if getter.startswith("get_") or getter.startswith("is_"):
+        return getter
+    return "get_" + getter
@@ -0,0 +1,173 @@
+import gzip
+import pickle
+import threading
+import time
+
+from .forwarding_microscope import ForwardingMicroscope, _freeze
+
+
+RECORDING_FORMAT = "temscript-recording"
+RECORDING_VERSION = 1
+
+# Exception types, which are reraised as such during replay. Any other exception is replayed as RuntimeError.
+_REPLAYED_EXCEPTIONS = {exc.__name__: exc for exc in (KeyError, ValueError, TypeError, AttributeError,
+                                                      NotImplementedError, RuntimeError, TimeoutError)}
+
+
+def _open_recording(filename, mode):
+    """Open recording file, files ending with '.gz' are gzip compressed."""
+    if str(filename).endswith(".gz"):
+        return gzip.open(filename, mode)
+    else:
+        return open(filename, mode)
+
+
+def load_recording(filename):
+    """
+    Iterate over the calls stored in a recording created by :class:`RecordingMicroscope`.
+
+    Each call is returned as dict with the following keys:
+
+        * "method": Name of the called method
+        * "args": Tuple with positional arguments
+        * "kw": Dict with keyword arguments
+        * "result": Returned value (`None` if the call raised an exception)
+        * "error": `None` or (exception type name, message) tuple, if the call raised an exception
+        * "duration(s)": Duration of the call in seconds
+
+    .. versionadded:: 2.2.0
+    """
+    with _open_recording(filename, "rb") as fp:
+        header = pickle.load(fp)
+        if not isinstance(header, dict) or header.get("format") != RECORDING_FORMAT:
+            raise ValueError("File '%s' is not a temscript recording." % filename)
+        if header.get("version", 0) > RECORDING_VERSION:
+            raise ValueError("Unsupported recording version: %s" % header.get("version"))
+        while True:
+            try:
+                method, args, kw, result, error, duration = pickle.load(fp)
+            except EOFError:
+                break
+            yield {
+                "method": method,
+                "args": args,
+                "kw": kw,
+                "result": result,
+                "error": error,
+                "duration(s)": duration
+            }
+
+
+class RecordingMicroscope(ForwardingMicroscope):
+    """
+    Microscope-like class, which records all calls to another microscope.
+
+    Every call is forwarded to *backend* and stored together with its arguments, its result (or the raised exception),
+    and its duration in the file *filename*. The recording can be replayed with :class:`ReplayMicroscope`, or be
+    analyzed using :func:`load_recording`. If *filename* ends with '.gz', the recording is gzip compressed.
+
+    Recorded calls are written immediately, thus the recording stays usable if the program is interrupted.
+
+    :param backend: Microscope to record
+    :type backend: BaseMicroscope
+    :param filename: Name of recording file
+    :type filename: str
+
+    Usage:
+
+        >>> with RecordingMicroscope(Microscope(), "session.rec.gz") as microscope:
+        ...     microscope.get_state()
+
+    .. versionadded:: 2.2.0
+    """
+    def __init__(self, backend, filename):
+        super(RecordingMicroscope, self).__init__(backend)
+        self._lock = threading.Lock()
+        self._file = _open_recording(filename, "wb")
+        pickle.dump({"format": RECORDING_FORMAT, "version": RECORDING_VERSION}, self._file,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+
+    def close(self):
+        """Close the recording file. The microscope can't be used after the file was closed."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _forward(self, method_name, *args, **kw):
+        start = time.perf_counter()
+        try:
+            result = super(RecordingMicroscope, self)._forward(method_name, *args, **kw)
+        except Exception as exc:
+            message = str(exc.args[0]) if len(exc.args) == 1 else str(exc)
+            self._write(method_name, args, kw, None, (type(exc).__name__, message), time.perf_counter() - start)
+            raise
+        self._write(method_name, args, kw, result, None, time.perf_counter() - start)
+        return result
+
+    def _write(self, method, args, kw, result, error, duration):
+        with self._lock:
+            if self._file is None:
+                raise ValueError("Recording is already closed.")
+            pickle.dump((method, args, kw, result, error, duration), self._file, protocol=pickle.HIGHEST_PROTOCOL)
+            self._file.flush()
+
+
+class ReplayMicroscope(ForwardingMicroscope):
+    """
+    Microscope-like class, which replays a recording created with :class:`RecordingMicroscope`.
+
+    Calls are answered with the recorded results (or recorded exceptions) after waiting the recorded duration of the
+    call multiplied with *latency_scale*. Calls are matched against recorded calls with the same method and
+    arguments. If a call was recorded several times, the recorded calls are served in order, starting over again
+    after the last one. If a call with these arguments was never recorded, the recorded calls of the same method
+    (regardless of arguments) are used instead. If the method was not recorded at all, a `KeyError` is raised.
+
+    The replayed microscope has no state of its own, thus setters have no effect on the values returned by getters.
+
+    :param filename: Name of recording file
+    :type filename: str
+    :param latency_scale: Factor applied to the recorded durations. A value of 0 answers all calls immediately.
+    :type latency_scale: float
+
+    .. versionadded:: 2.2.0
+    """
+    def __init__(self, filename, latency_scale=1.0):
+        super(ReplayMicroscope, self).__init__(None)
+        self._lock = threading.Lock()
+        self._latency_scale = float(latency_scale)
+        self._calls = {}
+        self._cursors = {}
+        for call in load_recording(filename):
+            key = (call["method"], _freeze(call["args"]), _freeze(call["kw"]))
+            self._calls.setdefault(key, []).append(call)
+            self._calls.setdefault(call["method"], []).append(call)
+
+    def _next_call(self, method, args, kw):
+        """Return next recorded call matching the method and arguments."""
+        key = (method, _freeze(args), _freeze(kw))
+        if key not in self._calls:
+            key = method
+            if key not in self._calls:
+                raise KeyError("No recorded call for method '%s'" % method)
+        calls = self._calls[key]
+        with self._lock:
+            index = self._cursors.get(key, 0)
+            self._cursors[key] = (index + 1) % len(calls)
+        return calls[index]
+
+    def _forward(self, method_name, *args, **kw):
+        call = self._next_call(method_name, args, kw)
+        delay = call["duration(s)"] * self._latency_scale
+        if delay > 0:
+            time.sleep(delay)
+        if call["error"] is not None:
+            exc_name, message = call["error"]
+            raise _REPLAYED_EXCEPTIONS.get(exc_name, RuntimeError)(message)
+        return call["result"]
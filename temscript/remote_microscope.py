@@ -1,9 +1,12 @@
 import socket
 import json
+import threading
+from concurrent.futures import Future
 from http.client import HTTPConnection
 from urllib.parse import urlencode, quote_plus
 
 from .base_microscope import BaseMicroscope
+from .stage_move import StageMoveHandle
 from .marshall import ExtendedJsonEncoder, unpack_array, gzip_decode, MIME_TYPE_PICKLE, MIME_TYPE_JSON
 
 
@@ -15,11 +18,27 @@ class RemoteMicroscope(BaseMicroscope):
     :type address: Tuple[str, int]
     :param transport: Underlying transport protocol, either 'JSON' (default) or 'PICKLE'
     :type transport: Literal['JSON', 'PICKLE']
+
+    Each thread using the instance has its own connection to the server, thus requests from several threads
+    (e.g. long-polling :meth:`wait_for` and reading the state) are handled concurrently. Use :meth:`close` to
+    close all connections.
+
+    .. versionchanged:: 2.2.0
+        One connection per thread instead of a single connection. :meth:`close` added.
     """
+    # Timeout of a single long-poll request while waiting for the stage
+    STAGE_WAIT_TIMEOUT = 10.0
+
+    # Stage status values ending a movement, all other values are treated as movement in progress
+    STAGE_FINAL_STATUS = ("READY", "DISABLED")
+
     def __init__(self, address, transport=None, timeout=None):
         self.address = address
         self.timeout = timeout
-        self._conn = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._generation = 0        # Incremented by close(), invalidates the connections of all threads
         if transport is None:
             transport = "JSON"
         if transport == "JSON":
@@ -29,8 +48,7 @@ class RemoteMicroscope(BaseMicroscope):
         else:
             raise ValueError("Unknown transport protocol.")
 
-        # Make connection
-        self._conn = HTTPConnection(self.address[0], self.address[1], timeout=self.timeout)
+        # Check connection
         version_string = self.get_version()
         if int(version_string.split('.')[0]) < 2:
             raise ValueError("Expected microscope server version >= 2.0.0, actual version is %s" % version_string)
@@ -72,14 +90,12 @@ class RemoteMicroscope(BaseMicroscope):
             url = endpoint + '?' + urlencode(query)
         else:
             url = endpoint
-        self._conn.request(method, url, body, headers)
-
-        # Get response
+        conn = self._connection()
         try:
-            response = self._conn.getresponse()
-        except socket.timeout:
-            self._conn.close()
-            self._conn = None
+            conn.request(method, url, body, headers)
+            response = conn.getresponse()
+        except (socket.timeout, OSError):
+            self._drop_connection(conn)
             raise
 
         if response.status not in accepted_response:
@@ -111,6 +127,37 @@ class RemoteMicroscope(BaseMicroscope):
             raise ValueError("Unsupported response type: %s", content_type)
         return response, body
 
+    def _connection(self):
+        """Return connection of the calling thread."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.generation != self._generation:
+            conn = HTTPConnection(self.address[0], self.address[1], timeout=self.timeout)
+            with self._lock:
+                self._connections.append(conn)
+                self._local.generation = self._generation
+            self._local.conn = conn
+        return conn
+
+    def _drop_connection(self, conn):
+        conn.close()
+        if getattr(self._local, "conn", None) is conn:
+            self._local.conn = None
+        with self._lock:
+            if conn in self._connections:
+                self._connections.remove(conn)
+
+    def close(self):
+        """
+        Close the connections of all threads. Subsequent requests open new connections.
+
+        .. versionadded:: 2.2.0
+        """
+        with self._lock:
+            connections, self._connections = self._connections, []
+            self._generation += 1
+        for conn in connections:
+            conn.close()
+
     def _request_with_json_body(self, method, url, body, query=None, headers=None, accepted_response=None):
         """
         Like :meth:`_request` but body is encoded as JSON.
@@ -168,6 +215,90 @@ class RemoteMicroscope(BaseMicroscope):
             query['speed'] = speed
         self._request_with_json_body("PUT", "/v1/stage_position", body=pos, query=query)
 
+    def _start_stage_move(self, pos=None, method="GO", speed=None):
+        query = {'wait': 0}
+        if method is not None:
+            query['method'] = method
+        if speed is not None:
+            query['speed'] = speed
+        response = self._request_with_json_body("PUT", "/v1/stage_position", body=pos, query=query)[1]
+        move_id = response.get("move_id") if response else None
+
+        # Wait for stage by long-polling, the waiting thread uses its own connection
+        future = Future()
+
+        def wait():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                status = self.wait_for_stage_status("READY", timeout=self.STAGE_WAIT_TIMEOUT, move_id=move_id)
+                while status not in self.STAGE_FINAL_STATUS:
+                    status = self.wait_for_stage_status("READY", timeout=self.STAGE_WAIT_TIMEOUT, move_id=move_id)
+                if status != "READY":
+                    raise RuntimeError("Stage movement ended with stage status %s." % status)
+            except BaseException as exc:
+                future.set_exception(exc)
+            else:
+                future.set_result(None)
+            finally:
+                # The connection of this thread isn't used anymore
+                conn = getattr(self._local, "conn", None)
+                if conn is not None:
+                    self._drop_connection(conn)
+
+        thread = threading.Thread(target=wait, name="temscript-stage-wait")
+        thread.daemon = True
+        thread.start()
+        return StageMoveHandle(future)
+
+    def wait_for(self, getter, predicate, timeout=10.0, poll_policy=None):
+        """
+        Wait until the value returned by a getter satisfies a predicate (see :meth:`BaseMicroscope.wait_for`).
+
+        Serializable predicates are evaluated by the server, which holds the request until the predicate is satisfied.
+        Other predicates (like lambdas) are evaluated by polling from the client. The long-poll uses the connection
+        of the calling thread, thus other threads are not blocked.
+        """
+        import json
+        import time
+        from .polling import encode_predicate
+        encoded = encode_predicate(predicate)
+        if encoded is None:
+            return super(RemoteMicroscope, self).wait_for(getter, predicate, timeout=timeout, poll_policy=poll_policy)
+        if getter.startswith("get_"):
+            getter = getter[4:]
+        elif getter.startswith("is_"):
+            getter = getter[3:]
+        query = {'getter': getter, 'predicate': encoded}
+        if poll_policy is not None:
+            query['poll_policy'] = json.dumps(poll_policy.to_dict())
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            remaining = deadline - time.monotonic() if deadline is not None else self.STAGE_WAIT_TIMEOUT
+            query['timeout'] = max(min(remaining, self.STAGE_WAIT_TIMEOUT), 0.0)
+            response = self._request("GET", "/v1/wait_for", query=query)[1]
+            if response["satisfied"]:
+                return response["value"]
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError("Timeout while waiting for %s (last value: %r)" % (getter, response["value"]))
+
+    def wait_for_stage_status(self, status="READY", timeout=10.0, move_id=None):
+        """
+        Wait until the stage has *status*, at most *timeout* seconds.
+
+        The server holds the request until the stage has the status (long-polling). With a *move_id* returned by
+        the server for a movement started with ``wait=False``, the request first waits for this movement.
+
+        :returns: Last status of the stage
+        :raises RuntimeError: If the movement *move_id* failed
+
+        .. versionadded:: 2.2.0
+        """
+        query = {'wait_until': status, 'timeout': timeout}
+        if move_id is not None:
+            query['move_id'] = move_id
+        return self._request("GET", "/v1/stage_status", query=query)[1]
+
     def get_cameras(self):
         return self._request("GET", "/v1/cameras")[1]
 
@@ -365,5 +496,10 @@ class RemoteMicroscope(BaseMicroscope):
     def set_instrument_mode(self, mode):
         self._request_with_json_body("PUT", "/v1/instrument_mode", mode)
 
-    def get_state(self):
-        return self._request("GET", "/v1/state")[1]
+    def get_state(self, fields=None):
+        query = tuple(("fields", field) for field in fields) if fields is not None else None
+        return self._request("GET", "/v1/state", query=query)[1]
+
+    def set_state(self, state, move_stage=False):
+        query = {'move_stage': int(move_stage)}
+        return self._request_with_json_body("PUT", "/v1/state", state, query=query)[1]
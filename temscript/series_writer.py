@@ -0,0 +1,318 @@
+import os
+import threading
+import time
+
+import numpy as np
+
+from ._pipeline import Pipeline
+
+
+NPY_HEADER_SIZE = 4096          # Fixed size of .npy headers, thus the shape can be updated in place
+STRING_LENGTH = 32              # Maximum length of string metadata
+
+
+def _npy_header(dtype, shape, size):
+    """Return .npy (version 1.0) header of *size* bytes."""
+    header = repr({"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)), "fortran_order": False,
+                   "shape": tuple(shape)}).encode("latin1")
+    padding = size - 10 - len(header) - 1
+    if padding < 0:
+        raise ValueError("Header doesn't fit into %d bytes." % size)
+    return b"\x93NUMPY\x01\x00" + np.array(size - 10, dtype="<u2").tobytes() + header + b" " * padding + b"\n"
+
+
+def _header_size(dtype):
+    """Return header size (a multiple of NPY_HEADER_SIZE) for arrays of *dtype* with large shapes."""
+    length = len(_npy_header(dtype, (2 ** 62, 2 ** 31, 2 ** 31), 2 ** 16).rstrip())
+    return NPY_HEADER_SIZE * ((length + 64) // NPY_HEADER_SIZE + 1)
+
+
+class _GrowableNpy:
+    """
+    Memory mapped .npy file, to which items are appended.
+
+    The file is preallocated for *capacity* items and grows by doubling. The shape in the header always reflects the
+    number of items written, thus the file can be read by :func:`numpy.load` at any time (also after a crash).
+    Unused capacity is truncated by :meth:`close`.
+    """
+    def __init__(self, filename, dtype, item_shape, capacity=64):
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self.item_shape = tuple(item_shape)
+        self.count = 0
+        self.capacity = max(int(capacity), 1)
+        self._header_size = _header_size(self.dtype)
+        self._item_size = self.dtype.itemsize * int(np.prod(self.item_shape, dtype=np.int64))
+        self._fp = open(filename, "w+b")
+        self._fp.write(self._header(0))
+        self._fp.truncate(self._header_size + self.capacity * self._item_size)
+        self._map = self._open_map()
+
+    def _header(self, count):
+        return _npy_header(self.dtype, (count,) + self.item_shape, self._header_size)
+
+    def _open_map(self):
+        return np.memmap(self._fp, dtype=self.dtype, mode="r+", offset=self._header_size,
+                         shape=(self.capacity,) + self.item_shape)
+
+    def _grow(self):
+        self._map.flush()
+        self._map = None
+        self.capacity *= 2
+        self._fp.truncate(self._header_size + self.capacity * self._item_size)
+        self._map = self._open_map()
+
+    def append(self, item):
+        if self.count >= self.capacity:
+            self._grow()
+        self._map[self.count] = item
+        self.count += 1
+        # Update shape after the data was written
+        self._fp.seek(0)
+        self._fp.write(self._header(self.count))
+
+    def flush(self):
+        self._map.flush()
+        self._fp.flush()
+
+    def close(self):
+        if self._fp is None:
+            return
+        self._map.flush()
+        self._map = None
+        self._fp.truncate(self._header_size + self.count * self._item_size)
+        self._fp.close()
+        self._fp = None
+
+
+def _metadata_dtype(value):
+    """Return dtype for metadata *value* (possibly nested dicts and sequences), None if it can't be stored."""
+    if isinstance(value, dict):
+        fields = []
+        for key in sorted(value.keys(), key=str):
+            dtype = _metadata_dtype(value[key])
+            if dtype is not None:
+                fields.append((str(key), dtype))
+        return np.dtype(fields) if fields else None
+    elif isinstance(value, (bool, np.bool_)):
+        return np.dtype(bool)
+    elif isinstance(value, (int, np.integer)):
+        return np.dtype(np.int64)
+    elif isinstance(value, (float, np.floating)):
+        return np.dtype(np.float64)
+    elif isinstance(value, str):
+        return np.dtype("U%d" % STRING_LENGTH)
+    elif isinstance(value, (list, tuple, np.ndarray)) and len(value) > 0:
+        try:
+            array = np.asarray(value, dtype=np.float64)
+        except (TypeError, ValueError):
+            return None
+        return np.dtype((np.float64, array.shape))
+    return None
+
+
+def _metadata_record(dtype, value):
+    """Return tuple for a record of structured *dtype* from dict *value* (missing values become zeros)."""
+    items = []
+    for name in dtype.names:
+        field = dtype.fields[name][0]
+        item = value.get(name) if isinstance(value, dict) else None
+        if field.names is not None:
+            items.append(_metadata_record(field, item if item is not None else {}))
+        elif item is None:
+            items.append(np.zeros((), dtype=field)[()])
+        elif field.kind == "U":
+            items.append(str(item)[:STRING_LENGTH])
+        else:
+            items.append(item)
+    return tuple(items)
+
+
+def _file_name(detector):
+    """Return file name of the frame stack of *detector*."""
+    return "frames-%s.npy" % "".join(c if c.isalnum() or c in "-_." else "_" for c in detector)
+
+
+class SeriesWriter:
+    """
+    Writes series of frames into memory mapped .npy stacks, with a structured array of metadata.
+
+    The frames of each detector are appended to the file "frames-<detector>.npy" in *directory*, the metadata of
+    the frames (index, time, and the state fields given by *fields*) to "metadata.npy" as numpy structured array.
+    Nested values of the state (e.g. "stage_position") are stored as nested structures. The dtypes are determined
+    by the first frame.
+
+    All frames must contain images of the same detectors, thus the stacks and the metadata stay in sync. Writing
+    happens in a background thread. At most *max_pending* frames are queued, afterwards :meth:`append` blocks. The
+    files are preallocated for *capacity* frames and grow if required. After each frame the shape in the
+    .npy header is updated, thus the files can be read by :func:`numpy.load` (or :func:`load_series`) at any time,
+    e.g. after a crash. :meth:`close` removes the unused capacity.
+
+    The writer can be used as *writer* of the acquisition engines (e.g. :class:`TiltSeries`), then the state recorded
+    by the engine is stored.
+
+    :param directory: Directory of the series (created if necessary)
+    :type directory: str
+    :param fields: State fields recorded by :meth:`acquire`
+    :type fields: Optional[Iterable[str]]
+    :param capacity: Number of preallocated frames
+    :type capacity: int
+    :param max_pending: Maximum number of frames waiting to be written
+    :type max_pending: int
+
+    Usage:
+
+        >>> with SeriesWriter("series", fields=["stage_position", "defocus"]) as writer:
+        ...     for n in range(100):
+        ...         writer.acquire(microscope, "BM-Ceta")
+        >>> series = load_series("series")
+        >>> series["BM-Ceta"].shape, series["metadata"]["stage_position"]["x"]
+
+    .. versionadded:: 2.2.0
+    """
+    def __init__(self, directory, fields=None, capacity=64, max_pending=8):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.fields = list(fields) if fields is not None else None
+        self.capacity = int(capacity)
+        self._stacks = {}
+        self._detectors = None
+        self._metadata = None
+        self._lock = threading.Lock()
+        self._count = 0
+        self._write_time = 0.0
+        self._pipeline = Pipeline(self._write, workers=1, max_pending=max_pending)
+        self._closed = False
+
+    @property
+    def count(self):
+        """Number of written frames."""
+        with self._lock:
+            return self._count
+
+    def append(self, images, state=None, timestamp=None):
+        """
+        Queue frames for writing.
+
+        :param images: Dict with images by detector name, as returned by :meth:`BaseMicroscope.acquire`
+        :type images: Dict[str, numpy.ndarray]
+        :param state: Optional dict with state values
+        :type state: Optional[Dict[str, Any]]
+        :param timestamp: Time of the acquisition in seconds since the epoch, defaults to the current time
+        :type timestamp: Optional[float]
+        :raises ValueError: If the detectors differ from the detectors of the first frame
+        """
+        if self._closed:
+            raise ValueError("Writer is closed.")
+        detectors = frozenset(images.keys())
+        with self._lock:
+            if self._detectors is None:
+                self._detectors = detectors
+            elif detectors != self._detectors:
+                raise ValueError("Detectors %s don't match detectors %s of the first frame." %
+                                 (sorted(detectors), sorted(self._detectors)))
+        timestamp = time.time() if timestamp is None else float(timestamp)
+        self._pipeline.submit(dict(images), state or {}, timestamp)
+
+    def acquire(self, microscope, *detectors):
+        """
+        Acquire *detectors*, read the state fields, and queue the frames for writing.
+
+        :returns: Dict with the images
+        """
+        state = microscope.get_state(fields=self.fields) if self.fields else {}
+        timestamp = time.time()
+        images = microscope.acquire(*detectors)
+        self.append(images, state, timestamp)
+        return images
+
+    def __call__(self, key, images, metadata):
+        # Writer interface of the acquisition engines
+        self.append(images, metadata.get("state"), metadata.get("time"))
+
+    def _write(self, images, state, timestamp):
+        start = time.perf_counter()
+        index = self._count
+        if self._metadata is None:
+            self._metadata = self._create_metadata(state)
+        for name, image in images.items():
+            stack = self._stacks.get(name)
+            if stack is None:
+                if index > 0:
+                    raise ValueError("Detector '%s' is missing in the first frame." % name)
+                image = np.asarray(image)
+                stack = _GrowableNpy(os.path.join(self.directory, _file_name(name)), image.dtype, image.shape,
+                                     self.capacity)
+                self._stacks[name] = stack
+            stack.append(image)
+        self._metadata.append(_metadata_record(self._metadata.dtype,
+                                               dict(state, index=index, time=timestamp)))
+        with self._lock:
+            self._count += 1
+            self._write_time += time.perf_counter() - start
+
+    def _create_metadata(self, state):
+        fields = [("index", np.int64), ("time", np.float64)]
+        dtype = _metadata_dtype(state)
+        if dtype is not None:
+            fields.extend((name, dtype.fields[name][0]) for name in dtype.names if name not in ("index", "time"))
+        return _GrowableNpy(os.path.join(self.directory, "metadata.npy"), np.dtype(fields), (), self.capacity)
+
+    def flush(self):
+        """Wait until all queued frames are written and flush the files."""
+        self._pipeline.join()
+        for stack in self._stacks.values():
+            stack.flush()
+        if self._metadata is not None:
+            self._metadata.flush()
+
+    def close(self):
+        """Write all queued frames and close the files."""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._pipeline.close()
+        finally:
+            for stack in self._stacks.values():
+                stack.close()
+            if self._metadata is not None:
+                self._metadata.close()
+
+    def statistics(self):
+        """Return dict with the number of written frames ("count") and the total time writing them ("write(s)")."""
+        with self._lock:
+            return {"count": self._count, "write(s)": self._write_time}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def load_series(directory, mmap_mode="r"):
+    """
+    Load series written by :class:`SeriesWriter`.
+
+    Also series, which were not closed properly, can be loaded. Since frames and metadata are written one after
+    the other, the number of frames may differ by one.
+
+    :param directory: Directory of the series
+    :type directory: str
+    :param mmap_mode: Memory mapping mode (see :func:`numpy.load`), None to read the arrays into memory
+    :type mmap_mode: Optional[str]
+    :returns: Dict with frame stacks by detector name (characters other than letters, digits, "-", "_", and "."
+        replaced by "_") and the metadata with key "metadata"
+
+    .. versionadded:: 2.2.0
+    """
+    result = {}
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if name == "metadata.npy":
+            result["metadata"] = np.load(path, mmap_mode=mmap_mode)
+        elif name.startswith("frames-") and name.endswith(".npy"):
+            result[name[len("frames-"):-len(".npy")]] = np.load(path, mmap_mode=mmap_mode)
+    return result
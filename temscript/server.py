@@ -1,9 +1,15 @@
 #!/usr/bin/python
 import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
 from urllib.parse import urlparse, parse_qs, unquote
 
 from .base_microscope import STAGE_AXES
+from .executor import MicroscopeExecutor
 from .marshall import ExtendedJsonEncoder, gzip_encode, MIME_TYPE_PICKLE, MIME_TYPE_JSON, pack_array
 
 
@@ -16,7 +22,7 @@ class MicroscopeHandler(BaseHTTPRequestHandler):
                       "condenser_stigmator", "diffraction_shift", "screen_current", "screen_position",
                       "illumination_mode", "condenser_mode", "illuminated_area", "probe_defocus", "convergence_angle",
                       "stem_magnification", "stem_rotation", "spot_size_index", "dark_field_mode", "beam_blanked",
-                      "instrument_mode", 'optics_state', 'state', 'column_valves_open')
+                      "instrument_mode", 'optics_state', 'column_valves_open')
 
     PUT_V1_FORWARD = ("image_shift", "beam_shift", "beam_tilt", "projection_mode", "magnification_index",
                       "defocus", "intensity", "diffraction_shift", "objective_stigmator", "condenser_stigmator",
@@ -25,9 +31,9 @@ class MicroscopeHandler(BaseHTTPRequestHandler):
                       "stem_magnification", "stem_rotation", "beam_blanked", "instrument_mode")
 
     def get_microscope(self):
-        """Return microscope object from server."""
+        """Return microscope object from server (the executor calling the microscope)."""
         assert isinstance(self.server, MicroscopeServer)
-        return self.server.microscope
+        return self.server.executor
     
     def get_accept_types(self):
         """Return list of accepted encodings."""
@@ -71,7 +77,14 @@ class MicroscopeHandler(BaseHTTPRequestHandler):
 
     def do_GET_V1(self, endpoint, query):
         """Handle V1 GET requests"""
-        if endpoint in self.GET_V1_FORWARD:
+        if endpoint == "stage_status" and "wait_until" in query:
+            assert isinstance(self.server, MicroscopeServer)
+            status = str(query["wait_until"][0])
+            timeout = float(query["timeout"][0]) if "timeout" in query else 10.0
+            move_id = int(query["move_id"][0]) if "move_id" in query else None
+            response = self.server.wait_for_stage_status(status, min(timeout, self.server.MAX_WAIT_TIMEOUT),
+                                                         move_id=move_id)
+        elif endpoint in self.GET_V1_FORWARD:
             response = getattr(self.get_microscope(), 'get_' + endpoint)()
         elif endpoint.startswith("detector_param/"):
             name = unquote(endpoint[15:])
@@ -85,10 +98,27 @@ class MicroscopeHandler(BaseHTTPRequestHandler):
         elif endpoint == "acquire":
             detectors = tuple(query.get("detectors", ()))
             response = self.get_microscope().acquire(*detectors)
+            if self.server.flatfield is not None:
+                response = self.server.flatfield.correct_images(self.get_microscope(), response)
             if MIME_TYPE_PICKLE not in self.get_accept_types():
                 response = {key: pack_array(value) for key, value in response.items()}
         elif endpoint == "stem_available":
             response = self.get_microscope().is_stem_available()
+        elif endpoint == "wait_for":
+            assert isinstance(self.server, MicroscopeServer)
+            getter = str(query["getter"][0])
+            if getter not in self.GET_V1_FORWARD and getter != "stem_available":
+                raise KeyError("Unknown getter: '%s'" % getter)
+            predicate = json.loads(query["predicate"][0])
+            timeout = float(query["timeout"][0]) if "timeout" in query else 10.0
+            poll_policy = json.loads(query["poll_policy"][0]) if "poll_policy" in query else None
+            response = self.server.wait_for(getter, predicate, min(timeout, self.server.MAX_WAIT_TIMEOUT),
+                                            poll_policy=poll_policy)
+        elif endpoint == "state":
+            fields = query.get("fields")
+            if fields is not None:
+                fields = [field for value in fields for field in value.split(",") if field]
+            response = self.get_microscope().get_state(fields=fields)
         else:
             raise KeyError("Unknown endpoint: '%s'" % endpoint)
         return response
@@ -108,8 +138,12 @@ class MicroscopeHandler(BaseHTTPRequestHandler):
         elif endpoint == "stage_position":
             method = str(query["method"][0]) if "method" in query else None
             speed = float(query["speed"][0]) if "speed" in query else None
+            wait = bool(int(query["wait"][0])) if "wait" in query else True
             pos = dict((k, decoded_content[k]) for k in decoded_content.keys() if k in STAGE_AXES)
-            self.get_microscope().set_stage_position(pos, method=method, speed=speed)
+            assert isinstance(self.server, MicroscopeServer)
+            move_id = self.server.move_stage(pos, method=method, speed=speed, wait=wait)
+            if move_id is not None:
+                response = {"move_id": move_id}
         elif endpoint.startswith("camera_param/"):
             name = unquote(endpoint[13:])
             ignore_errors = bool(query.get("ignore_errors", [False])[0])
@@ -126,6 +160,9 @@ class MicroscopeHandler(BaseHTTPRequestHandler):
             response = self.get_microscope().set_detector_param(name, decoded_content)
         elif endpoint == "normalize":
             self.get_microscope().normalize(decoded_content)
+        elif endpoint == "state":
+            move_stage = bool(int(query.get("move_stage", [0])[0]))
+            response = self.get_microscope().set_state(decoded_content, move_stage=move_stage)
         elif endpoint == "column_valves_open":
             state = bool(decoded_content)
             assert isinstance(self.server, MicroscopeServer)
@@ -172,22 +209,130 @@ class MicroscopeHandler(BaseHTTPRequestHandler):
             self.build_response(response)
 
 
-class MicroscopeServer(HTTPServer, object):
-    def __init__(self, server_address=('', 8080), microscope_factory=None, allow_column_valves_open=True):
+class MicroscopeServer(ThreadingMixIn, HTTPServer, object):
+    # Maximum time a long-poll request is held
+    MAX_WAIT_TIMEOUT = 60.0
+
+    # Polling interval of stage status during long-poll requests
+    STAGE_POLL_INTERVAL = 0.05
+
+    # Maximum number of stage movements kept until their result is collected
+    MAX_STAGE_MOVES = 64
+
+    daemon_threads = True
+
+    def __init__(self, server_address=('', 8080), microscope_factory=None, allow_column_valves_open=True,
+                 flatfield=None):
         """
         Run a microscope server.
 
+        Requests are handled in separate threads. The microscope is created and called by a
+        :class:`MicroscopeExecutor` (attribute :attr:`executor`), thus all calls of the microscope are done in a
+        single thread. The attribute :attr:`microscope` is still the microscope created by *microscope_factory*.
+
+        Stage movements started with ``wait=0`` are identified by a move id. Long-polls of the stage status with this
+        id wait for the movement and return its error. They are kept until their result was collected (at most
+        :attr:`MAX_STAGE_MOVES` movements, the oldest finished ones are dropped first).
+
         :param server_address: (address, port) tuple
         :param microscope_factory: callable creating the BaseMicroscope instance to use
         :param allow_column_valves_open: Allow remote client to open column valves
+        :param flatfield: Optional :class:`ReferenceLibrary` used to correct acquired images before they are sent
         """
         if microscope_factory is None:
             from .microscope import Microscope
             microscope_factory = Microscope
-        self.microscope = microscope_factory()
+        self.executor = MicroscopeExecutor(microscope_factory, name="temscript-server")
         self.allow_column_valves_open = allow_column_valves_open
+        self.flatfield = flatfield
+        self._stage_moves = OrderedDict()
+        self._stage_move_id = 0
+        self._stage_move_lock = threading.Lock()
         super(MicroscopeServer, self).__init__(server_address, MicroscopeHandler)
 
+    @property
+    def microscope(self):
+        """
+        The microscope created by *microscope_factory* (`None` after the executor was shut down). It must only be
+        called through the :attr:`executor`.
+        """
+        return self.executor.backend
+
+    def move_stage(self, pos, method=None, speed=None, wait=True):
+        """
+        Move stage, if *wait* is false, the movement is only started.
+
+        :returns: Move id of a started movement (for :meth:`wait_for_stage_status`) or `None` if *wait* is true
+        """
+        if wait:
+            self.executor.set_stage_position(pos, method=method, speed=speed)
+            return None
+        move = self.executor.set_stage_position(pos, method=method, speed=speed, wait=False)
+        with self._stage_move_lock:
+            self._stage_move_id += 1
+            move_id = self._stage_move_id
+            self._stage_moves[move_id] = move
+            # Drop oldest finished movements never collected by their owner
+            for old_id in [old_id for old_id, old in self._stage_moves.items() if old.done()]:
+                if len(self._stage_moves) <= self.MAX_STAGE_MOVES:
+                    break
+                del self._stage_moves[old_id]
+        return move_id
+
+    def wait_for(self, getter, predicate, timeout, poll_policy=None):
+        """
+        Wait until *getter* satisfies the serialized *predicate*, at most *timeout* seconds.
+
+        :returns: Dict with keys "satisfied" (whether the predicate holds) and "value" (the last value)
+        """
+        from .polling import Predicate, PollPolicy, getter_name
+        if getter == "stem_available":
+            getter = "is_stem_available"
+        predicate = Predicate.from_dict(predicate)
+        poll_policy = PollPolicy.from_dict(poll_policy) if poll_policy is not None else None
+        try:
+            value = self.executor.wait_for(getter, predicate, timeout=timeout, poll_policy=poll_policy)
+        except TimeoutError:
+            return {"satisfied": False, "value": getattr(self.executor, getter_name(getter))()}
+        return {"satisfied": True, "value": value}
+
+    def wait_for_stage_status(self, status, timeout, move_id=None):
+        """
+        Wait until stage has *status*, at most *timeout* seconds, and return the last status.
+
+        With a *move_id* returned by :meth:`move_stage`, the request first waits for this movement. If the movement
+        failed, its exception is raised. The movement is forgotten, once its result was returned, later requests with
+        the same *move_id* only wait for the stage status. Without *move_id* the request waits for the latest
+        movement, but neither raises its exception nor forgets it.
+        """
+        deadline = time.monotonic() + timeout
+        with self._stage_move_lock:
+            if move_id is not None:
+                move = self._stage_moves.get(move_id)
+            elif self._stage_moves:
+                move = self._stage_moves[next(reversed(self._stage_moves))]
+            else:
+                move = None
+        if move is not None:
+            try:
+                move.result(timeout=timeout)
+            except FutureTimeoutError:
+                # Stage is still moving and the executor is busy
+                return "MOVING"
+            except Exception:
+                if move_id is None:
+                    return self.executor.get_stage_status()
+                raise
+            finally:
+                if move_id is not None and move.done():
+                    with self._stage_move_lock:
+                        self._stage_moves.pop(move_id, None)
+        while True:
+            current = self.executor.get_stage_status()
+            if current == status or time.monotonic() >= deadline:
+                return current
+            time.sleep(min(self.STAGE_POLL_INTERVAL, max(deadline - time.monotonic(), 0.0)))
+
 
 def run_server(argv=None):
     """
@@ -204,16 +349,39 @@ def run_server(argv=None):
                         help="Specify host address on which the the server is listening")
     parser.add_argument("--null", action='store_true', default=False,
                         help="Use NullMicroscope instead of local microscope as backend")
+    parser.add_argument("--replay", type=str, default=None, metavar="FILE",
+                        help="Use ReplayMicroscope replaying the given recording as backend")
+    parser.add_argument("--latency-scale", type=float, default=1.0,
+                        help="Factor applied to the recorded latencies when replaying (defaults to 1.0)")
+    parser.add_argument("--record", type=str, default=None, metavar="FILE",
+                        help="Record all calls to the backend into the given file")
+    parser.add_argument("--flatfield", type=str, default=None, metavar="DIR",
+                        help="Correct unprocessed camera images with the dark and gain references in the given "
+                             "directory")
     args = parser.parse_args(argv)
 
     if args.null:
         from .null_microscope import NullMicroscope
         microscope_factory = NullMicroscope
+    elif args.replay:
+        from .recording_microscope import ReplayMicroscope
+        microscope_factory = lambda: ReplayMicroscope(args.replay, latency_scale=args.latency_scale)
     else:
-        microscope_factory = None
+        from .microscope import Microscope
+        microscope_factory = Microscope
+
+    if args.record:
+        from .recording_microscope import RecordingMicroscope
+        backend_factory = microscope_factory
+        microscope_factory = lambda: RecordingMicroscope(backend_factory(), args.record)
 
     # Create a web server and define the handler to manage the incoming request
-    server = MicroscopeServer((args.host, args.port), microscope_factory=microscope_factory)
+    flatfield = None
+    if args.flatfield:
+        from .flatfield import ReferenceLibrary
+        flatfield = ReferenceLibrary(args.flatfield)
+
+    server = MicroscopeServer((args.host, args.port), microscope_factory=microscope_factory, flatfield=flatfield)
     try:
         print("Started httpserver on host '%s' port %d." % (args.host, args.port))
         print("Press Ctrl+C to stop server.")
@@ -226,5 +394,8 @@ def run_server(argv=None):
 
     finally:
         server.socket.close()
+        if args.record:
+            server.executor.submit("close").result()
+        server.executor.shutdown()
 
     return 0
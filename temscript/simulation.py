@@ -0,0 +1,318 @@
+import time
+import threading
+from fnmatch import fnmatchcase
+
+import numpy as np
+
+
+class RealClock:
+    """
+    Clock running in real time.
+
+    Clocks provide the :meth:`time` and :meth:`sleep` methods. All simulated delays of the :class:`NullMicroscope`
+    are passed through its clock.
+
+    .. versionadded:: 2.2.0
+    """
+    def time(self):
+        """Return current time of the clock in seconds."""
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        """Wait for *seconds* in clock time."""
+        if seconds > 0.0:
+            time.sleep(seconds)
+
+
+class ScaledClock(RealClock):
+    """
+    Clock running *factor* times faster than real time.
+
+    Sleeping for one second in clock time takes 1/*factor* seconds in real time. The time of the clock starts at
+    the current real time.
+
+    .. versionadded:: 2.2.0
+    """
+    def __init__(self, factor):
+        factor = float(factor)
+        if factor <= 0.0:
+            raise ValueError("Factor must be positive.")
+        self.factor = factor
+        self._origin = time.monotonic()
+
+    def time(self):
+        return self._origin + (time.monotonic() - self._origin) * self.factor
+
+    def sleep(self, seconds):
+        if seconds > 0.0:
+            time.sleep(seconds / self.factor)
+
+
+class VirtualClock:
+    """
+    Clock, which only advances when slept on.
+
+    Sleeping returns immediately and advances the time of the clock by the slept duration. Thus simulations take
+    no time at all, while the relative timing of the simulated events is retained. The clock is shared by all
+    threads, every sleep advances the clock regardless of the sleeping thread.
+
+    :param start: Initial time of the clock in seconds
+    :type start: float
+
+    .. versionadded:: 2.2.0
+    """
+    def __init__(self, start=0.0):
+        self._lock = threading.Lock()
+        self._time = float(start)
+
+    def time(self):
+        """Return current time of the clock in seconds."""
+        with self._lock:
+            return self._time
+
+    def sleep(self, seconds):
+        """Advance the clock by *seconds*."""
+        self.advance(seconds)
+
+    def advance(self, seconds):
+        """Advance the clock by *seconds*."""
+        if seconds > 0.0:
+            with self._lock:
+                self._time += seconds
+
+
+def make_clock(spec):
+    """
+    Create clock from *spec*.
+
+    *spec* might be a clock instance (returned as is), `None` or "real" for a :class:`RealClock`,
+    "virtual" for a :class:`VirtualClock`, or a number for a :class:`ScaledClock` with this factor.
+
+    .. versionadded:: 2.2.0
+    """
+    if spec is None or spec == "real":
+        return RealClock()
+    elif spec == "virtual":
+        return VirtualClock()
+    elif isinstance(spec, (int, float)):
+        return ScaledClock(spec)
+    elif hasattr(spec, "sleep") and hasattr(spec, "time"):
+        return spec
+    raise ValueError("Unknown clock: %r" % (spec,))
+
+
+class FixedLatency:
+    """
+    Latency distribution always returning the same *value* (in seconds).
+
+    .. versionadded:: 2.2.0
+    """
+    def __init__(self, value):
+        self.value = max(0.0, float(value))
+
+    def sample(self, rng):
+        """Return latency in seconds, *rng* is the :class:`numpy.random.RandomState` to use."""
+        return self.value
+
+    def __repr__(self):
+        return "FixedLatency(%r)" % self.value
+
+
+class NormalLatency:
+    """
+    Normal distributed latency with *mean* and standard deviation *std* (in seconds).
+
+    Samples are clipped to *minimum*.
+
+    .. versionadded:: 2.2.0
+    """
+    def __init__(self, mean, std, minimum=0.0):
+        self.mean = float(mean)
+        self.std = float(std)
+        self.minimum = float(minimum)
+
+    def sample(self, rng):
+        """Return latency in seconds, *rng* is the :class:`numpy.random.RandomState` to use."""
+        return max(self.minimum, rng.normal(self.mean, self.std))
+
+    def __repr__(self):
+        return "NormalLatency(%r, %r, minimum=%r)" % (self.mean, self.std, self.minimum)
+
+
+class HistogramLatency:
+    """
+    Latency drawn from a histogram.
+
+    The histogram is given by the bin *edges* (in seconds, length N+1) and the *counts* (length N) of the bins.
+    Latencies are uniformly distributed within each bin. Use :meth:`from_samples` to create the distribution from
+    measured latencies.
+
+    .. versionadded:: 2.2.0
+    """
+    def __init__(self, edges, counts):
+        self.edges = np.asarray(edges, dtype=float)
+        counts = np.asarray(counts, dtype=float)
+        if self.edges.ndim != 1 or counts.shape != (len(self.edges) - 1,):
+            raise ValueError("Expected N+1 edges for N counts.")
+        total = counts.sum()
+        if total <= 0:
+            raise ValueError("Histogram is empty.")
+        self.probabilities = counts / total
+
+    @classmethod
+    def from_samples(cls, samples, bins=20):
+        """Create distribution from the measured latencies *samples* (in seconds)."""
+        counts, edges = np.histogram(np.asarray(samples, dtype=float), bins=bins)
+        return cls(edges, counts)
+
+    def sample(self, rng):
+        """Return latency in seconds, *rng* is the :class:`numpy.random.RandomState` to use."""
+        index = rng.choice(len(self.probabilities), p=self.probabilities)
+        return max(0.0, rng.uniform(self.edges[index], self.edges[index + 1]))
+
+    def __repr__(self):
+        return "HistogramLatency(%r, ...)" % (self.edges.tolist(),)
+
+
+def _as_latency(value):
+    """Convert numbers to :class:`FixedLatency`, leave distributions untouched."""
+    if hasattr(value, "sample"):
+        return value
+    return FixedLatency(value)
+
+
+def _lookup(mapping, method_name, default):
+    """Return value for *method_name* from *mapping*, keys are method names or wildcard patterns."""
+    if not isinstance(mapping, dict):
+        return mapping if mapping is not None else default
+    try:
+        return mapping[method_name]
+    except KeyError:
+        pass
+    for pattern, value in mapping.items():
+        if fnmatchcase(method_name, pattern):
+            return value
+    return default
+
+
+class LatencyProfile:
+    """
+    Latency and fault injection profile for the :class:`NullMicroscope`.
+
+    The *latencies* are given as dict, indexed by method name, with the latency distributions as values. Instead of
+    a method name, a wildcard pattern (like "get_*") can be used as key. Exact names take precedence over patterns,
+    patterns are tried in order. Plain numbers are treated as fixed latencies (in seconds). Distributions are
+    :class:`FixedLatency`, :class:`NormalLatency`, :class:`HistogramLatency`, or any other object with a
+    ``sample(rng)`` method. Methods not matched are delayed by the *default* latency.
+
+    *failure_rate* and *timeout_rate* are the probabilities that a call fails with a `RuntimeError`, or that a call
+    raises a `TimeoutError` after waiting *timeout* seconds. Both can be numbers or dicts in the same format as
+    *latencies*.
+
+    Stage movements take time proportional to the distance traveled. The *stage_velocity* dict contains the velocity
+    for each axis (meters/second or radians/second), which is used at a `speed` of 1.0. With the "GO" method all axes
+    move simultaneously, with the "MOVE" method the axes move one after another.
+
+    :param latencies: Latency distributions by method name or pattern
+    :type latencies: Dict[str, Union[float, LatencyDistribution]]
+    :param default: Latency of methods not found in *latencies*
+    :param failure_rate: Probability of injected failures
+    :type failure_rate: Union[float, Dict[str, float]]
+    :param timeout_rate: Probability of injected timeouts
+    :type timeout_rate: Union[float, Dict[str, float]]
+    :param timeout: Time in seconds after which an injected timeout is raised
+    :type timeout: float
+    :param stage_velocity: Velocity of stage axes
+    :type stage_velocity: Dict[str, float]
+    :param seed: Seed for the random number generator
+    :type seed: Optional[int]
+
+    Usage:
+
+        >>> profile = LatencyProfile({"get_*": NormalLatency(0.01, 0.002), "acquire": 0.2}, failure_rate=0.01)
+        >>> microscope = NullMicroscope(latency_profile=profile)
+
+    .. versionadded:: 2.2.0
+    """
+    STAGE_VELOCITY = {'x': 0.5e-3, 'y': 0.5e-3, 'z': 0.1e-3, 'a': 0.1, 'b': 0.1}
+
+    def __init__(self, latencies=None, default=0.0, failure_rate=0.0, timeout_rate=0.0, timeout=10.0,
+                 stage_velocity=None, seed=None):
+        self.latencies = {key: _as_latency(value) for key, value in (latencies or {}).items()}
+        self.default = _as_latency(default)
+        self.failure_rate = failure_rate
+        self.timeout_rate = timeout_rate
+        self.timeout = float(timeout)
+        self.stage_velocity = dict(self.STAGE_VELOCITY)
+        if stage_velocity is not None:
+            self.stage_velocity.update(stage_velocity)
+        self._rng = np.random.RandomState(seed)
+
+    @classmethod
+    def from_recording(cls, filename, bins=20, **kw):
+        """
+        Create profile with the latencies measured in a recording of :class:`RecordingMicroscope`.
+
+        For each recorded method a :class:`HistogramLatency` with *bins* bins is created. Further keywords are
+        passed to the constructor.
+        """
+        from .recording_microscope import load_recording
+        durations = {}
+        for call in load_recording(filename):
+            durations.setdefault(call["method"], []).append(call["duration(s)"])
+        latencies = {name: HistogramLatency.from_samples(samples, bins=bins) for name, samples in durations.items()}
+        return cls(latencies, **kw)
+
+    def sample_latency(self, method_name):
+        """Return latency for a call of *method_name* in seconds."""
+        return _lookup(self.latencies, method_name, self.default).sample(self._rng)
+
+    def sample_fault(self, method_name):
+        """Return "FAILURE", "TIMEOUT", or `None` for a call of *method_name*."""
+        failure_rate = float(_lookup(self.failure_rate, method_name, 0.0))
+        timeout_rate = float(_lookup(self.timeout_rate, method_name, 0.0))
+        if failure_rate <= 0.0 and timeout_rate <= 0.0:
+            return None
+        value = self._rng.uniform()
+        if value < failure_rate:
+            return "FAILURE"
+        elif value < failure_rate + timeout_rate:
+            return "TIMEOUT"
+        return None
+
+    def stage_travel_time(self, start, end, method="GO", speed=None):
+        """
+        Return time in seconds the stage needs to move from position *start* to position *end* (dicts indexed by
+        axis).
+        """
+        speed = float(speed) if speed is not None else 1.0
+        if speed <= 0.0:
+            raise ValueError("Speed must be positive.")
+        times = [abs(end[axis] - start[axis]) / (self.stage_velocity[axis] * speed)
+                 for axis in end.keys() if axis in start]
+        if not times:
+            return 0.0
+        elif method == "MOVE":
+            return sum(times)
+        else:
+            return max(times)
+
+    def simulate_call(self, method_name, clock=None):
+        """
+        Simulate latency and injected faults of a call of *method_name*. The delays are waited on the *clock*
+        (defaults to real time).
+
+        :raises RuntimeError: On injected failures
+        :raises TimeoutError: On injected timeouts
+        """
+        if clock is None:
+            clock = RealClock()
+        fault = self.sample_fault(method_name)
+        if fault == "TIMEOUT":
+            clock.sleep(self.timeout)
+            raise TimeoutError("Injected timeout in %s()" % method_name)
+        delay = self.sample_latency(method_name)
+        if delay > 0.0:
+            clock.sleep(delay)
+        if fault == "FAILURE":
+            raise RuntimeError("Injected failure in %s()" % method_name)
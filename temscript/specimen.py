@@ -0,0 +1,264 @@
+import threading
+
+import numpy as np
+
+
+def _make_rng(seed):
+    """Return numpy random generator (falls back to RandomState on old numpy versions)."""
+    try:
+        return np.random.default_rng(seed)
+    except AttributeError:
+        return np.random.RandomState(seed)
+
+
+def _normal(rng, shape):
+    """Return float32 array with standard normal distributed values."""
+    try:
+        return rng.standard_normal(shape, dtype=np.float32)
+    except TypeError:
+        return rng.standard_normal(shape).astype(np.float32)
+
+
+def _normal_into(rng, out):
+    """Fill float32 array *out* with standard normal distributed values."""
+    try:
+        rng.standard_normal(dtype=np.float32, out=out)
+    except TypeError:
+        out[...] = rng.standard_normal(out.shape)
+
+
+class SyntheticSpecimen:
+    """
+    Synthetic specimen model for the simulated acquisitions of the :class:`NullMicroscope`.
+
+    The specimen is a random, periodic texture with a power law spectrum. It is defined in frequency space on the
+    unbinned detector grid, images are rendered by a single inverse FFT:
+
+        * Shifts (stage position and image shift) are applied as phase ramp, thus subpixel shifts are exact.
+        * Defocus blurs the image with a gaussian envelope, which widens with the absolute defocus.
+        * Binning selects the low frequency part of the spectrum, thus binned images show the same specimen.
+        * The dose (counts per unbinned pixel) is scaled by the exposure time, the binning, the spot size index, and
+          the intensity. Noise follows Poisson statistics (approximated by a normal distribution for large counts).
+
+    The frequency grids and the spectrum are computed once per detector size and binning and reused afterwards.
+    The noise-free image of the last state is cached as well, thus repeated acquisitions without changes of shift or
+    defocus only generate the noise. The noise is computed in the *out* array (float32) or in per-thread scratch
+    buffers. Remaining allocations per image are the returned array if no *out* array is given, and the Poisson
+    samples at low doses (below 50 counts per binned pixel); :meth:`statistics` counts the cached renders.
+    The texture repeats after *max_period* unbinned pixels, larger detectors show several periods. Rendering is
+    thread-safe.
+
+    :param seed: Seed of the specimen texture and the noise
+    :type seed: Optional[int]
+    :param contrast: Standard deviation of the specimen contrast relative to the mean intensity
+    :type contrast: float
+    :param dose_rate: Counts per unbinned pixel per second at spot size index 1 and zero intensity
+    :type dose_rate: float
+    :param defocus_blur: Width of defocus blur in unbinned pixels per meter of defocus
+    :type defocus_blur: float
+    :param spectrum_exponent: Exponent of the power law spectrum of the texture
+    :type spectrum_exponent: float
+    :param max_period: Maximum period of the texture in unbinned pixels
+    :type max_period: int
+
+    .. versionadded:: 2.2.0
+    """
+    SPOT_SIZE_FACTOR = 0.6      # Relative beam current per spot size index step
+    INTENSITY_WIDTH = 0.2       # Intensity deviation (arbitrary units) at which the dose is halved
+
+    def __init__(self, seed=None, contrast=0.3, dose_rate=100.0, defocus_blur=3e6, spectrum_exponent=1.5,
+                 max_period=4096):
+        self.max_period = int(max_period)
+        self.contrast = float(contrast)
+        self.dose_rate = float(dose_rate)
+        self.defocus_blur = float(defocus_blur)
+        self.spectrum_exponent = float(spectrum_exponent)
+        self._seed = seed
+        self._rng = _make_rng(seed)
+        self._rng_lock = threading.Lock()
+        self._cache_lock = threading.Lock()
+        self._spectra = {}
+        self._grids = {}
+        self._bases = {}
+        self._local = threading.local()
+        self._renders = 0
+        self._base_hits = 0
+
+    def _master_spectrum(self, shape):
+        """Return (cached) half spectrum of the specimen texture on an unbinned grid of *shape*."""
+        spectrum = self._spectra.get(shape)
+        if spectrum is None:
+            rng = _make_rng(self._seed)
+            ky = np.fft.fftfreq(shape[0]).astype(np.float32)
+            kx = np.fft.rfftfreq(shape[1]).astype(np.float32)
+            k2 = ky[:, np.newaxis] ** 2 + kx[np.newaxis, :] ** 2
+            amplitude = (k2 + (2.0 / min(shape)) ** 2) ** (-0.5 * self.spectrum_exponent)
+            amplitude[0, 0] = 0.0
+            noise = _normal(rng, k2.shape) + 1j * _normal(rng, k2.shape)
+            spectrum = (amplitude * noise).astype(np.complex64)
+            # Normalize standard deviation of the texture to 1.0
+            texture = np.fft.irfft2(spectrum, s=shape)
+            spectrum /= max(float(np.std(texture)), 1e-30)
+            self._spectra[shape] = spectrum
+        return spectrum
+
+    def _grid(self, shape, binning):
+        """
+        Return (cached) spectrum, frequencies and squared frequencies for an image of the unbinned *shape*
+        with *binning*.
+        """
+        key = shape, binning
+        with self._cache_lock:
+            grid = self._grids.get(key)
+            if grid is None:
+                master = self._master_spectrum(shape)
+                ny, nx = shape[0] // binning, shape[1] // binning
+                half = ny // 2
+                spectrum = np.empty((ny, nx // 2 + 1), dtype=np.complex64)
+                spectrum[:half, :] = master[:half, :nx // 2 + 1]
+                spectrum[half:, :] = master[shape[0] - (ny - half):, :nx // 2 + 1]
+                spectrum *= (ny * nx) / float(shape[0] * shape[1])
+                ky = np.fft.fftfreq(ny).astype(np.float32)
+                kx = np.fft.rfftfreq(nx).astype(np.float32)
+                k2 = ky[:, np.newaxis] ** 2 + kx[np.newaxis, :] ** 2
+                grid = spectrum, ky, kx, k2
+                self._grids[key] = grid
+        return grid
+
+    def relative_dose(self, spot_size_index=1, intensity=0.0):
+        """Return dose relative to spot size index 1 and zero intensity."""
+        spot_factor = self.SPOT_SIZE_FACTOR ** (max(int(spot_size_index), 1) - 1)
+        intensity_factor = 1.0 / (1.0 + (float(intensity) / self.INTENSITY_WIDTH) ** 2)
+        return spot_factor * intensity_factor
+
+    def render(self, shape, binning=1, shift=(0.0, 0.0), defocus=0.0, dose=None, crop=None, dtype=np.float32,
+               out=None):
+        """
+        Render image of the specimen.
+
+        :param shape: Size of the detector in unbinned pixels, either an integer (quadratic detector) or a
+            (height, width) tuple.
+        :type shape: Union[int, Tuple[int, int]]
+        :param binning: Binning
+        :type binning: int
+        :param shift: (x, y) tuple with the shift of the specimen in unbinned pixels
+        :param defocus: Defocus in meters
+        :type defocus: float
+        :param dose: Mean counts per unbinned pixel. If `None`, the noise-free image with mean 1.0 is returned.
+        :type dose: Optional[float]
+        :param crop: If given, only the center region of this size (in binned pixels) is returned. Either an integer
+            or a (height, width) tuple.
+        :type crop: Union[int, Tuple[int, int], None]
+        :param dtype: Data type of the returned image. For integer types, the values are clipped to the range
+            of the type.
+        :param out: Optional array the image is written to. It must have the shape of the image and the
+            given *dtype*.
+        :type out: Optional[numpy.ndarray]
+        :returns: Numpy array with image
+        """
+        shape = (int(shape), int(shape)) if np.ndim(shape) == 0 else (int(shape[0]), int(shape[1]))
+        binning = max(int(binning), 1)
+        out_shape = shape[0] // binning, shape[1] // binning
+        if crop is not None:
+            crop = (int(crop), int(crop)) if np.ndim(crop) == 0 else (int(crop[0]), int(crop[1]))
+            out_shape = min(out_shape[0], crop[0]), min(out_shape[1], crop[1])
+
+        dtype = np.dtype(dtype)
+        if out is not None and (out.shape != out_shape or out.dtype != dtype):
+            raise ValueError("Output array has wrong shape or data type.")
+        base = self._base(shape, binning, (float(shift[0]), float(shift[1])), float(defocus), out_shape)
+
+        # Noise is added in a float32 work buffer: *out* itself, or a scratch buffer of the calling thread
+        if out is None:
+            work = np.empty(out_shape, dtype=np.float32)
+        elif dtype == np.float32:
+            work = out
+        else:
+            work = self._scratch(out_shape)[0]
+
+        if dose is None:
+            np.copyto(work, base)
+        else:
+            mean = float(dose) * binning * binning
+            np.multiply(base, np.float32(mean), out=work)
+            if mean > 50.0:
+                _, noise, root = self._scratch(out_shape)
+                with self._rng_lock:
+                    _normal_into(self._rng, noise)
+                np.sqrt(work, out=root)
+                noise *= root
+                work += noise
+                np.maximum(work, 0.0, out=work)
+                np.rint(work, out=work)
+            else:
+                # Poisson samples are allocated by numpy
+                with self._rng_lock:
+                    work[...] = self._rng.poisson(work)
+
+        if dtype.kind in "iu":
+            info = np.iinfo(dtype)
+            np.clip(work, info.min, info.max, out=work)
+        if out is None:
+            return work.astype(dtype, copy=False)
+        if work is not out:
+            np.copyto(out, work, casting='unsafe')
+        return out
+
+    def _base(self, shape, binning, shift, defocus, out_shape):
+        """
+        Return noise-free image (mean 1.0) for the given parameters. The last image of each (shape, binning,
+        out_shape) combination is cached, thus repeated acquisitions of the same state skip the inverse FFT. The
+        returned array must not be modified.
+        """
+        key = shape, binning, out_shape
+        with self._cache_lock:
+            self._renders += 1
+            cached = self._bases.get(key)
+            if cached is not None and cached[0] == (shift, defocus):
+                self._base_hits += 1
+                return cached[1]
+
+        # The specimen is periodic, large detectors show repetitions of the texture
+        period = min(shape[0], self.max_period), min(shape[1], self.max_period)
+        spectrum, ky, kx, k2 = self._grid(period, binning)
+        ny, nx = period[0] // binning, period[1] // binning
+
+        # Shift by phase ramp (separable), blur by gaussian envelope
+        ramp_y = np.exp(-2j * np.pi * ky * (shift[1] / binning)).astype(np.complex64)
+        ramp_x = np.exp(-2j * np.pi * kx * (shift[0] / binning)).astype(np.complex64)
+        transfer = spectrum * ramp_y[:, np.newaxis]
+        transfer *= ramp_x[np.newaxis, :]
+        sigma = abs(defocus) * self.defocus_blur / binning
+        if sigma > 0.0:
+            transfer *= np.exp(np.float32(-2.0 * (np.pi * sigma) ** 2) * k2)
+        image = np.fft.irfft2(transfer, s=(ny, nx)).astype(np.float32, copy=False)
+
+        # Cut center region of the detector (wrapping around the period)
+        if out_shape != (ny, nx):
+            start_y = (shape[0] // binning - out_shape[0]) // 2
+            start_x = (shape[1] // binning - out_shape[1]) // 2
+            image = np.take(image, np.arange(start_y, start_y + out_shape[0]), axis=0, mode='wrap')
+            image = np.take(image, np.arange(start_x, start_x + out_shape[1]), axis=1, mode='wrap')
+
+        image *= np.float32(self.contrast)
+        image += np.float32(1.0)
+        np.maximum(image, 0.0, out=image)
+        with self._cache_lock:
+            self._bases[key] = (shift, defocus), image
+        return image
+
+    def _scratch(self, shape):
+        """Return three float32 scratch buffers of *shape* owned by the calling thread."""
+        buffers = getattr(self._local, "buffers", None)
+        if buffers is None or buffers[0].shape != shape:
+            buffers = tuple(np.empty(shape, dtype=np.float32) for n in range(3))
+            self._local.buffers = buffers
+        return buffers
+
+    def statistics(self):
+        """
+        Return dict with the number of rendered images ("renders") and the number of renders, which reused the
+        cached noise-free image ("cached").
+        """
+        with self._cache_lock:
+            return {"renders": self._renders, "cached": self._base_hits}
@@ -0,0 +1,73 @@
+import asyncio
+from concurrent.futures import Future
+
+
+class StageMoveHandle:
+    """
+    Handle of a stage movement started by ``set_stage_position(..., wait=False)``.
+
+    The handle can be polled (:meth:`done`), waited for (:meth:`wait`, :meth:`result`), or awaited in coroutines.
+
+    :param future: Future, which is resolved when the movement is finished
+    :type future: concurrent.futures.Future
+
+    Usage:
+
+        >>> move = microscope.set_stage_position(x=1e-6, wait=False)
+        >>> process(previous_image)         # Overlaps with stage travel
+        >>> move.result()                   # Raises exception if the movement failed
+
+    .. versionadded:: 2.2.0
+    """
+    def __init__(self, future):
+        self._future = future
+
+    @classmethod
+    def completed(cls, exception=None):
+        """Return handle of an already finished movement (which failed with *exception*, if given)."""
+        future = Future()
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(None)
+        return cls(future)
+
+    @property
+    def future(self):
+        """The underlying :class:`concurrent.futures.Future`."""
+        return self._future
+
+    def done(self):
+        """Return whether the movement is finished."""
+        return self._future.done()
+
+    def wait(self, timeout=None):
+        """
+        Wait until the movement is finished, at most *timeout* seconds.
+
+        :returns: Whether the movement is finished
+        """
+        try:
+            self._future.exception(timeout=timeout)
+        except Exception:
+            pass
+        return self._future.done()
+
+    def result(self, timeout=None):
+        """
+        Wait until the movement is finished, at most *timeout* seconds.
+
+        :raises concurrent.futures.TimeoutError: If the movement didn't finish in time
+        :raises Exception: Exception raised by the movement
+        """
+        return self._future.result(timeout=timeout)
+
+    def add_done_callback(self, callback):
+        """Call *callback* with the handle when the movement is finished."""
+        self._future.add_done_callback(lambda future: callback(self))
+
+    def __await__(self):
+        return iter(asyncio.wrap_future(self._future))
+
+    def __repr__(self):
+        return "<StageMoveHandle %s>" % ("done" if self.done() else "moving")
@@ -0,0 +1,362 @@
+import json
+import threading
+import time
+
+import numpy as np
+
+from .base_microscope import STATE_FIELDS
+from ._pipeline import Pipeline
+
+
+TELEMETRY_FORMAT = "temscript-telemetry"
+TELEMETRY_VERSION = 1
+TELEMETRY_HEADER_SIZE = 4096
+
+
+def _flatten_paths(value, prefix=(), name=""):
+    """Return list of (column name, key path) tuples for all numeric leaves of *value*."""
+    if isinstance(value, dict):
+        paths = []
+        for key in sorted(value.keys(), key=str):
+            paths.extend(_flatten_paths(value[key], prefix + (key,), "%s.%s" % (name, key)))
+        return paths
+    elif isinstance(value, (list, tuple)) or hasattr(value, "tolist") and np.ndim(value) > 0:
+        paths = []
+        for index, item in enumerate(value):
+            paths.extend(_flatten_paths(item, prefix + (index,), "%s.%d" % (name, index)))
+        return paths
+    elif isinstance(value, (bool, int, float, np.number, np.bool_)):
+        return [(name, prefix)]
+    return []
+
+
+def _write_header(fp, columns, dtype):
+    header = json.dumps({
+        "format": TELEMETRY_FORMAT,
+        "version": TELEMETRY_VERSION,
+        "columns": columns,
+        "dtype": np.dtype(dtype).str
+    }).encode("utf-8")
+    if len(header) >= TELEMETRY_HEADER_SIZE:
+        raise ValueError("Too many telemetry columns.")
+    fp.write(header + b" " * (TELEMETRY_HEADER_SIZE - len(header) - 1) + b"\n")
+
+
+def _window_indices(times, start, end):
+    """Return slice of sorted *times* within [start, end)."""
+    lo = np.searchsorted(times, start, side="left") if start is not None else 0
+    hi = np.searchsorted(times, end, side="left") if end is not None else len(times)
+    return slice(lo, hi)
+
+
+def load_telemetry(filename, start=None, end=None, columns=None):
+    """
+    Load samples from a telemetry file written by :class:`TelemetryRecorder`.
+
+    The file is memory mapped, only the requested window is read.
+
+    :param filename: Name of telemetry file
+    :type filename: str
+    :param start: Start of window (in seconds since the epoch, inclusive), `None` for first sample
+    :type start: Optional[float]
+    :param end: End of window (in seconds since the epoch, exclusive), `None` for last sample
+    :type end: Optional[float]
+    :param columns: Names of columns to return. By default all columns are returned.
+    :type columns: Optional[Iterable[str]]
+    :returns: Dict with column names as keys and arrays as values. The timestamps are in column "time".
+
+    .. versionadded:: 2.2.0
+    """
+    with open(filename, "rb") as fp:
+        header = json.loads(fp.read(TELEMETRY_HEADER_SIZE).decode("utf-8"))
+        if header.get("format") != TELEMETRY_FORMAT:
+            raise ValueError("File '%s' is not a temscript telemetry file." % filename)
+        if header.get("version", 0) > TELEMETRY_VERSION:
+            raise ValueError("Unsupported telemetry version: %s" % header.get("version"))
+        fp.seek(0, 2)
+        size = fp.tell()
+    all_columns = header["columns"]
+    dtype = np.dtype(header["dtype"])
+    rows = (size - TELEMETRY_HEADER_SIZE) // (dtype.itemsize * len(all_columns))
+    if rows <= 0:
+        data = np.zeros((0, len(all_columns)), dtype=dtype)
+    else:
+        data = np.memmap(filename, dtype=dtype, mode="r", offset=TELEMETRY_HEADER_SIZE,
+                         shape=(rows, len(all_columns)))
+    window = _window_indices(data[:, 0], start, end)
+    columns = list(columns) if columns is not None else all_columns
+    return {column: np.array(data[window, all_columns.index(column)]) for column in columns}
+
+
+class TelemetryRecorder:
+    """
+    Records selected values of a microscope at a fixed rate.
+
+    The values are stored in a columnar ring buffer of fixed size, thus the memory usage stays constant. Each
+    numeric value is stored in a separate column, nested values are flattened: e.g. the field "stage_position" is
+    stored in the columns "stage_position.x", "stage_position.y", ..., and "beam_shift" in the columns "beam_shift.0"
+    and "beam_shift.1". Non-numeric values (like strings) are skipped. The column "time" contains the timestamp
+    (in seconds since the epoch) of each sample. The columns are determined by the first sample, values missing in
+    later samples are stored as NaN.
+
+    The *fields* are the names of state fields (see :data:`STATE_FIELDS`), which are read by a single
+    :meth:`BaseMicroscope.get_state` call per sample, or the names of other values with a getter without arguments
+    (e.g. "vacuum" for :meth:`BaseMicroscope.get_vacuum`).
+
+    If a *filename* is given, the samples are appended to this file every *spill_interval* seconds (or earlier, if
+    half of the buffer is filled with samples not yet written). The samples are copied out of the ring buffer and
+    written by a background thread, thus :meth:`store` doesn't wait for the disk. The file consists of a JSON header
+    (padded to 4096 bytes) followed by the samples as rows of float64 values. Use :func:`load_telemetry` to read the
+    file.
+
+    Sampling is done either by a background thread (:meth:`start` and :meth:`stop`) or by calling :meth:`sample`.
+
+    :param microscope: Microscope to sample
+    :type microscope: BaseMicroscope
+    :param fields: Names of fields to sample
+    :type fields: Iterable[str]
+    :param rate: Sampling rate of background thread in Hz
+    :type rate: float
+    :param capacity: Number of samples kept in memory
+    :type capacity: int
+    :param filename: Optional name of file the samples are appended to
+    :type filename: Optional[str]
+    :param spill_interval: Interval in seconds, in which the samples are appended to the file
+    :type spill_interval: float
+
+    Usage:
+
+        >>> with TelemetryRecorder(microscope, ["stage_position", "defocus", "vacuum"], rate=20.0,
+        ...                        filename="drift.telemetry") as recorder:
+        ...     time.sleep(3600)
+        >>> data = load_telemetry("drift.telemetry")
+        >>> data["time"], data["stage_position.x"]
+
+    .. versionadded:: 2.2.0
+    """
+    def __init__(self, microscope, fields, rate=10.0, capacity=65536, filename=None, spill_interval=10.0):
+        if isinstance(fields, str):
+            fields = [fields]
+        self.fields = list(fields)
+        for field in self.fields:
+            if field not in STATE_FIELDS and not callable(getattr(microscope, "get_" + field, None)):
+                raise KeyError("Unknown state field: '%s'" % (field,))
+        self.rate = float(rate)
+        if self.rate <= 0.0:
+            raise ValueError("Rate must be positive.")
+        self.capacity = int(capacity)
+        self.filename = filename
+        self.spill_interval = float(spill_interval)
+        self._microscope = microscope
+        self._state_fields = [field for field in self.fields if field in STATE_FIELDS]
+        self._getter_fields = [field for field in self.fields if field not in STATE_FIELDS]
+        self._lock = threading.Lock()
+        self._paths = None
+        self._buffer = None
+        self._count = 0             # Total number of samples
+        self._spilled = 0           # Number of samples written to file
+        self._lost = 0              # Number of samples overwritten before written to file
+        self._overruns = 0
+        self._errors = 0
+        self._store_time = 0.0
+        self._file = None
+        self._writer = None
+        self._last_spill = time.monotonic()
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def columns(self):
+        """List of column names (`None` before the first sample)."""
+        with self._lock:
+            return [name for name, path in self._paths] if self._paths is not None else None
+
+    def _read(self):
+        values = self._microscope.get_state(fields=self._state_fields) if self._state_fields else {}
+        for field in self._getter_fields:
+            values[field] = getattr(self._microscope, "get_" + field)()
+        return values
+
+    def _init_schema(self, values):
+        """Create columns and buffer from first sample."""
+        paths = [("time", None)]
+        for field in self.fields:
+            if field in values:
+                paths.extend(_flatten_paths(values[field], (field,), field))
+        self._paths = paths
+        self._buffer = np.full((len(paths), self.capacity), np.nan, dtype=np.float64)
+        if self.filename is not None:
+            self._file = open(self.filename, "wb")
+            _write_header(self._file, [name for name, path in paths], np.float64)
+            self._file.flush()
+            self._writer = Pipeline(self._write_rows, workers=1, max_pending=4)
+
+    def sample(self):
+        """Read the fields once and store the values."""
+        timestamp = time.time()
+        values = self._read()
+        self.store(values, timestamp)
+
+    def store(self, values, timestamp=None):
+        """
+        Store sample of *values* (dict indexed by field) with *timestamp* (defaults to current time).
+
+        :param values: Values indexed by field name
+        :type values: Dict[str, Any]
+        :param timestamp: Time of sample in seconds since epoch
+        :type timestamp: Optional[float]
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        start = time.perf_counter()
+        with self._lock:
+            if self._paths is None:
+                self._init_schema(values)
+            index = self._count % self.capacity
+            column = self._buffer[:, index]
+            column[0] = timestamp
+            for n in range(1, len(self._paths)):
+                value = values
+                try:
+                    for key in self._paths[n][1]:
+                        value = value[key]
+                    column[n] = value
+                except (KeyError, IndexError, TypeError, ValueError):
+                    column[n] = np.nan
+            self._count += 1
+            if self._count - self._spilled > self.capacity:
+                self._lost += self._count - self._spilled - self.capacity
+                self._spilled = self._count - self.capacity
+            if self._file is not None and (2 * (self._count - self._spilled) >= self.capacity or
+                                           time.monotonic() - self._last_spill >= self.spill_interval):
+                self._spill_locked()
+            self._store_time += time.perf_counter() - start
+
+    def flush(self):
+        """Write all samples to the file, blocks until they are written."""
+        with self._lock:
+            if self._file is None:
+                return
+            self._spill_locked()
+            writer = self._writer
+        writer.join()
+
+    def _spill_locked(self):
+        # Rows are copied under the lock, the writer thread writes them in order
+        self._last_spill = time.monotonic()
+        if self._count == self._spilled:
+            return
+        first = self._spilled % self.capacity
+        last = self._count % self.capacity
+        if first < last:
+            rows = self._buffer[:, first:last]
+        else:
+            rows = np.concatenate((self._buffer[:, first:], self._buffer[:, :last]), axis=1)
+        self._writer.submit(self._file, np.ascontiguousarray(rows.T))
+        self._spilled = self._count
+
+    @staticmethod
+    def _write_rows(fp, rows):
+        fp.write(rows.data)
+        fp.flush()
+
+    def window(self, start=None, end=None, columns=None):
+        """
+        Return samples kept in memory, which were taken in the time window [*start*, *end*).
+
+        :param start: Start of window (in seconds since the epoch, inclusive), `None` for oldest sample in memory
+        :type start: Optional[float]
+        :param end: End of window (in seconds since the epoch, exclusive), `None` for latest sample
+        :type end: Optional[float]
+        :param columns: Names of columns to return. By default all columns are returned.
+        :type columns: Optional[Iterable[str]]
+        :returns: Dict with column names as keys and arrays (copies) as values.
+        """
+        with self._lock:
+            if self._paths is None:
+                return {}
+            names = [name for name, path in self._paths]
+            indices = [names.index(column) for column in columns] if columns is not None else range(len(names))
+            count = min(self._count, self.capacity)
+            first = (self._count - count) % self.capacity
+            order = np.roll(np.arange(self.capacity), -first)[:count] if first else slice(0, count)
+            times = self._buffer[0, order]
+            selected = _window_indices(times, start, end)
+            return {names[index]: self._buffer[index, order][selected].copy() for index in indices}
+
+    def statistics(self):
+        """
+        Return dict with statistics of the recorder:
+
+            * "samples": Total number of samples
+            * "spilled": Number of samples written (or queued for writing) to file
+            * "lost": Number of samples overwritten before they were written to file (always all samples not kept
+              in memory, if no file is used)
+            * "overruns": Number of samples skipped by the background thread, since reading took too long
+            * "errors": Number of samples of the background thread, which failed
+            * "store_time(s)": Mean time for storing a sample (without reading the values) in seconds
+        """
+        with self._lock:
+            return {
+                "samples": self._count,
+                "spilled": self._spilled if self.filename is not None else 0,
+                "lost": self._lost,
+                "overruns": self._overruns,
+                "errors": self._errors,
+                "store_time(s)": self._store_time / self._count if self._count else 0.0
+            }
+
+    def start(self):
+        """Start sampling in background thread."""
+        if self._thread is not None:
+            raise RuntimeError("Recorder is already running.")
+        with self._lock:
+            if self._paths is not None and self.filename is not None and self._file is None:
+                self._file = open(self.filename, "ab")
+                self._writer = Pipeline(self._write_rows, workers=1, max_pending=4)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="temscript-telemetry")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop background thread, write remaining samples and close the file."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            if self._file is None:
+                return
+            self._spill_locked()
+            fp, writer = self._file, self._writer
+            self._file = self._writer = None
+        try:
+            writer.close()
+        finally:
+            fp.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def _run(self):
+        period = 1.0 / self.rate
+        next_time = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                self.sample()
+            except Exception:
+                with self._lock:
+                    self._errors += 1
+            next_time += period
+            now = time.monotonic()
+            if now > next_time:
+                skipped = int((now - next_time) / period) + 1
+                with self._lock:
+                    self._overruns += skipped
+                next_time += skipped * period
+            self._stop.wait(next_time - now)
@@ -0,0 +1,321 @@
+import json
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from ._pipeline import Pipeline
+from .marshall import ExtendedJsonEncoder
+from .version import __version__
+
+
+# TIFF field types
+_ASCII = 2
+_SHORT = 3
+_LONG = 4
+_LONG8 = 16
+
+# TIFF tags
+_NEW_SUBFILE_TYPE = 254
+_IMAGE_WIDTH = 256
+_IMAGE_LENGTH = 257
+_BITS_PER_SAMPLE = 258
+_COMPRESSION = 259
+_PHOTOMETRIC = 262
+_IMAGE_DESCRIPTION = 270
+_STRIP_OFFSETS = 273
+_SAMPLES_PER_PIXEL = 277
+_ROWS_PER_STRIP = 278
+_STRIP_BYTE_COUNTS = 279
+_PLANAR_CONFIGURATION = 284
+_SOFTWARE = 305
+_SAMPLE_FORMAT = 339
+
+_COMPRESSION_NONE = 1
+_COMPRESSION_DEFLATE = 8
+
+# SampleFormat by numpy dtype kind
+_SAMPLE_FORMATS = {"u": 1, "i": 2, "f": 3}
+_KINDS = {value: key for key, value in _SAMPLE_FORMATS.items()}
+
+_FIELD_SIZES = {_ASCII: 1, _SHORT: 2, _LONG: 4, _LONG8: 8}
+_FIELD_DTYPES = {_SHORT: "<u2", _LONG: "<u4", _LONG8: "<u8"}
+
+
+def _entry_values(field_type, values):
+    """Return bytes of the values of an IFD entry."""
+    if field_type == _ASCII:
+        return values
+    return np.asarray(values, dtype=_FIELD_DTYPES[field_type]).tobytes()
+
+
+class TiffWriter:
+    """
+    Writes frames incrementally into a multi-page BigTIFF file, without dependencies.
+
+    Each frame is written as page (directory) of the file, immediately after the frame was compressed. Only the
+    offset of the last page is kept in memory, thus memory use doesn't depend on the length of the series. The file
+    is valid after each frame.
+
+    With *compression* "zlib", the strips of the frames are compressed (deflate) in a pool of *workers* threads,
+    while the previous frames are written by a background thread. At most *max_pending* frames are waiting,
+    afterwards :meth:`append` blocks. Without compression, frames are written in the background thread.
+
+    The metadata of each frame (e.g. the state read by :meth:`acquire`) is stored as JSON in the ImageDescription tag.
+
+    The writer can be used as *writer* of the acquisition engines (e.g. :class:`TiltSeries`), then the image of
+    *detector* (defaults to the only image) is stored, the metadata dict of the engine (without the images) is stored
+    as description.
+
+    :param filename: Name of TIFF file
+    :type filename: str
+    :param compression: None or "zlib"
+    :type compression: Optional[str]
+    :param level: Compression level (1 to 9)
+    :type level: int
+    :param strip_size: Approximate size of strips in bytes
+    :type strip_size: int
+    :param workers: Number of compression threads
+    :type workers: int
+    :param max_pending: Maximum number of frames waiting to be written
+    :type max_pending: int
+    :param detector: Detector written if used as writer of acquisition engines
+    :type detector: Optional[str]
+
+    Usage:
+
+        >>> with TiffWriter("series.tif", compression="zlib") as writer:
+        ...     for n in range(100):
+        ...         writer.acquire(microscope, "BM-Ceta", fields=["stage_position", "defocus"])
+        >>> frames, metadata = load_tiff("series.tif")
+
+    .. versionadded:: 2.2.0
+    """
+    def __init__(self, filename, compression=None, level=6, strip_size=256 * 1024, workers=2, max_pending=4,
+                 detector=None):
+        if compression not in (None, "zlib"):
+            raise ValueError("Unknown compression: %r" % compression)
+        self.filename = filename
+        self.compression = compression
+        self.level = int(level)
+        self.strip_size = max(int(strip_size), 1)
+        self.detector = detector
+        self._fp = open(filename, "wb")
+        # BigTIFF header, the offset of the first page is written with the first page
+        self._fp.write(b"II" + np.array([43, 8, 0], dtype="<u2").tobytes() + np.zeros(1, dtype="<u8").tobytes())
+        self._next_pointer = 8          # Position of the offset of the next page
+        self._lock = threading.Lock()
+        self._count = 0
+        self._bytes = 0
+        self._raw_bytes = 0
+        self._write_time = 0.0
+        self._compressor = ThreadPoolExecutor(max_workers=max(int(workers), 1)) if compression else None
+        self._pipeline = Pipeline(self._write, workers=1, max_pending=max_pending)
+        self._closed = False
+
+    @property
+    def count(self):
+        """Number of written frames."""
+        with self._lock:
+            return self._count
+
+    def append(self, frame, metadata=None):
+        """
+        Queue *frame* for writing.
+
+        :param frame: Image
+        :type frame: numpy.ndarray
+        :param metadata: Optional dict stored as JSON ImageDescription
+        :type metadata: Optional[Dict[str, Any]]
+        """
+        if self._closed:
+            raise ValueError("Writer is closed.")
+        frame = np.ascontiguousarray(frame)
+        if frame.ndim != 2:
+            raise ValueError("Frames must be 2D arrays.")
+        if frame.dtype.kind not in _SAMPLE_FORMATS:
+            raise ValueError("Unsupported dtype for TIFF files: %s" % frame.dtype)
+        frame = frame.astype(frame.dtype.newbyteorder("<"), copy=False)
+        description = json.dumps(metadata if metadata is not None else {}, cls=ExtendedJsonEncoder)
+
+        row_size = frame.shape[1] * frame.dtype.itemsize
+        rows_per_strip = max(min(self.strip_size // row_size, frame.shape[0]), 1)
+        strips = [frame[row:row + rows_per_strip] for row in range(0, frame.shape[0], rows_per_strip)]
+        if self._compressor is not None:
+            strips = [self._compressor.submit(zlib.compress, strip.tobytes(), self.level) for strip in strips]
+        self._pipeline.submit(frame.shape, frame.dtype, rows_per_strip, strips, description)
+
+    def acquire(self, microscope, detector, fields=None):
+        """
+        Acquire *detector* and append the image, with the time and the state *fields* as metadata.
+
+        :returns: The image
+        """
+        state = microscope.get_state(fields=fields) if fields else {}
+        timestamp = time.time()
+        image = microscope.acquire(detector)[detector]
+        self.append(image, {"time": timestamp, "state": state})
+        return image
+
+    def __call__(self, key, images, metadata):
+        # Writer interface of the acquisition engines
+        if self.detector is not None:
+            image = images[self.detector]
+        elif len(images) == 1:
+            image = next(iter(images.values()))
+        else:
+            raise ValueError("Detector must be given for acquisitions of several detectors.")
+        self.append(image, {name: value for name, value in metadata.items() if name != "images"})
+
+    def _write(self, shape, dtype, rows_per_strip, strips, description):
+        start = time.perf_counter()
+        fp = self._fp
+        offsets = []
+        counts = []
+        for strip in strips:
+            data = strip.result() if self._compressor is not None else strip.tobytes()
+            offsets.append(fp.tell())
+            counts.append(len(data))
+            fp.write(data)
+        raw_bytes = shape[0] * shape[1] * dtype.itemsize
+
+        description = description.encode("utf-8") + b"\0"
+        software = ("temscript %s" % __version__).encode("ascii") + b"\0"
+        entries = [
+            (_NEW_SUBFILE_TYPE, _LONG, 1, 0),
+            (_IMAGE_WIDTH, _LONG, 1, shape[1]),
+            (_IMAGE_LENGTH, _LONG, 1, shape[0]),
+            (_BITS_PER_SAMPLE, _SHORT, 1, dtype.itemsize * 8),
+            (_COMPRESSION, _SHORT, 1, _COMPRESSION_DEFLATE if self._compressor is not None else _COMPRESSION_NONE),
+            (_PHOTOMETRIC, _SHORT, 1, 1),
+            (_IMAGE_DESCRIPTION, _ASCII, len(description), description),
+            (_STRIP_OFFSETS, _LONG8, len(offsets), offsets),
+            (_SAMPLES_PER_PIXEL, _SHORT, 1, 1),
+            (_ROWS_PER_STRIP, _LONG, 1, rows_per_strip),
+            (_STRIP_BYTE_COUNTS, _LONG8, len(counts), counts),
+            (_PLANAR_CONFIGURATION, _SHORT, 1, 1),
+            (_SOFTWARE, _ASCII, len(software), software),
+            (_SAMPLE_FORMAT, _SHORT, 1, _SAMPLE_FORMATS[dtype.kind]),
+        ]
+
+        # Values not fitting into the entries are written before the directory
+        fields = []
+        for tag, field_type, count, values in entries:
+            data = _entry_values(field_type, values)
+            if len(data) > 8:
+                if fp.tell() % 2:
+                    fp.write(b"\0")
+                offset = fp.tell()
+                fp.write(data)
+                data = np.array(offset, dtype="<u8").tobytes()
+            fields.append(np.array([tag, field_type], dtype="<u2").tobytes() + np.array(count, dtype="<u8").tobytes()
+                          + data.ljust(8, b"\0"))
+
+        if fp.tell() % 2:
+            fp.write(b"\0")
+        position = fp.tell()
+        fp.write(np.array(len(fields), dtype="<u8").tobytes() + b"".join(fields) + np.zeros(1, dtype="<u8").tobytes())
+        next_pointer = fp.tell() - 8
+
+        # Link page after it is complete
+        fp.seek(self._next_pointer)
+        fp.write(np.array(position, dtype="<u8").tobytes())
+        fp.seek(0, 2)
+        fp.flush()
+        self._next_pointer = next_pointer
+
+        with self._lock:
+            self._count += 1
+            self._bytes += sum(counts)
+            self._raw_bytes += raw_bytes
+            self._write_time += time.perf_counter() - start
+
+    def flush(self):
+        """Wait until all queued frames are written."""
+        self._pipeline.join()
+
+    def close(self):
+        """Write all queued frames and close the file."""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._pipeline.close()
+        finally:
+            if self._compressor is not None:
+                self._compressor.shutdown(wait=True)
+            self._fp.close()
+
+    def statistics(self):
+        """
+        Return dict with the number of written frames ("count"), the total size of the image data ("bytes"), its
+        uncompressed size ("raw_bytes"), and the time writing the frames ("write(s)", including waiting for the
+        compression).
+        """
+        with self._lock:
+            return {"count": self._count, "bytes": self._bytes, "raw_bytes": self._raw_bytes,
+                    "write(s)": self._write_time}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def load_tiff(filename):
+    """
+    Load frames and metadata from a BigTIFF file written by :class:`TiffWriter`.
+
+    Only the features used by :class:`TiffWriter` are supported (little endian BigTIFF, single sample per pixel,
+    strips without compression or with deflate compression).
+
+    :param filename: Name of TIFF file
+    :type filename: str
+    :returns: Tuple (list of frames, list of metadata dicts)
+
+    .. versionadded:: 2.2.0
+    """
+    frames = []
+    metadata = []
+    with open(filename, "rb") as fp:
+        header = fp.read(16)
+        if header[:4] != b"II\x2b\x00":
+            raise ValueError("File '%s' is not a little endian BigTIFF file." % filename)
+        position = int(np.frombuffer(header[8:16], dtype="<u8")[0])
+        while position:
+            fp.seek(position)
+            count = int(np.frombuffer(fp.read(8), dtype="<u8")[0])
+            raw = fp.read(count * 20 + 8)
+            tags = {}
+            for n in range(count):
+                entry = raw[n * 20:(n + 1) * 20]
+                tag, field_type = np.frombuffer(entry[:4], dtype="<u2")
+                value_count = int(np.frombuffer(entry[4:12], dtype="<u8")[0])
+                data = entry[12:20]
+                size = _FIELD_SIZES[int(field_type)] * value_count
+                if size > 8:
+                    fp.seek(int(np.frombuffer(data, dtype="<u8")[0]))
+                    data = fp.read(size)
+                data = data[:size]
+                if field_type == _ASCII:
+                    tags[int(tag)] = data.rstrip(b"\0").decode("utf-8")
+                else:
+                    tags[int(tag)] = np.frombuffer(data, dtype=_FIELD_DTYPES[int(field_type)]).tolist()
+            position = int(np.frombuffer(raw[count * 20:count * 20 + 8], dtype="<u8")[0])
+
+            dtype = np.dtype("<%s%d" % (_KINDS[tags[_SAMPLE_FORMAT][0]], tags[_BITS_PER_SAMPLE][0] // 8))
+            chunks = []
+            for offset, size in zip(tags[_STRIP_OFFSETS], tags[_STRIP_BYTE_COUNTS]):
+                fp.seek(offset)
+                data = fp.read(size)
+                if tags[_COMPRESSION][0] == _COMPRESSION_DEFLATE:
+                    data = zlib.decompress(data)
+                chunks.append(data)
+            frame = np.frombuffer(b"".join(chunks), dtype=dtype)
+            frames.append(frame.reshape(tags[_IMAGE_LENGTH][0], tags[_IMAGE_WIDTH][0]))
+            description = tags.get(_IMAGE_DESCRIPTION)
+            metadata.append(json.loads(description) if description else {})
+    return frames, metadata
@@ -0,0 +1,237 @@
+import math
+import threading
+import time
+
+from ._pipeline import Pipeline, settle
+
+
+# State fields recorded for each frame by default
+DEFAULT_METADATA_FIELDS = ("stage_position", "defocus", "magnification_index", "spot_size_index", "intensity",
+                           "image_shift", "beam_shift", "beam_blanked")
+
+
+def _tilt_range(start, stop, step):
+    """Return angles from *start* towards *stop* (inclusive) in steps of *step*."""
+    count = int(math.floor(abs(stop - start) / step + 1e-9))
+    sign = 1.0 if stop >= start else -1.0
+    return [start + sign * step * n for n in range(count + 1)]
+
+
+def dose_symmetric_angles(max_angle, step, start=0.0, group=1, min_angle=None):
+    """
+    Return tilt angles (in degrees) of a dose-symmetric tilt scheme.
+
+    The series starts at *start* and alternates between positive and negative tilts in groups of *group* angles
+    (e.g. 0, 3, -3, 6, -6, ... for a *group* of 1), until *max_angle* and *min_angle* (defaults to -*max_angle*)
+    are reached.
+
+    :param max_angle: Maximum tilt angle in degrees
+    :type max_angle: float
+    :param step: Increment in degrees
+    :type step: float
+    :param start: Start angle in degrees
+    :type start: float
+    :param group: Number of consecutive angles on the same side
+    :type group: int
+    :param min_angle: Minimum tilt angle in degrees
+    :type min_angle: Optional[float]
+    :returns: List of angles
+
+    .. versionadded:: 2.2.0
+    """
+    step = abs(float(step))
+    if step <= 0.0:
+        raise ValueError("Step must be positive.")
+    min_angle = -max_angle if min_angle is None else min_angle
+    group = max(int(group), 1)
+    positive = _tilt_range(start, max_angle, step)[1:]
+    negative = _tilt_range(start, min_angle, step)[1:]
+    angles = [float(start)]
+    while positive or negative:
+        angles.extend(positive[:group])
+        angles.extend(negative[:group])
+        positive = positive[group:]
+        negative = negative[group:]
+    return angles
+
+
+def bidirectional_angles(max_angle, step, start=0.0, min_angle=None):
+    """
+    Return tilt angles (in degrees) of a bidirectional tilt scheme.
+
+    The series starts at *start* and goes to *max_angle*, then continues on the other side of *start* towards
+    *min_angle* (defaults to -*max_angle*).
+
+    .. versionadded:: 2.2.0
+    """
+    step = abs(float(step))
+    if step <= 0.0:
+        raise ValueError("Step must be positive.")
+    min_angle = -max_angle if min_angle is None else min_angle
+    return _tilt_range(start, max_angle, step) + _tilt_range(start, min_angle, step)[1:]
+
+
+def unidirectional_angles(max_angle, step, min_angle=None):
+    """
+    Return tilt angles (in degrees) from *min_angle* (defaults to -*max_angle*) to *max_angle*.
+
+    .. versionadded:: 2.2.0
+    """
+    step = abs(float(step))
+    if step <= 0.0:
+        raise ValueError("Step must be positive.")
+    min_angle = -max_angle if min_angle is None else min_angle
+    return _tilt_range(min_angle, max_angle, step)
+
+
+class TiltSeries:
+    """
+    Pipelined acquisition of tilt series.
+
+    For each tilt angle the stage is tilted, the state fields given by *metadata_fields* are read (by a single
+    :meth:`BaseMicroscope.get_state` call), and the *detectors* are acquired. The acquired frames are passed to
+    *writer* in worker threads. While a frame is written, the stage is already moved to the next angle (using
+    ``set_stage_position(..., wait=False)``). At most *max_pending* frames are waiting to be written, afterwards the
+    acquisition waits for the writers.
+
+    Angles outside of the alpha range of :meth:`BaseMicroscope.get_stage_limits` are skipped.
+
+    The *writer* is called as ``writer(index, images, metadata)`` with the index of the frame, the dict of images
+    returned by :meth:`BaseMicroscope.acquire`, and the metadata dict of the frame. The metadata dict contains the
+    keys "index", "angle(deg)", "time" (seconds since epoch, when the acquisition started), and "state" (dict with the
+    read state fields). If no *writer* is given, the images are kept in memory and stored in the metadata dicts
+    with the key "images".
+
+    :param microscope: Microscope
+    :type microscope: BaseMicroscope
+    :param detectors: Names of detectors to acquire
+    :type detectors: Union[str, Iterable[str]]
+    :param angles: Tilt angles in degrees, e.g. from :func:`dose_symmetric_angles`
+    :type angles: Iterable[float]
+    :param writer: Callable writing the frames
+    :param settle_time: Time in seconds to wait after the stage arrived (in clock time for a simulated microscope)
+    :type settle_time: float
+    :param metadata_fields: State fields recorded for each frame
+    :type metadata_fields: Iterable[str]
+    :param workers: Number of writer threads
+    :type workers: int
+    :param max_pending: Maximum number of frames waiting for the writers
+    :type max_pending: int
+    :param callback: Optional callable called with the metadata dict after each acquisition
+
+    Usage:
+
+        >>> angles = dose_symmetric_angles(60.0, 3.0, group=2)
+        >>> series = TiltSeries(microscope, "BM-Ceta", angles, writer=write_frame, settle_time=0.5)
+        >>> frames = series.run()
+        >>> series.statistics()
+
+    .. versionadded:: 2.2.0
+    """
+    def __init__(self, microscope, detectors, angles, writer=None, settle_time=0.0,
+                 metadata_fields=DEFAULT_METADATA_FIELDS, workers=2, max_pending=4, callback=None):
+        self.microscope = microscope
+        self.detectors = [detectors] if isinstance(detectors, str) else list(detectors)
+        self.angles = [float(angle) for angle in angles]
+        self.writer = writer
+        self.settle_time = float(settle_time)
+        self.metadata_fields = list(metadata_fields) if metadata_fields is not None else []
+        self.workers = int(workers)
+        self.max_pending = int(max_pending)
+        self.callback = callback
+        self.skipped = []
+        self._lock = threading.Lock()
+        self._timings = {}
+
+    def _time(self, phase, start):
+        duration = time.perf_counter() - start
+        with self._lock:
+            self._timings[phase] = self._timings.get(phase, 0.0) + duration
+
+    def valid_angles(self):
+        """Return angles within the alpha range of the stage, the other angles are stored in :attr:`skipped`."""
+        limits = self.microscope.get_stage_limits()
+        alpha_min, alpha_max = limits.get("a", (-math.pi, math.pi))
+        valid = []
+        self.skipped = []
+        for angle in self.angles:
+            # Tolerate rounding errors at the limits
+            if alpha_min - 1e-9 <= math.radians(angle) <= alpha_max + 1e-9:
+                valid.append(angle)
+            else:
+                self.skipped.append(angle)
+        return valid
+
+    def run(self):
+        """
+        Acquire the series.
+
+        :returns: List of metadata dicts of the frames
+        """
+        angles = self.valid_angles()
+        self._timings = {}
+        frames = []
+        if not angles:
+            return frames
+
+        start_total = time.perf_counter()
+        pipeline = Pipeline(self._write, workers=self.workers, max_pending=self.max_pending)
+        try:
+            move = self.microscope.set_stage_position(a=math.radians(angles[0]), wait=False)
+            for index, angle in enumerate(angles):
+                start = time.perf_counter()
+                move.result()
+                self._time("move_wait", start)
+                settle(self.microscope, self.settle_time)
+
+                start = time.perf_counter()
+                state = self.microscope.get_state(fields=self.metadata_fields) if self.metadata_fields else {}
+                self._time("metadata", start)
+
+                timestamp = time.time()
+                start = time.perf_counter()
+                images = self.microscope.acquire(*self.detectors)
+                self._time("acquire", start)
+
+                # Start moving to the next angle, while the frame is written
+                if index + 1 < len(angles):
+                    move = self.microscope.set_stage_position(a=math.radians(angles[index + 1]), wait=False)
+
+                metadata = {
+                    "index": index,
+                    "angle(deg)": angle,
+                    "time": timestamp,
+                    "state": state
+                }
+                frames.append(metadata)
+                if self.callback is not None:
+                    self.callback(metadata)
+                pipeline.submit(index, images, metadata)
+        finally:
+            pipeline.close()
+            with self._lock:
+                self._timings["write_wait"] = pipeline.wait_time
+                self._timings["total"] = time.perf_counter() - start_total
+        return frames
+
+    def _write(self, index, images, metadata):
+        start = time.perf_counter()
+        if self.writer is None:
+            metadata["images"] = images
+        else:
+            self.writer(index, images, metadata)
+        self._time("write", start)
+
+    def statistics(self):
+        """
+        Return dict with the accumulated times (in seconds) of the last run:
+
+            * "move_wait": Waiting for the stage (not overlapped with writing)
+            * "metadata": Reading the state fields
+            * "acquire": Acquisition
+            * "write": Writing frames (in worker threads, overlapped with the acquisition)
+            * "write_wait": Waiting for the writers, since *max_pending* frames were pending
+            * "total": Total time
+        """
+        with self._lock:
+            return dict(self._timings)